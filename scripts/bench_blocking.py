@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Small-file latency while a large directory renders.
+
+Builds a throwaway tree with one small file and a directory of many entries,
+starts k0sNgin under uvicorn once per K0SNGIN_BLOCKING_THREADS value, and
+for a few seconds requests the small file from several clients while another
+client keeps re-rendering the large directory (a new ``?index=`` each time,
+so the render cache can't answer). Prints small-file latency percentiles
+for each setting; ``0`` is the old all-on-the-event-loop behavior.
+
+Usage: python scripts/bench_blocking.py [--entries 20000] [--threads 0,16]
+"""
+
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+
+def build_tree(top: str, entries: int) -> None:
+    with open(os.path.join(top, "small.css"), "w") as f:
+        f.write("body { margin: 0; }\n" * 20)
+    big = os.path.join(top, "big")
+    os.mkdir(big)
+    for i in range(entries):
+        with open(os.path.join(big, f"file-{i:06d}.txt"), "w") as f:
+            f.write("x")
+    # Settle everything, so the server's caches accept it.
+    for directory, _, filenames in os.walk(top):
+        for name in filenames:
+            os.utime(os.path.join(directory, name), (1_500_000_000, 1_500_000_000))
+        os.utime(directory, (1_500_000_000, 1_500_000_000))
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(top: str, threads: int, port: int) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        "K0SNGIN_TOP_LEVEL": top,
+        "K0SNGIN_RATE_LIMIT": "1000000000",
+        "K0SNGIN_BLOCKING_THREADS": str(threads),
+    }
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "k0sngin.main:app", "--port", str(port),
+         "--log-level", "warning"],
+        env=env, stdout=subprocess.DEVNULL,
+    )
+
+
+async def wait_ready(client: httpx.AsyncClient) -> None:
+    for _ in range(100):
+        try:
+            await client.get("/small.css")
+            return
+        except httpx.TransportError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError("server did not start")
+
+
+async def measure(base_url: str, duration: float, clients: int) -> tuple[list, int]:
+    latencies = []
+    renders = 0
+    deadline = time.perf_counter() + duration
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=60) as client:
+        await wait_ready(client)
+
+        async def small():
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                response = await client.get("/small.css")
+                latencies.append(time.perf_counter() - started)
+                response.raise_for_status()
+
+        async def render():
+            nonlocal renders
+            while time.perf_counter() < deadline:
+                response = await client.get(f"/big/?index={renders}")
+                response.raise_for_status()
+                renders += 1
+
+        await asyncio.gather(render(), *(small() for _ in range(clients)))
+    return latencies, renders
+
+
+def percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def main(args=sys.argv[1:]):
+    """CLI entry point"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entries', type=int, default=20000, help='Entries in the large directory (default: 20000)')
+    parser.add_argument('--threads', default='0,16', help='Comma-separated K0SNGIN_BLOCKING_THREADS values to compare (default: 0,16)')
+    parser.add_argument('--duration', type=float, default=5, help='Seconds per run (default: 5)')
+    parser.add_argument('--clients', type=int, default=8, help='Concurrent small-file clients (default: 8)')
+    options = parser.parse_args(args)
+
+    with tempfile.TemporaryDirectory(prefix="k0sngin-bench-") as top:
+        build_tree(top, options.entries)
+        for threads in [int(value) for value in options.threads.split(',')]:
+            port = free_port()
+            server = start_server(top, threads, port)
+            try:
+                latencies, renders = asyncio.run(
+                    measure(f"http://127.0.0.1:{port}", options.duration, options.clients))
+            finally:
+                server.terminate()
+                server.wait()
+            ms = [latency * 1000 for latency in latencies]
+            print(f"K0SNGIN_BLOCKING_THREADS={threads}: {len(ms)} small-file requests,"
+                  f" {renders} renders; p50 {percentile(ms, 50):.1f} ms,"
+                  f" p99 {percentile(ms, 99):.1f} ms, max {max(ms):.1f} ms")
+
+
+if __name__ == '__main__':
+    sys.exit(main() or 0)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Per-request overhead of the rate-limit and security-header middleware.
+
+Calls a trivial ASGI endpoint directly (no server, no sockets) many times,
+bare and wrapped in the two middleware layers: the BaseHTTPMiddleware
+versions they replaced (reproduced below) and the plain-ASGI ones in
+k0sngin. Prints microseconds per request for each, and the overhead over
+the bare endpoint.
+
+Usage: python scripts/bench_middleware.py [--requests 20000]
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse, Response
+
+os.environ.setdefault("K0SNGIN_TOP_LEVEL", tempfile.gettempdir())
+from k0sngin.main import COMMIT, SecurityHeadersMiddleware  # noqa: E402
+from k0sngin.ratelimit import RateLimitMiddleware  # noqa: E402
+
+
+class BaseHTTPRateLimit(BaseHTTPMiddleware):
+    """The timestamp-list limiter as it was."""
+
+    def __init__(self, app, requests_per_minute: int = 60):
+        super().__init__(app)
+        self.requests_per_minute = requests_per_minute
+        self.request_counts = defaultdict(list)
+
+    async def dispatch(self, request: Request, call_next):
+        client_ip = request.client.host if request.client else "unknown"
+        if "x-forwarded-for" in request.headers:
+            client_ip = request.headers["x-forwarded-for"].split(",")[0].strip()
+        current_time = time.time()
+        self.request_counts[client_ip] = [
+            timestamp for timestamp in self.request_counts[client_ip]
+            if current_time - timestamp < 60
+        ]
+        if len(self.request_counts[client_ip]) >= self.requests_per_minute:
+            return Response("Rate limit exceeded. Please try again later.", status_code=429,
+                            headers={"Retry-After": "60"})
+        self.request_counts[client_ip].append(current_time)
+        return await call_next(request)
+
+
+class BaseHTTPSecurityHeaders(BaseHTTPMiddleware):
+    """The per-response header assignment as it was."""
+
+    async def dispatch(self, request: Request, call_next):
+        response = await call_next(request)
+        response.headers["X-Content-Type-Options"] = "nosniff"
+        response.headers["X-Frame-Options"] = "DENY"
+        response.headers["X-XSS-Protection"] = "1; mode=block"
+        response.headers["Referrer-Policy"] = "strict-origin-when-cross-origin"
+        response.headers["X-K0sNgin-Commit"] = COMMIT
+        response.headers["Content-Security-Policy"] = (
+            "default-src 'self'; "
+            "script-src 'self'; "
+            "style-src 'self' 'unsafe-inline'; "
+            "img-src 'self' data: https:; "
+            "font-src 'self' data:; "
+            "connect-src 'self'; "
+            "frame-ancestors 'none';"
+        )
+        return response
+
+
+async def endpoint(scope, receive, send):
+    await PlainTextResponse("ok")(scope, receive, send)
+
+
+SCOPE = {
+    "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+    "method": "GET", "scheme": "http", "path": "/", "raw_path": b"/",
+    "root_path": "", "query_string": b"", "headers": [(b"host", b"bench")],
+    "client": ("127.0.0.1", 1234), "server": ("bench", 80),
+}
+
+
+async def receive():
+    return {"type": "http.request", "body": b"", "more_body": False}
+
+
+async def send(message):
+    pass
+
+
+async def time_app(app, requests: int) -> float:
+    """Microseconds per request."""
+    for _ in range(min(requests, 1000)):  # warm up
+        await app(dict(SCOPE), receive, send)
+    started = time.perf_counter()
+    for _ in range(requests):
+        await app(dict(SCOPE), receive, send)
+    return (time.perf_counter() - started) / requests * 1e6
+
+
+def main(args=sys.argv[1:]):
+    """CLI entry point"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=20000, help='Requests per variant (default: 20000)')
+    options = parser.parse_args(args)
+
+    limit = options.requests * 10  # never 429: measure the pass-through path
+    variants = {
+        "bare endpoint": endpoint,
+        "BaseHTTPMiddleware": BaseHTTPSecurityHeaders(BaseHTTPRateLimit(endpoint, limit)),
+        "plain ASGI": SecurityHeadersMiddleware(RateLimitMiddleware(endpoint, limit)),
+    }
+    results = {name: asyncio.run(time_app(app, options.requests))
+               for name, app in variants.items()}
+    bare = results["bare endpoint"]
+    for name, us in results.items():
+        overhead = "" if name == "bare endpoint" else f" (+{us - bare:.1f} us)"
+        print(f"{name:>20}: {us:7.1f} us/request{overhead}")
+
+
+if __name__ == '__main__':
+    sys.exit(main() or 0)
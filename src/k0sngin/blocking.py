@@ -0,0 +1,118 @@
+"""
+Blocking work off the event loop.
+
+Filesystem lookups and directory renders run in worker threads through
+``run_blocking``, at most ``K0SNGIN_BLOCKING_THREADS`` (default 16) at a
+time per process, so a slow stat or a large render holds up only its own
+request. Requests answered from memory stay on the event loop (see
+``main.answered_from_memory``). ``K0SNGIN_BLOCKING_THREADS=0`` runs
+everything inline, as before (for comparison: scripts/bench_blocking.py).
+
+Directory renders are the expensive kind, and a crawler can ask for many at
+once. At most ``K0SNGIN_RENDER_CONCURRENCY`` (default 4) run at a time per
+process; up to ``K0SNGIN_RENDER_QUEUE`` more (default 16) wait, each for at
+most ``K0SNGIN_RENDER_WAIT`` seconds (default 5). Past that, ``admit_render``
+answers 503 with ``Retry-After`` at once. Threads stay free for file
+lookups, so static traffic keeps flowing. ``K0SNGIN_RENDER_CONCURRENCY=0``
+admits every render.
+"""
+
+import contextlib
+import math
+import os
+
+import anyio
+from anyio.lowlevel import RunVar
+from fastapi import HTTPException, status
+
+BLOCKING_THREADS = int(os.environ.get("K0SNGIN_BLOCKING_THREADS", "16"))
+RENDER_CONCURRENCY = int(os.environ.get("K0SNGIN_RENDER_CONCURRENCY", "4"))
+RENDER_QUEUE = int(os.environ.get("K0SNGIN_RENDER_QUEUE", "16"))
+RENDER_WAIT = float(os.environ.get("K0SNGIN_RENDER_WAIT", "5"))
+
+# One limiter per event loop, as anyio keeps its own default one.
+_limiter = RunVar("k0sngin_blocking_limiter")
+
+
+def limiter() -> anyio.CapacityLimiter:
+    """The running event loop's limiter for blocking work."""
+    try:
+        return _limiter.get()
+    except LookupError:
+        limiter = anyio.CapacityLimiter(BLOCKING_THREADS)
+        _limiter.set(limiter)
+        return limiter
+
+
+async def run_blocking(func, *args):
+    """``func(*args)`` in a worker thread (or inline, with 0 threads)."""
+    if BLOCKING_THREADS <= 0:
+        return func(*args)
+    return await anyio.to_thread.run_sync(func, *args, limiter=limiter())
+
+
+class RenderAdmission:
+    """At most ``concurrency`` renders at a time, and ``queue`` waiting."""
+
+    def __init__(self, concurrency: int, queue: int, wait: float):
+        self.concurrency = concurrency
+        self.semaphore = anyio.Semaphore(concurrency)
+        self.queue = queue
+        self.wait = wait
+        self.waiting = 0
+        self.admitted = 0
+        self.shed = 0
+
+    def overloaded(self) -> HTTPException:
+        self.shed += 1
+        return HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                             detail="Server busy. Please try again later.",
+                             headers={"Retry-After": str(max(1, math.ceil(self.wait)))})
+
+    @contextlib.asynccontextmanager
+    async def admit(self):
+        """Hold a render slot, waiting in the queue for one if need be."""
+        try:
+            self.semaphore.acquire_nowait()
+        except anyio.WouldBlock:
+            if self.waiting >= self.queue:
+                raise self.overloaded() from None
+            self.waiting += 1
+            try:
+                with anyio.fail_after(self.wait):
+                    await self.semaphore.acquire()
+            except TimeoutError:
+                raise self.overloaded() from None
+            finally:
+                self.waiting -= 1
+        self.admitted += 1
+        try:
+            yield
+        finally:
+            self.semaphore.release()
+
+    def stats(self) -> dict:
+        """Counters and occupancy."""
+        return {"running": self.concurrency - self.semaphore.value,
+                "waiting": self.waiting, "admitted": self.admitted, "shed": self.shed}
+
+
+_admission = RunVar("k0sngin_render_admission")
+
+
+def render_admission() -> RenderAdmission:
+    """The running event loop's render admission."""
+    try:
+        return _admission.get()
+    except LookupError:
+        admission = RenderAdmission(RENDER_CONCURRENCY, RENDER_QUEUE, RENDER_WAIT)
+        _admission.set(admission)
+        return admission
+
+
+def admit_render():
+    """A render slot (see ``RenderAdmission.admit``), or none needed with
+    ``K0SNGIN_RENDER_CONCURRENCY=0``."""
+    if RENDER_CONCURRENCY <= 0:
+        return contextlib.nullcontext()
+    return render_admission().admit()
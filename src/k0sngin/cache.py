@@ -0,0 +1,232 @@
+"""
+In-process caches for the request path.
+
+Everything here is process-wide and thread-safe: the caches are shared by all
+requests a worker serves. Entries are validated against the filesystem with
+``stat_signature`` rather than expired by time, so a cached value is never
+older than the file it was derived from.
+
+When a filesystem watcher is running (``watcher.py``), ``stat_signature``
+itself is memoized for the paths the watcher covers, and the watcher's
+``invalidate`` calls keep the memo — and every cache registered with
+``on_invalidate`` — current without per-request stats.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Filesystem timestamps come from a coarse clock, so a second change within
+# the same tick can leave a file's mtime (and signature) unchanged. Like git's
+# "racy clean" rule, a signature this recent is not trusted for caching.
+RACY_WINDOW_NS = 2 * 10**9
+
+
+def _stat_signature(path) -> tuple | None:
+    try:
+        stat_result = os.stat(path)
+    except OSError:
+        return None
+    return (stat_result.st_ino, stat_result.st_mtime_ns, stat_result.st_size)
+
+
+def stat_signature(path) -> tuple | None:
+    """``(st_ino, st_mtime_ns, st_size)`` for a path, or None if it can't be
+    stat'ed. Any edit, replacement, or removal changes the signature.
+
+    Memoized (in ``STAT_CACHE``) for paths a running watcher covers.
+    """
+    path = os.fspath(path)
+    covers = _covers
+    if covers is None or not covers(path):
+        return _stat_signature(path)
+    signature = STAT_CACHE.get(path, _MISSING)
+    if signature is _MISSING:
+        generation = _generation
+        signature = _stat_signature(path)
+        with _invalidation_lock:
+            # Don't memoize a stat that may predate an invalidation that
+            # arrived while it was in flight.
+            if generation == _generation:
+                STAT_CACHE.put(path, signature)
+    return signature
+
+
+def is_settled(signature: tuple | None) -> bool:
+    """True if a ``stat_signature`` is old enough to key a cache entry on
+    (see ``RACY_WINDOW_NS``). A missing file (None) is settled."""
+    return signature is None or time.time_ns() - signature[1] > RACY_WINDOW_NS
+
+
+# Every named cache, for reporting (see ``all_stats``).
+CACHES = {}
+
+
+class LRUCache:
+    """Bounded least-recently-used mapping with hit/miss/eviction counters.
+
+    ``maxsize`` caps the number of entries (None: no cap; ``0`` disables the
+    cache — every lookup misses, nothing is stored). ``maxbytes`` caps the
+    total of the sizes passed to ``put``; a single value larger than the
+    budget is not stored. A ``name`` registers the cache in ``CACHES``.
+    """
+
+    def __init__(self, maxsize: int | None = 1024, maxbytes: int | None = None,
+                 name: str | None = None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()  # key -> (value, size)
+        self._lock = threading.Lock()
+        if name:
+            CACHES[name] = self
+
+    def get(self, key, default=None):
+        """Value for ``key`` (marking it most recently used), or ``default``."""
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return self._data[key][0]
+
+    def peek(self, key, default=None):
+        """Value for ``key`` without marking it used or counting a lookup."""
+        entry = self._data.get(key)
+        return default if entry is None else entry[0]
+
+    def put(self, key, value, size: int = 0) -> None:
+        """Store ``value`` (weighing ``size`` bytes), evicting least recently
+        used entries past the limits."""
+        if self.maxsize == 0 or (self.maxbytes is not None and size > self.maxbytes):
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[1]
+            self._data[key] = (value, size)
+            self.nbytes += size
+            while ((self.maxsize is not None and len(self._data) > self.maxsize)
+                   or (self.maxbytes is not None and self.nbytes > self.maxbytes)):
+                _, (_, evicted_size) = self._data.popitem(last=False)
+                self.nbytes -= evicted_size
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        """Remove and return the entry for ``key`` (no counters touched)."""
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return default
+            self.nbytes -= entry[1]
+            return entry[0]
+
+    def pop_if(self, predicate) -> int:
+        """Remove every entry whose key satisfies ``predicate``; returns the
+        number removed. Linear in the cache size."""
+        with self._lock:
+            keys = [key for key in self._data if predicate(key)]
+            for key in keys:
+                self.nbytes -= self._data.pop(key)[1]
+            return len(keys)
+
+    def clear(self) -> None:
+        """Drop every entry; counters are kept."""
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+    def stats(self) -> dict:
+        """Counters and occupancy, for sizing the cache."""
+        with self._lock:
+            return {
+                "entries": len(self._data),
+                "maxsize": self.maxsize,
+                "bytes": self.nbytes,
+                "maxbytes": self.maxbytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key) -> bool:
+        return key in self._data
+
+
+def all_stats() -> dict:
+    """``stats()`` of every named cache."""
+    return {name: cache.stats() for name, cache in CACHES.items()}
+
+
+# --- watcher-driven invalidation ---------------------------------------------
+
+STAT_CACHE = LRUCache(int(os.environ.get("K0SNGIN_STAT_CACHE_SIZE", "65536")),
+                      name="stat")
+
+_MISSING = object()
+_covers = None        # set by the watcher: path -> True if its changes are reported
+_generation = 0       # bumped by every invalidation
+_invalidation_lock = threading.Lock()
+_invalidators = []
+
+
+def set_coverage(covers) -> None:
+    """Install (or, with None, remove) the watcher's coverage predicate.
+
+    Either way the memo is flushed: it is only valid while the same watcher
+    has been reporting changes without a gap.
+    """
+    global _covers
+    _covers = covers
+    invalidate_all()
+
+
+def covered(path) -> bool:
+    """True if a running watcher guarantees to report changes to ``path``."""
+    covers = _covers
+    return covers is not None and covers(os.fspath(path))
+
+
+def generation() -> int:
+    """Invalidation counter: a value derived from the filesystem may only be
+    cached if this is unchanged from before it was read."""
+    return _generation
+
+
+def on_invalidate(callback) -> None:
+    """Register ``callback(path, subtree)`` to be told about changed paths;
+    ``path`` None means everything may have changed."""
+    _invalidators.append(callback)
+
+
+def invalidate(path, subtree: bool = False) -> None:
+    """A path (with ``subtree``, everything below it too) changed on disk."""
+    global _generation
+    path = os.fspath(path)
+    with _invalidation_lock:
+        _generation += 1
+        STAT_CACHE.pop(path)
+        if subtree:
+            prefix = path.rstrip(os.sep) + os.sep
+            STAT_CACHE.pop_if(lambda key: key.startswith(prefix))
+    for callback in _invalidators:
+        callback(path, subtree)
+
+
+def invalidate_all() -> None:
+    """Anything may have changed (e.g. the watcher lost events)."""
+    global _generation
+    with _invalidation_lock:
+        _generation += 1
+        STAT_CACHE.clear()
+    for callback in _invalidators:
+        callback(None, True)
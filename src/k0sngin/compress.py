@@ -0,0 +1,302 @@
+"""
+Dynamic response compression (gzip, and brotli when installed).
+
+``CompressionMiddleware`` is plain ASGI: it rewrites the messages as they
+pass, so a streamed body is compressed and sent chunk by chunk rather than
+collected first. A file handed over by path (``pathsend``/``zerocopysend``)
+is read and compressed ``FILE_CHUNK_SIZE`` bytes at a time. Only ``200``
+responses to ``GET`` and ``HEAD`` with a compressible content type
+(``precompressed.COMPRESSIBLE_TYPES``) and at least
+``K0SNGIN_COMPRESS_MIN_SIZE`` bytes are compressed; anything already
+encoded (e.g. a precompressed sibling), marked ``no-transform``, or a range
+passes through untouched. A ``HEAD`` gets the headers the ``GET`` would;
+its ``Content-Length`` only if the compressed body is cached.
+
+Compressed bodies of responses with an ETag are kept in
+``COMPRESSED_CACHE``, keyed by (path, query, ETag, encoding), so a page or
+file is compressed once per version. The compressed representation gets the
+weak form of the ETag, which ``client_cache_is_fresh`` matches against the
+strong one, so 304s keep working; a 304 for it repeats the weak form.
+Chunks larger than ``INLINE_MAX`` are compressed in the thread pool
+(blocking.py), not on the event loop. ``K0SNGIN_COMPRESS=0`` turns it off.
+"""
+
+import os
+import zlib
+
+from starlette.datastructures import Headers, MutableHeaders
+
+from .blocking import run_blocking
+from .cache import LRUCache
+from .precompressed import accepted_encodings, is_compressible
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS = os.environ.get("K0SNGIN_COMPRESS", "1").lower() not in {"0", "false", "no", "off"}
+COMPRESS_MIN_SIZE = int(os.environ.get("K0SNGIN_COMPRESS_MIN_SIZE", "1024"))
+COMPRESSED_CACHE = LRUCache(
+    maxsize=None,
+    maxbytes=int(os.environ.get("K0SNGIN_COMPRESS_CACHE_BYTES", str(16 * 1024 * 1024))),
+    name="compressed",
+)
+INLINE_MAX = 16 * 1024        # larger chunks are compressed in a worker thread
+FILE_CHUNK_SIZE = 256 * 1024  # read size for file bodies
+
+
+class GzipCompressor:
+    def __init__(self):
+        self._zlib = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._zlib.compress(data)
+
+    def finish(self) -> bytes:
+        return self._zlib.flush()
+
+
+class BrotliCompressor:
+    def __init__(self):
+        self._brotli = brotli.Compressor(quality=5)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._brotli.process(data)
+
+    def finish(self) -> bytes:
+        return self._brotli.finish()
+
+
+# Content-Encoding -> streaming compressor, for the encoders available.
+COMPRESSORS = {"gzip": GzipCompressor}
+if brotli is not None:
+    COMPRESSORS["br"] = BrotliCompressor
+
+
+def choose_encoding(accept_encoding: str | None) -> str | None:
+    """The best encoding we can produce that the client accepts, or None."""
+    if not accept_encoding:
+        return None
+    for encoding in accepted_encodings(accept_encoding):
+        if encoding in COMPRESSORS:
+            return encoding
+    return None
+
+
+async def file_message_bodies(message, chunk_size: int = FILE_CHUNK_SIZE):
+    """The ``http.response.body`` messages a ``pathsend`` / ``zerocopysend``
+    message stands for, ``chunk_size`` bytes at a time."""
+    if message["type"] == "http.response.pathsend":
+        fd = await run_blocking(os.open, message["path"], os.O_RDONLY | os.O_CLOEXEC)
+        offset, count, more_body = 0, None, False
+    else:
+        fd = message["file"].fileno()
+        offset, count = message.get("offset", 0), message.get("count")
+        more_body = message.get("more_body", False)
+    try:
+        if count is None:
+            count = os.fstat(fd).st_size - offset
+        while True:
+            chunk = await run_blocking(os.pread, fd, min(chunk_size, count), offset)
+            offset += len(chunk)
+            count -= len(chunk)
+            last = not chunk or count <= 0
+            yield {"type": "http.response.body", "body": chunk,
+                   "more_body": more_body or not last}
+            if last:
+                return
+    finally:
+        if message["type"] == "http.response.pathsend":
+            os.close(fd)
+
+
+class CompressionMiddleware:
+    """Compress eligible responses for clients that accept it."""
+
+    def __init__(self, app, minimum_size: int | None = None, cache: LRUCache | None = None):
+        self.app = app
+        self.minimum_size = COMPRESS_MIN_SIZE if minimum_size is None else minimum_size
+        self.cache = COMPRESSED_CACHE if cache is None else cache
+
+    async def __call__(self, scope, receive, send) -> None:
+        if not COMPRESS or scope["type"] != "http" or scope["method"] not in ("GET", "HEAD"):
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding"))
+        responder = CompressingResponder(scope, send, encoding, self.minimum_size, self.cache)
+        await self.app(scope, receive, responder.send)
+
+
+class CompressingResponder:
+    """The ``send`` side of one response through ``CompressionMiddleware``."""
+
+    def __init__(self, scope, send, encoding: str | None, minimum_size: int,
+                 cache: LRUCache):
+        self.scope = scope
+        self.head = scope["method"] == "HEAD"
+        self.downstream = send
+        self.encoding = encoding
+        self.minimum_size = minimum_size
+        self.cache = cache
+        self.start = None      # the held-back http.response.start
+        self.state = "start"   # start, held, compress, passthrough, done
+        self.compressor = None
+        self.key = None
+        self.parts = []        # compressed output, for the cache
+        self.size = 0
+
+    async def send(self, message) -> None:
+        if self.state == "passthrough" or message["type"] == "http.response.debug":
+            await self.downstream(message)
+        elif self.state == "start":
+            await self.on_start(message)
+        elif self.state in ("held", "compress"):
+            if message["type"] in ("http.response.pathsend", "http.response.zerocopysend"):
+                async for body in file_message_bodies(message, FILE_CHUNK_SIZE):
+                    await self.send_body(body)
+                    if self.state == "done":
+                        break
+            elif message["type"] != "http.response.body":
+                await self.downstream(message)
+            else:
+                await self.send_body(message)
+        # "done": the body came from the cache; the app's copy is dropped.
+
+    async def send_body(self, message) -> None:
+        if self.state == "held":
+            await self.on_first_body(message)
+        elif self.state == "compress":
+            await self.on_body(message)
+        elif self.state == "passthrough":
+            await self.downstream(message)
+
+    async def on_start(self, message) -> None:
+        headers = MutableHeaders(raw=list(message.get("headers", [])))
+        message = {**message, "headers": headers.raw}
+        if message["status"] == 304 and self.encoding is not None:
+            self.not_modified(headers)
+        if (message["status"] != 200
+                or not is_compressible(headers.get("content-type"))
+                or "content-encoding" in headers
+                or "content-range" in headers
+                or "no-transform" in headers.get("cache-control", "")):
+            self.state = "passthrough"
+            await self.downstream(message)
+            return
+        vary = headers.get("vary")
+        if not vary:
+            headers["Vary"] = "Accept-Encoding"
+        elif "accept-encoding" not in vary.lower():
+            headers["Vary"] = f"{vary}, Accept-Encoding"
+        length = headers.get("content-length")
+        if self.encoding is None or (length is not None and int(length) < self.minimum_size):
+            self.state = "passthrough"
+            await self.downstream(message)
+            return
+
+        etag = headers.get("etag")
+        if etag:
+            strong = etag.removeprefix("W/")
+            headers["ETag"] = f"W/{strong}"
+            self.key = (self.scope["path"], self.scope["query_string"], strong, self.encoding)
+            body = self.cache.get(self.key)
+            if body is not None:
+                self.set_encoded(headers, len(body))
+                self.state = "done"
+                await self.downstream(message)
+                await self.downstream({"type": "http.response.body", "body": body})
+                return
+        self.start = message
+        self.state = "held"
+
+    def not_modified(self, headers: MutableHeaders) -> None:
+        """Give a 304 the ETag of the representation the client validated:
+        the weak one, if that is what it holds (it was sent compressed)."""
+        etag = headers.get("etag")
+        if not etag or etag.startswith("W/") or "content-encoding" in headers:
+            return
+        if_none_match = Headers(scope=self.scope).get("if-none-match", "")
+        if f"W/{etag}" in {token.strip() for token in if_none_match.split(",")}:
+            headers["ETag"] = f"W/{etag}"
+            vary = headers.get("vary")
+            if not vary:
+                headers["Vary"] = "Accept-Encoding"
+            elif "accept-encoding" not in vary.lower():
+                headers["Vary"] = f"{vary}, Accept-Encoding"
+
+    def set_encoded(self, headers: MutableHeaders, length: int | None) -> None:
+        headers["Content-Encoding"] = self.encoding
+        if length is None:
+            del headers["content-length"]
+        else:
+            headers["Content-Length"] = str(length)
+
+    async def on_first_body(self, message) -> None:
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        headers = MutableHeaders(raw=self.start["headers"])
+        if self.head and not body and not more_body:
+            # Headers only (a file): the GET's, but the length isn't known.
+            self.set_encoded(headers, None)
+            self.state = "done"
+            await self.downstream(self.start)
+            await self.downstream(message)
+            return
+        if not more_body and len(body) < self.minimum_size:
+            # Too small to be worth it after all: send it as it is.
+            if "etag" in headers:
+                headers["ETag"] = headers["etag"].removeprefix("W/")
+            self.state = "passthrough"
+            await self.downstream(self.start)
+            await self.downstream(message)
+            return
+        self.compressor = COMPRESSORS[self.encoding]()
+        self.state = "compress"
+        if not more_body:
+            # A complete body: compress it in one go, with a Content-Length.
+            compressed = await self.compress(body, final=True)
+            self.set_encoded(headers, len(compressed))
+            self.remember(compressed, final=True)
+            self.state = "done"
+            await self.downstream(self.start)
+            await self.downstream({"type": "http.response.body", "body": compressed})
+            return
+        self.set_encoded(headers, None)
+        await self.downstream(self.start)
+        await self.on_body(message)
+
+    async def on_body(self, message) -> None:
+        more_body = message.get("more_body", False)
+        chunk = await self.compress(message.get("body", b""), final=not more_body)
+        if not more_body:
+            self.state = "done"
+        self.remember(chunk, final=not more_body)
+        if chunk or not more_body:
+            await self.downstream({"type": "http.response.body", "body": chunk,
+                                   "more_body": more_body})
+
+    async def compress(self, data: bytes, final: bool) -> bytes:
+        """Compressed ``data`` (and the end of the stream, if ``final``); off
+        the event loop for large chunks."""
+        if len(data) > INLINE_MAX:
+            return await run_blocking(self._compress, data, final)
+        return self._compress(data, final)
+
+    def _compress(self, data: bytes, final: bool) -> bytes:
+        chunk = self.compressor.compress(data)
+        if final:
+            chunk += self.compressor.finish()
+        return chunk
+
+    def remember(self, chunk: bytes, final: bool) -> None:
+        """Collect compressed output for the cache (while it can still fit)."""
+        if self.key is None:
+            return
+        self.parts.append(chunk)
+        self.size += len(chunk)
+        if self.cache.maxbytes is not None and self.size > self.cache.maxbytes:
+            self.key = None
+            self.parts = []
+        elif final:
+            self.cache.put(self.key, b"".join(self.parts), self.size)
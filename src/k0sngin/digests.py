@@ -0,0 +1,241 @@
+"""
+Content-addressed ETags (optional): ``K0SNGIN_CONTENT_ETAG=1``.
+
+The default ETag is derived from a file's mtime and size, so a deploy that
+rewrites mtimes (git checkout, rsync without ``--times``) changes every
+ETag and the edge refetches the whole site. In this mode a file's ETag is a
+digest of its contents instead, and survives anything that doesn't change
+the bytes.
+
+Digests live in ``DIGESTS``, keyed by path and validated by
+(st_ino, st_size, st_mtime_ns): an unchanged stat means an unchanged digest,
+so each file is hashed once per change. Hashing runs in a small background
+thread pool (``K0SNGIN_DIGEST_WORKERS``, default 2) with
+``hashlib.file_digest``. Until a file's digest is ready it is served with
+the stat ETag, and that ETag keeps validating the file for as long as its
+stat is unchanged. Only files no larger than the caller's ``inline_max``
+are hashed on the spot: a request can't make a large file be hashed on a
+serving thread, whatever it sends. A file whose stat changed (a deploy that
+only rewrote mtimes) is rehashed in the background too, and gets its old
+digest back once that is done. As with the other caches, stats within the
+racy window (``cache.RACY_WINDOW_NS``) are not trusted.
+
+The index holds at most ``K0SNGIN_DIGEST_INDEX_SIZE`` files (default
+131072), the least recently served are dropped first. Files found missing
+are dropped when served and before each save.
+
+With ``K0SNGIN_DIGEST_INDEX`` naming a file, the index is loaded at startup
+and saved at shutdown, and at most once a minute while digests come in. It
+is a ``marshal`` dump, which loads in milliseconds even for large trees. An
+unreadable or malformed index is ignored and rebuilt.
+"""
+
+import contextlib
+import hashlib
+import marshal
+import os
+import stat
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from . import cache
+from .cache import is_settled
+
+CONTENT_ETAG = os.environ.get("K0SNGIN_CONTENT_ETAG", "").lower() in {"1", "true", "yes", "on"}
+DIGEST_INDEX = os.environ.get("K0SNGIN_DIGEST_INDEX")
+DIGEST_WORKERS = int(os.environ.get("K0SNGIN_DIGEST_WORKERS", "2"))
+DIGEST_INDEX_SIZE = int(os.environ.get("K0SNGIN_DIGEST_INDEX_SIZE", "131072"))
+DIGEST_ALGORITHM = "sha256"
+INDEX_VERSION = 1
+SAVE_INTERVAL = 60
+
+
+def file_digest(path: str, signature: tuple) -> str | None:
+    """Hex digest of a file's contents, or None if the file is not (or no
+    longer) the one ``signature`` describes."""
+    try:
+        # Non-blocking, so a FIFO in its place can't hang the open.
+        with open(os.open(path, os.O_RDONLY | os.O_NONBLOCK), "rb") as f:
+            before = os.fstat(f.fileno())
+            if (not stat.S_ISREG(before.st_mode)
+                    or (before.st_ino, before.st_size, before.st_mtime_ns) != signature):
+                return None
+            digest = hashlib.file_digest(f, DIGEST_ALGORITHM).hexdigest()
+            after = os.fstat(f.fileno())
+    except OSError:
+        return None
+    if (after.st_ino, after.st_size, after.st_mtime_ns) != signature:
+        return None  # written to while we read it
+    return digest
+
+
+def _valid_entries(entries) -> bool:
+    """True if a loaded index has the shape ``save`` writes: path ->
+    (st_ino, st_size, st_mtime_ns, hex digest)."""
+    return isinstance(entries, dict) and all(
+        isinstance(path, str) and isinstance(entry, tuple) and len(entry) == 4
+        and all(isinstance(field, int) for field in entry[:3]) and isinstance(entry[3], str)
+        for path, entry in entries.items())
+
+
+class DigestIndex:
+    """Content digests of files, validated by stat and persisted to ``path``."""
+
+    def __init__(self, path: str | None = None, workers: int = 2,
+                 maxsize: int = DIGEST_INDEX_SIZE):
+        self.path = path
+        self.workers = workers
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.computed = 0
+        self.evictions = 0
+        # path -> (st_ino, st_size, st_mtime_ns, hex digest), least recently used first
+        self._entries = OrderedDict()
+        self._pending = {}     # path -> (signature, Future) being hashed
+        self._lock = threading.Lock()
+        self._pool = None
+        self._dirty = False
+        self._saved = time.monotonic()
+
+    def etag(self, path, stat_result, inline_max: int = 0) -> str | None:
+        """Content ETag for ``path`` as ``stat_result`` describes it, or None
+        if it isn't known yet (it is then computed in the background). Files
+        of at most ``inline_max`` bytes are hashed here instead."""
+        digest = self.digest(path, stat_result, inline_max)
+        return None if digest is None else f'"{digest[:32]}"'
+
+    def digest(self, path, stat_result, inline_max: int = 0) -> str | None:
+        path = os.fspath(path)
+        signature = (stat_result.st_ino, stat_result.st_size, stat_result.st_mtime_ns)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[:3] == signature:
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return entry[3]
+            self.misses += 1
+        if not is_settled((stat_result.st_ino, stat_result.st_mtime_ns, stat_result.st_size)):
+            return None
+        if stat_result.st_size <= inline_max:
+            return self._compute(path, signature)
+        with self._lock:
+            if self._pending.get(path, (None,))[0] != signature:
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix="k0sngin-digest")
+                self._pending[path] = (signature, self._pool.submit(self._background, path, signature))
+        return None
+
+    def _compute(self, path: str, signature: tuple) -> str | None:
+        digest = file_digest(path, signature)
+        if digest is not None:
+            with self._lock:
+                self._entries[path] = (*signature, digest)
+                self._entries.move_to_end(path)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+                self._dirty = True
+                self.computed += 1
+        return digest
+
+    def _background(self, path: str, signature: tuple) -> str | None:
+        try:
+            return self._compute(path, signature)
+        finally:
+            with self._lock:
+                if self._pending.get(path, (None,))[0] == signature:
+                    del self._pending[path]
+            if self.path and self._dirty and time.monotonic() - self._saved > SAVE_INTERVAL:
+                self.save()
+
+    def forget(self, path) -> None:
+        """Drop the digest of a file that is gone."""
+        with self._lock:
+            if self._entries.pop(os.fspath(path), None) is not None:
+                self._dirty = True
+
+    def prune(self) -> int:
+        """Drop the digests of files that no longer exist; returns how many."""
+        with self._lock:
+            paths = list(self._entries)
+        gone = [path for path in paths if not os.path.lexists(path)]
+        for path in gone:
+            self.forget(path)
+        return len(gone)
+
+    def wait(self, cancel: bool = False) -> None:
+        """Finish the queued background work, or with ``cancel`` just the
+        digests already being computed (at shutdown)."""
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=cancel)
+
+    def load(self) -> int:
+        """Load the persisted index, if any; returns the number of entries."""
+        if not self.path:
+            return 0
+        try:
+            with open(self.path, "rb") as f:
+                version, algorithm, entries = marshal.load(f)
+        except FileNotFoundError:
+            return 0
+        except (OSError, EOFError, ValueError, TypeError) as e:
+            print(f"K0SNGIN_DIGEST_INDEX: cannot read {self.path}: {e};"
+                  " rebuilding it")  # TODO: log this
+            return 0
+        if version != INDEX_VERSION or algorithm != DIGEST_ALGORITHM:
+            return 0
+        if not _valid_entries(entries):
+            print(f"K0SNGIN_DIGEST_INDEX: {self.path} is malformed;"
+                  " rebuilding it")  # TODO: log this
+            return 0
+        with self._lock:
+            self._entries.update(entries)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return len(entries)
+
+    def save(self) -> None:
+        """Write the index atomically (if it changed since it was loaded)."""
+        if not self.path or not self._dirty:
+            return
+        self.prune()
+        with self._lock:
+            entries = dict(self._entries)
+            self._dirty = False
+            self._saved = time.monotonic()
+        directory = os.path.dirname(os.path.abspath(self.path))
+        tmp = None
+        try:
+            fd, tmp = tempfile.mkstemp(dir=directory, prefix=".digests-")
+            with os.fdopen(fd, "wb") as f:
+                marshal.dump((INDEX_VERSION, DIGEST_ALGORITHM, entries), f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"K0SNGIN_DIGEST_INDEX: cannot write {self.path}: {e}")  # TODO: log this
+            self._dirty = True
+            if tmp is not None:
+                with contextlib.suppress(OSError):
+                    os.remove(tmp)
+
+    def stats(self) -> dict:
+        """Counters and occupancy."""
+        return {
+            "entries": len(self._entries),
+            "maxsize": self.maxsize,
+            "pending": len(self._pending),
+            "hits": self.hits,
+            "misses": self.misses,
+            "computed": self.computed,
+            "evictions": self.evictions,
+        }
+
+
+DIGESTS = DigestIndex(DIGEST_INDEX, DIGEST_WORKERS)
+if CONTENT_ETAG:
+    cache.CACHES["digests"] = DIGESTS
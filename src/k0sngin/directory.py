@@ -3,15 +3,25 @@ Directory indexer.
 """
 
 import fnmatch
+import hashlib
+import os
 import pathlib
+import threading
+import time
 from fastapi import Request, HTTPException, Response
 from fastapi.responses import FileResponse
 from fastapi.templating import Jinja2Templates
 from jinja2 import Environment, FileSystemLoader
 
-from .formatter import apply_formatters
+from . import cache, fingerprint
+from .blocking import admit_render, run_blocking
+from .cache import LRUCache, is_settled, stat_signature
+from .formatter import CacheFormatter, ImagesFormatter, IncludeFormatter, apply_formatters
+from .hints import preload_header, preload_links, send_early_hints
 from .parser import parse_config
 from .path import TOP_LEVEL_DIR
+from .purge import cache_tag_headers
+from .version import COMMIT
 
 # Built-in page templates (also passed to serve_directory as `templates`).
 TEMPLATES_DIR = pathlib.Path(__file__).parent / "templates"
@@ -20,6 +30,41 @@ TEMPLATES_DIR = pathlib.Path(__file__).parent / "templates"
 # they are never inherited by subdirectories. See docs/formatters.md.
 LOCAL_ONLY_FORMATTERS = {"all", "images", "template"}
 
+# Directory indexes are dynamic (index.ini edits must show immediately):
+# allow caches to store but always revalidate — against ``directory_etag``.
+# A ``/cache`` directive overrides it (see ``CachePolicies``).
+INDEX_CACHE_CONTROL = "no-cache"
+
+# How long (seconds) a file response may go on using a directory's memoized
+# ``/cache`` policy without revalidating its index.ini chain, when no
+# watcher reports changes.
+CACHE_POLICY_VALID = float(os.environ.get("K0SNGIN_CACHE_POLICY_VALID", "5"))
+
+# Query parameters the built-in templates read (sequence.html, background.html).
+TEMPLATE_QUERY_PARAMS = ("index", "image")
+
+# Parsed index.ini files, keyed by (path, st_ino, st_mtime_ns, st_size): an
+# edited or replaced file gets a new key, so a lookup costs one stat and the
+# stale entry simply ages out of the LRU.
+INDEX_CONF_CACHE = LRUCache(int(os.environ.get("K0SNGIN_INDEX_CACHE_SIZE", "1024")),
+                            name="index_conf")
+
+# Directory listings, keyed by the directory's own stat signature: creating,
+# removing or renaming an entry changes the directory's mtime. (Entry sizes
+# and mtimes are as of the listing; an in-place edit of a file does not touch
+# its directory.)
+LISTING_CACHE = LRUCache(int(os.environ.get("K0SNGIN_LISTING_CACHE_SIZE", "256")),
+                         name="listing")
+
+# Rendered index pages, keyed by ``directory_etag`` (which already covers
+# every input, including the query parameters the templates read), within a
+# total byte budget.
+RENDER_CACHE = LRUCache(
+    maxsize=None,
+    maxbytes=int(os.environ.get("K0SNGIN_RENDER_CACHE_BYTES", str(32 * 1024 * 1024))),
+    name="render",
+)
+
 
 class DirectoryIndexer:
     """Directory indexer."""
@@ -64,47 +109,325 @@ def parse_index_conf(index_conf_path: pathlib.Path) -> dict:
     }
 
 
-def collect_cascading_formatters(directory: pathlib.Path) -> dict:
+def load_index_conf(index_conf_path: pathlib.Path, signature: tuple | None = ...) -> dict | None:
+    """``parse_index_conf`` through the stat-keyed ``INDEX_CONF_CACHE``.
+
+    Returns None if there is no index.ini. Parse errors (``ValueError``,
+    which includes a file that isn't UTF-8) propagate; they are printed once
+    and cached like parses, so a malformed file isn't re-read until it is
+    edited. The result is shared between requests: callers must copy before
+    mutating. Pass ``signature`` if the file was just stat'ed.
     """
-    Collect formatters by walking up the directory tree from the given directory
-    to the root, with child directories overriding parent formatters.
+    if signature is ...:
+        signature = stat_signature(index_conf_path)
+    if signature is None:
+        return None
+    key = (str(index_conf_path), *signature)
+    conf_data = INDEX_CONF_CACHE.get(key)
+    if conf_data is None:
+        try:
+            conf_data = parse_index_conf(index_conf_path)
+        except ValueError as e:
+            print(f"{index_conf_path}: not parsed: {e}")  # TODO: log this
+            conf_data = e
+        if is_settled(signature):
+            INDEX_CONF_CACHE.put(key, conf_data)
+    if isinstance(conf_data, ValueError):
+        raise conf_data.with_traceback(None)
+    return conf_data
+
+
+def cascading_part(conf_data: dict | None) -> dict:
+    """The formatters an index.ini passes down to its subtree (everything but
+    the local-only directives)."""
+    if conf_data is None:
+        return {}
+    return {
+        key: value
+        for key, value in conf_data["formatters"].items()
+        if key not in LOCAL_ONLY_FORMATTERS
+    }
+
+
+class FormatterNode:
+    """One directory in the ``FormatterTree``."""
+
+    __slots__ = ("children", "signature", "signatures", "settled", "formatters",
+                 "cache_control")
+
+    def __init__(self):
+        self.children = {}
+        self.signature = None   # stat_signature of this directory's index.ini
+        self.signatures = ()    # ...and of every ancestor's, root first
+        self.settled = False    # all of ``signatures`` are cacheable (is_settled)
+        self.formatters = None  # merged cascading formatters; None = not computed
+        self.cache_control = None  # from the effective /cache; None = built-in policy
+
+
+class FormatterTree:
+    """Memo of the merged cascading formatters for every directory served,
+    as a trie mirroring the content tree below ``root``.
+
+    A node's formatters are its parent's merged formatters updated with its
+    own index.ini, so each level costs one dict merge, never a walk back to
+    the root. On lookup every index.ini on the path is re-stat'ed (through
+    the parse cache); if one changed, that node's subtree is dropped and
+    rebuilt from the (still valid) ancestors on the way down.
+
+    A node is never modified once built: a changed one is replaced, with no
+    children, in its parent. The stats and parses happen outside the lock,
+    which only guards installing nodes, so a slow index.ini holds up only
+    the lookups that need it.
     """
-    formatters = {}
 
-    # Walk up the directory tree from current to root
-    current_dir = directory
-    while True:
-        # Check if we've reached the top-level directory
+    def __init__(self, root: pathlib.Path):
+        self.root = root
+        self._root_node = FormatterNode()
+        self._lock = threading.Lock()
+
+    def lookup(self, directory: pathlib.Path) -> dict:
+        """Merged cascading formatters for ``directory`` (read-only: shared
+        between requests). Directories outside ``root`` cascade nothing."""
+        return self.lookup_node(directory).formatters
+
+    def lookup_node(self, directory: pathlib.Path) -> FormatterNode:
+        """The revalidated node for ``directory``; its ``signatures`` are the
+        index.ini inputs of its formatters."""
+        try:
+            parts = directory.relative_to(self.root).parts
+        except ValueError:
+            node = FormatterNode()
+            node.settled = True
+            node.formatters = {}
+            return node
+        node = self._refresh(self._root_node, self.root, None, None)
+        current_dir = self.root
+        for part in parts:
+            current_dir = current_dir / part
+            node = self._refresh(node.children.get(part), current_dir, node, part)
+        return node
+
+    def invalidate(self, directory: pathlib.Path) -> None:
+        """Forget ``directory`` and everything below it."""
         try:
-            current_dir.relative_to(TOP_LEVEL_DIR)
+            parts = directory.relative_to(self.root).parts
         except ValueError:
-            # We've gone above the top-level directory, stop here
-            break
+            return
+        with self._lock:
+            if not parts:
+                self._root_node = FormatterNode()
+                return
+            node = self._root_node
+            for part in parts[:-1]:
+                node = node.children.get(part)
+                if node is None:
+                    return
+            node.children.pop(parts[-1], None)
+
+    def _refresh(self, node: FormatterNode | None, directory: pathlib.Path,
+                 parent: FormatterNode | None, name: str | None) -> FormatterNode:
+        """``node`` if it is still valid for its index.ini, else a new node
+        computed from ``parent``'s memo and installed in its place (as
+        ``parent``'s child ``name``, or as the root)."""
+        index_conf_path = directory / "index.ini"
+        signature = stat_signature(index_conf_path)
+        # A racy signature may hide a second edit, so it never validates:
+        # the memo is rebuilt until the file settles.
+        if (node is not None and node.formatters is not None
+                and signature == node.signature and is_settled(signature)):
+            return node
+        try:
+            own = cascading_part(load_index_conf(index_conf_path, signature))
+        except Exception:
+            # If parsing fails, inherit the parent's formatters unchanged
+            own = {}
+        new = FormatterNode()
+        new.signature = signature
+        new.formatters = {**(parent.formatters if parent else {}), **own}
+        inherited = parent.cache_control if parent else None
+        if "cache" in own:
+            new.cache_control = CacheFormatter.cache_control(
+                own["cache"], inherited, (str(index_conf_path), signature and signature[1]))
+        else:
+            new.cache_control = inherited
+        new.signatures = (parent.signatures if parent else ()) + (signature,)
+        new.settled = (parent.settled if parent else True) and is_settled(signature)
+        with self._lock:
+            if parent is None:
+                self._root_node = new
+            else:
+                parent.children[name] = new
+        return new
+
+
+FORMATTER_TREE = FormatterTree(TOP_LEVEL_DIR)
+
+
+class CachePolicies:
+    """The effective ``/cache`` policy (a Cache-Control value, or None) per
+    directory, memoized so that a file request doesn't revalidate its
+    directory's index.ini chain.
+
+    Page requests revalidate the chain anyway (``directory_etag``) and
+    ``update`` the memo with the result. Otherwise an entry is trusted while
+    the watcher reports no change (``cache.generation``) or, for paths it
+    doesn't cover, for ``valid`` seconds.
+    """
+
+    def __init__(self, tree: FormatterTree, valid: float = 5, maxsize: int = 4096):
+        self.tree = tree
+        self.valid = valid
+        self._memo = LRUCache(maxsize, name="cache_policies")
+
+    @staticmethod
+    def _valid(key: str, entry: tuple | None) -> bool:
+        if entry is None:
+            return False
+        _, generation, expires = entry
+        if cache.covered(key):
+            return generation == cache.generation()
+        return time.monotonic() < expires
+
+    def memoized(self, directory: pathlib.Path) -> bool:
+        """True if ``lookup`` will answer from the memo (no filesystem work)."""
+        key = str(directory)
+        return self._valid(key, self._memo.peek(key))
+
+    def lookup(self, directory: pathlib.Path) -> str | None:
+        key = str(directory)
+        entry = self._memo.get(key)
+        if self._valid(key, entry):
+            return entry[0]
+        generation = cache.generation()
+        node = self.tree.lookup_node(directory)
+        self.update(directory, node, generation)
+        return node.cache_control
+
+    def update(self, directory: pathlib.Path, node: FormatterNode, generation: int) -> None:
+        """Remember ``node``'s policy, revalidated at ``generation``."""
+        self._memo.put(str(directory),
+                       (node.cache_control, generation, time.monotonic() + self.valid))
+
+
+CACHE_POLICIES = CachePolicies(FORMATTER_TREE, CACHE_POLICY_VALID)
+
+
+def index_cache_control(directory: pathlib.Path) -> str:
+    """Cache-Control for a directory's index page."""
+    return CACHE_POLICIES.lookup(directory) or INDEX_CACHE_CONTROL
+
+
+def collect_cascading_formatters(directory: pathlib.Path) -> dict:
+    """
+    Collect formatters cascading from the top-level directory down to the
+    given directory, with child directories overriding parent formatters.
+    Served from the memoized ``FORMATTER_TREE``.
+    """
+    return dict(FORMATTER_TREE.lookup(directory))
+
+
+def list_directory(directory: pathlib.Path) -> dict:
+    """Directory listing: name -> ``{name, type, size, mtime}``.
 
-        # Look for index.ini in current directory
-        index_conf_path = current_dir / "index.ini"
-        if index_conf_path.exists():
+    One ``os.scandir`` pass: the entry type comes from the ``d_type`` the
+    kernel returns with the names (only symlinks need a stat to classify),
+    size and mtime from the entry's stat. Cached in ``LISTING_CACHE`` by the
+    directory's signature; the result is shared, so callers copy entries
+    before mutating them.
+    """
+    signature = stat_signature(directory)
+    key = (str(directory), signature)
+    disk_entries = LISTING_CACHE.get(key)
+    if disk_entries is not None:
+        return disk_entries
+
+    disk_entries = {}
+    with os.scandir(directory) as entries:
+        for item in entries:
+            try:
+                item_type = None
+                if item.is_file():
+                    item_type = 'file'
+                elif item.is_dir():
+                    item_type = 'directory'
+            except PermissionError:
+                # Just skip for now
+                # We should log this eventually
+                continue
             try:
-                conf_data = parse_index_conf(index_conf_path)
-                # Child formatters override parent formatters.
-                # Local-only directives never cascade.
-                formatters.update({
-                    key: value
-                    for key, value in conf_data["formatters"].items()
-                    if key not in LOCAL_ONLY_FORMATTERS
-                })
-            except Exception:
-                # If parsing fails, continue to parent directory
-                pass
-
-        # Move to parent directory
-        parent = current_dir.parent
-        if parent == current_dir:
-            # We've reached the filesystem root
-            break
-        current_dir = parent
-
-    return formatters
+                stat_result = item.stat()
+                size, mtime = stat_result.st_size, stat_result.st_mtime
+            except OSError:
+                # e.g. a dangling symlink
+                size = mtime = None
+            disk_entries[item.name] = {
+                "name": item.name,
+                "type": item_type,
+                "size": size,
+                "mtime": mtime,
+            }
+
+    if signature is not None and is_settled(signature):
+        LISTING_CACHE.put(key, disk_entries)
+    return disk_entries
+
+
+def directory_etag(requested_path: pathlib.Path, request: Request) -> str | None:
+    """ETag for a directory index page, fingerprinted from what it is rendered
+    from — without rendering it.
+
+    The inputs: the build (``COMMIT``, which covers the built-in templates),
+    the request path, the directory's own stat (its listing), the stat of
+    every cascading index.ini, the ``/include`` fragment, the ``/template``
+    choice and any local ``index.html``, the gallery thumbnail directory, and
+    the query parameters the templates read, and — when fingerprinting — the
+    ``/css`` and ``/icon`` files whose hashes the page links to. Returns None (no validator) if
+    any of those files changed too recently to trust its mtime (see
+    ``cache.is_settled``).
+    """
+    generation = cache.generation()
+    node = FORMATTER_TREE.lookup_node(requested_path)
+    CACHE_POLICIES.update(requested_path, node, generation)
+    try:
+        conf_data = load_index_conf(requested_path / "index.ini")
+    except Exception:
+        conf_data = None
+    local_formatters = conf_data["formatters"] if conf_data else {}
+    merged_formatters = {**node.formatters, **local_formatters}
+
+    signatures = [stat_signature(requested_path)]
+    fragment = None
+    if "include" in merged_formatters:
+        fragment = IncludeFormatter.find(merged_formatters["include"], requested_path)
+        signatures.append(stat_signature(fragment) if fragment else None)
+    if "images" in local_formatters:
+        flags, kwargs = ImagesFormatter.parse_args(local_formatters["images"])
+        if "thumbnails" in flags:
+            thumb_dir = kwargs.get("thumb_dir") or ImagesFormatter.defaults["thumb_dir"]
+            signatures.append(stat_signature(requested_path / thumb_dir))
+    if fingerprint.FINGERPRINT:
+        assets = merged_formatters.get("css", "").split() + merged_formatters.get("icon", "").split()
+        signatures.extend(fingerprint.asset_signatures(assets, requested_path))
+    local_template = stat_signature(requested_path / "index.html")
+    signatures.append(local_template)
+    if not node.settled or not all(map(is_settled, signatures)):
+        return None
+
+    if local_template is None:
+        query = [(name, request.query_params.get(name)) for name in TEMPLATE_QUERY_PARAMS]
+    else:
+        query = request.url.query  # a local template may read anything
+    inputs = (
+        COMMIT,
+        request.scope.get("path", "/"),
+        node.signatures,
+        signatures,
+        str(fragment),
+        local_formatters.get("template", "").strip(),
+        query,
+    )
+    digest = hashlib.md5(repr(inputs).encode(), usedforsecurity=False).hexdigest()
+    return f'"{digest}"'
 
 
 def parse_globs(value: str) -> list:
@@ -147,44 +470,32 @@ def serve_directory(requested_path: pathlib.Path, request: Request, templates: J
     Serve a directory.
     Look for index.ini file for metadata and generate directory listing.
     """
+    template_variables, local_formatters = prepare_directory(requested_path, request)
+    return render_page(requested_path, template_variables, local_formatters, templates)
+
+
+def prepare_directory(requested_path: pathlib.Path, request: Request) -> tuple[dict, dict]:
+    """The template variables for a directory page (listing, formatters
+    applied) and its local formatters — everything but the render."""
 
     template_variables = {
         "files": {}
     }
 
     # Raw directory listing: name -> basic metadata.
-    disk_entries = {}
-    for item in requested_path.iterdir():
-        try:
-            item_type = None
-            if item.is_file():
-                item_type = 'file'
-            elif item.is_dir():
-                item_type = 'directory'
-
-            disk_entries[item.name] = {
-                "name": item.name,
-                "type": item_type
-                # TODO: created, last modified, size...
-            }
-        except PermissionError:
-            # Just skip for now
-            # We should log this eventually
-            continue
+    disk_entries = list_directory(requested_path)
 
     # index.ini for THIS directory: described files + local formatters.
     declared = {}
     local_formatters = {}
-    index_conf_path = requested_path / "index.ini"
-    if index_conf_path.exists():
-        try:
-            conf_data = parse_index_conf(index_conf_path)
-            declared = conf_data["files"]
-            local_formatters = conf_data["formatters"]
-        except Exception:
-            # If parsing fails, fall back to a plain listing.
-            declared = {}
-            local_formatters = {}
+    try:
+        conf_data = load_index_conf(requested_path / "index.ini")
+    except Exception:
+        # If parsing fails, fall back to a plain listing.
+        conf_data = None
+    if conf_data is not None:
+        declared = conf_data["files"]
+        local_formatters = conf_data["formatters"]
 
     # Collect cascading formatters from parent directories (needed now:
     # `ignore` is a cascading listing filter).
@@ -206,11 +517,13 @@ def serve_directory(requested_path: pathlib.Path, request: Request, templates: J
         if name in visible:
             entry = dict(data)
             if name in disk_entries:
-                entry.setdefault("type", disk_entries[name]["type"])
+                for field in ("type", "size", "mtime"):
+                    entry.setdefault(field, disk_entries[name][field])
             files[name] = entry
     for name, data in disk_entries.items():
         if name in visible and name not in files:
-            files[name] = data
+            # Copy: formatters annotate entries, the listing is cached.
+            files[name] = dict(data)
     template_variables["files"] = files
 
     # Apply formatters (local formatters override cascading ones). `all`,
@@ -240,14 +553,27 @@ def serve_directory(requested_path: pathlib.Path, request: Request, templates: J
         template_variables["parent_url"] = path_info.rstrip("/").rsplit("/", 1)[0] + "/"
 
     template_variables["request"] = request
+    return template_variables, local_formatters
+
+
+def page_tag_headers(requested_path: pathlib.Path, fragment: pathlib.Path | None) -> dict:
+    """Cache tags of a directory page, including its ``/include`` fragment."""
+    return cache_tag_headers(requested_path, is_directory=True,
+                             inputs=(fragment,) if fragment is not None else ())
 
+
+def render_page(requested_path: pathlib.Path, template_variables: dict,
+                local_formatters: dict, templates: Jinja2Templates) -> Response:
+    """Render a prepared directory page (see ``prepare_directory``)."""
     # Explicit /template (local-only): select a built-in template by name.
     # It takes precedence over a local index.html file (as in decoupage).
     # Only bare filenames that exist in the built-in templates directory are
     # accepted — /template never loads templates from the content tree.
-    # Directory indexes are dynamic (index.ini edits must show immediately):
-    # allow caches to store but always revalidate.
-    index_headers = {"Cache-Control": "no-cache"}
+    index_headers = {"Cache-Control": index_cache_control(requested_path),
+                     **page_tag_headers(requested_path, template_variables.get("include_path"))}
+    link = preload_header(template_variables)
+    if link:
+        index_headers["Link"] = link
 
     requested_template = local_formatters.get("template", "").strip()
     if requested_template:
@@ -285,3 +611,54 @@ def serve_directory(requested_path: pathlib.Path, request: Request, templates: J
         # TODO: reconcile with the local template path mechanism above
         return templates.TemplateResponse(template_name, template_variables,
                                           headers=index_headers)
+
+
+def page_headers(requested_path: pathlib.Path, etag: str, link: str | None,
+                 fragment: pathlib.Path | None) -> dict:
+    """Headers of a rendered directory page (as ``render_page`` sets them)."""
+    headers = {"Cache-Control": index_cache_control(requested_path), "ETag": etag,
+               **page_tag_headers(requested_path, fragment)}
+    if link:
+        headers["Link"] = link
+    return headers
+
+
+def cached_page_headers(requested_path: pathlib.Path, etag: str) -> dict | None:
+    """Headers of the page ``etag`` names, if its render is in
+    ``RENDER_CACHE``; a 304 for it repeats them without a render."""
+    cached = RENDER_CACHE.get(etag)
+    if cached is None:
+        return None
+    _, link, fragment = cached
+    return page_headers(requested_path, etag, link, fragment)
+
+
+async def render_directory(requested_path: pathlib.Path, request: Request,
+                           templates: Jinja2Templates, etag: str | None) -> Response:
+    """``serve_directory`` through ``RENDER_CACHE``, with 103 Early Hints for
+    the page's preloads sent before a render where the server takes them.
+    Preparing and rendering the page run in the thread pool, once admitted
+    (blocking.py).
+
+    Pages without an ``etag`` (inputs too fresh to fingerprint) are always
+    rendered; so are non-UTF-8 local index.html files, which are served as
+    files rather than rendered.
+    """
+    if etag is not None:
+        cached = RENDER_CACHE.get(etag)
+        if cached is not None:
+            body, link, fragment = cached
+            return Response(content=body, media_type="text/html",
+                            headers=page_headers(requested_path, etag, link, fragment))
+    async with admit_render():  # 503 when too many are running and waiting
+        template_variables, local_formatters = await run_blocking(prepare_directory, requested_path, request)
+        await send_early_hints(request, preload_links(template_variables))
+        response = await run_blocking(render_page, requested_path, template_variables,
+                                      local_formatters, templates)
+    if etag is not None:
+        response.headers["ETag"] = etag
+        if not isinstance(response, FileResponse):
+            RENDER_CACHE.put(etag, (response.body, response.headers.get("link"),
+                                    template_variables.get("include_path")),
+                             size=len(response.body))
+    return response
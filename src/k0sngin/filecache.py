@@ -0,0 +1,327 @@
+"""
+Open-file cache for hot static files (cf. nginx ``open_file_cache``).
+
+Frequently served files are kept open, with their stat results, so a hit
+needs neither ``open()`` nor a path lookup — the body is read from the
+cached descriptor with ``pread`` (no shared file position, so concurrent
+responses can share one descriptor). Optional: ``K0SNGIN_OPEN_FILE_CACHE``
+sets the number of descriptors kept open (default 0, disabled).
+
+Validation on every hit is an ``fstat`` of the descriptor: an in-place edit
+shows up as a new mtime/size, and a deleted or replaced file (the old inode
+unlinked) as ``st_nlink == 0`` — the descriptor is then closed. A file
+renamed away while still linked elsewhere can't be seen by ``fstat``; that
+is caught by watcher invalidation (``cache.on_invalidate``) or, for paths
+the watcher doesn't cover, by re-stat'ing the path at most every
+``K0SNGIN_OPEN_FILE_CACHE_VALID`` seconds. Entries unused for
+``K0SNGIN_OPEN_FILE_CACHE_INACTIVE`` seconds are closed, by a background
+thread that sweeps the cache that often, so a quiet server doesn't keep
+descriptors (and the space of deleted files) held.
+
+Descriptors are reference counted: eviction only drops the cache's
+reference, and the descriptor is closed once the last response reading it
+has finished — it can never be closed (and its number reused) mid-response.
+
+Delivery is zero-copy when the ASGI server offers it: with the
+``http.response.zerocopysend`` extension the server ``sendfile``s straight
+from a descriptor, with ``http.response.pathsend`` it sends a file by path
+(for a cached descriptor, only while the watcher covers the path: else the
+path may name another file by now); otherwise the body is read in chunks. ``K0SNGIN_ZERO_COPY=0`` forces the
+chunked path. An extension is only used if every middleware between the
+server and the response can carry its messages (``FORWARDED_EXTENSIONS``).
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from starlette.responses import Response
+
+from . import cache
+from .blocking import run_blocking
+
+OPEN_FILE_CACHE_SIZE = int(os.environ.get("K0SNGIN_OPEN_FILE_CACHE", "0"))
+OPEN_FILE_CACHE_INACTIVE = float(os.environ.get("K0SNGIN_OPEN_FILE_CACHE_INACTIVE", "60"))
+OPEN_FILE_CACHE_VALID = float(os.environ.get("K0SNGIN_OPEN_FILE_CACHE_VALID", "1"))
+ZERO_COPY = os.environ.get("K0SNGIN_ZERO_COPY", "1").lower() not in {"0", "false", "no", "off"}
+
+# ASGI extensions for handing the body to the server.
+PATHSEND = "http.response.pathsend"
+ZEROCOPYSEND = "http.response.zerocopysend"
+# What the middleware stack (main.py) carries through to the server: every
+# layer is plain ASGI and passes both along (compress.py reads the file
+# itself when it compresses the body).
+FORWARDED_EXTENSIONS = {PATHSEND, ZEROCOPYSEND}
+
+
+def server_supports(scope, extension: str) -> bool:
+    """True if the ASGI server offers ``extension``, the middleware stack can
+    forward it, and zero-copy is on."""
+    return (ZERO_COPY and extension in FORWARDED_EXTENSIONS
+            and extension in (scope.get("extensions") or {}))
+
+
+class Descriptor:
+    """A bare descriptor as the file object ``zerocopysend`` expects; closing
+    it stays with the owner."""
+
+    __slots__ = ("fd",)
+
+    def __init__(self, fd: int):
+        self.fd = fd
+
+    def fileno(self) -> int:
+        return self.fd
+
+
+async def send_zero_copy(send, file, size: int) -> None:
+    """Send ``size`` bytes of ``file`` (from offset 0, which leaves the file
+    position alone) through ``http.response.zerocopysend``. The server has
+    sent the data when ``send`` returns, so the file may be closed then."""
+    await send({
+        "type": ZEROCOPYSEND,
+        "file": file,
+        "offset": 0,
+        "count": size,
+        "more_body": False,
+    })
+
+
+async def send_chunks(send, fd: int, size: int, chunk_size: int) -> None:
+    """Send ``size`` bytes of ``fd`` (from offset 0, with ``pread``) as body
+    messages, reading in the bounded blocking pool (``run_blocking``)."""
+    offset = 0
+    more_body = size > 0
+    while more_body:
+        chunk = await run_blocking(os.pread, fd, min(chunk_size, size - offset), offset)
+        offset += len(chunk)
+        more_body = bool(chunk) and offset < size
+        await send({"type": "http.response.body", "body": chunk, "more_body": more_body})
+    if size == 0:
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+class OpenFile:
+    """A reference-counted open descriptor and its stat result."""
+
+    __slots__ = ("path", "fd", "stat_result", "last_used", "verified", "_refs", "_lock")
+
+    def __init__(self, path: str, fd: int, stat_result: os.stat_result):
+        self.path = path
+        self.fd = fd
+        self.stat_result = stat_result
+        self.last_used = self.verified = time.monotonic()
+        self._refs = 1  # the cache's own reference
+        self._lock = threading.Lock()
+
+    def acquire(self) -> bool:
+        """Take a reference; False if the descriptor is already closed."""
+        with self._lock:
+            if self._refs == 0:
+                return False
+            self._refs += 1
+            return True
+
+    def release(self) -> None:
+        """Drop a reference, closing the descriptor with the last one."""
+        with self._lock:
+            self._refs -= 1
+            close = self._refs == 0
+        if close:
+            os.close(self.fd)
+
+
+class OpenFileCache:
+    """LRU of ``OpenFile`` entries keyed by path."""
+
+    def __init__(self, maxsize: int, inactive: float = 60, valid: float = 1):
+        self.maxsize = maxsize
+        self.inactive = inactive
+        self.valid = valid
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        cache.on_invalidate(self.invalidate)
+
+    @property
+    def enabled(self) -> bool:
+        return self.maxsize > 0
+
+    def acquire(self, path) -> OpenFile | None:
+        """The cached, revalidated entry for ``path`` with a reference taken
+        (the caller must ``release`` it), or None on a miss."""
+        path = os.fspath(path)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None:
+                self._entries.move_to_end(path)
+        if entry is None or not entry.acquire():
+            self.misses += 1
+            return None
+        try:
+            stat_result = os.fstat(entry.fd)
+            if stat_result.st_nlink == 0:
+                raise FileNotFoundError(path)  # deleted or replaced
+            if now - entry.verified > self.valid and not cache.covered(path):
+                path_stat = os.stat(path)
+                if (path_stat.st_ino, path_stat.st_dev) != (stat_result.st_ino, stat_result.st_dev):
+                    raise FileNotFoundError(path)  # the path names another file now
+                entry.verified = now
+        except OSError:
+            entry.release()
+            self._drop(path, entry)
+            self.misses += 1
+            return None
+        entry.stat_result = stat_result
+        entry.last_used = now
+        self.hits += 1
+        return entry
+
+    def open(self, path, stat_result: os.stat_result) -> OpenFile | None:
+        """Open ``path`` (just stat'ed as a regular file) into the cache; the
+        returned entry carries a reference for the caller. None if it can't
+        be opened or is no longer the file that was stat'ed."""
+        path = os.fspath(path)
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+        except OSError:
+            return None
+        opened_stat = os.fstat(fd)
+        if (opened_stat.st_ino, opened_stat.st_dev) != (stat_result.st_ino, stat_result.st_dev):
+            os.close(fd)
+            return None
+        entry = OpenFile(path, fd, opened_stat)
+        entry.acquire()
+        with self._lock:
+            old = self._entries.pop(path, None)
+            self._entries[path] = entry
+            evicted = [old] if old is not None else []
+            while len(self._entries) > self.maxsize:
+                evicted.append(self._entries.popitem(last=False)[1])
+                self.evictions += 1
+        for stale in evicted:
+            stale.release()
+        self.expire()
+        return entry
+
+    def expire(self) -> int:
+        """Close the entries unused for ``inactive`` seconds; how many."""
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            # Inactive entries age out from the LRU end.
+            while self._entries:
+                oldest = next(iter(self._entries.values()))
+                if now - oldest.last_used <= self.inactive:
+                    break
+                expired.append(self._entries.popitem(last=False)[1])
+        for stale in expired:
+            stale.release()
+        return len(expired)
+
+    def start(self) -> None:
+        """Expire inactive entries every ``inactive`` seconds in a background
+        thread, not only when another file is opened."""
+        if not self.enabled or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="k0sngin-open-files",
+                                        daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop.wait(max(self.inactive, 0.01)):
+            self.expire()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def invalidate(self, path, subtree: bool) -> None:
+        """``cache.on_invalidate`` callback: close entries for changed paths."""
+        with self._lock:
+            if path is None:
+                stale = list(self._entries)
+            elif subtree:
+                prefix = path.rstrip(os.sep) + os.sep
+                stale = [key for key in self._entries if key == path or key.startswith(prefix)]
+            else:
+                stale = [path] if path in self._entries else []
+            entries = [self._entries.pop(key) for key in stale]
+        for entry in entries:
+            entry.release()
+
+    def _drop(self, path: str, entry: OpenFile) -> None:
+        with self._lock:
+            if self._entries.get(path) is entry:
+                del self._entries[path]
+            else:
+                return
+        entry.release()
+
+    def stats(self) -> dict:
+        """Counters and occupancy, for sizing the cache."""
+        return {
+            "entries": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+OPEN_FILES = OpenFileCache(OPEN_FILE_CACHE_SIZE, OPEN_FILE_CACHE_INACTIVE, OPEN_FILE_CACHE_VALID)
+cache.CACHES["open_files"] = OPEN_FILES
+
+
+class OpenFileResponse(Response):
+    """Send a file from an ``OpenFile`` entry, releasing it when done.
+
+    Headers (validators, Content-Length) are the caller's; the body is
+    ``stat_result.st_size`` bytes, sent from the cached descriptor with
+    ``zerocopysend``, else by path with ``pathsend`` if the watcher covers
+    the path (so the path still names the descriptor's file), else read
+    with ``pread`` in the blocking pool.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, entry: OpenFile, headers: dict | None = None,
+                 media_type: str | None = None):
+        self.entry = entry
+        self.status_code = 200
+        self.media_type = media_type
+        self.background = None
+        self.init_headers(headers)
+        self.headers.setdefault("content-length", str(entry.stat_result.st_size))
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await send({
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            })
+            if scope["method"].upper() == "HEAD":
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+                return
+            size = self.entry.stat_result.st_size
+            if server_supports(scope, ZEROCOPYSEND):
+                await send_zero_copy(send, Descriptor(self.entry.fd), size)
+                return
+            # By path, the server would open whatever is there now: only
+            # while the watcher vouches that it is still this file.
+            if server_supports(scope, PATHSEND) and cache.covered(self.entry.path):
+                await send({"type": PATHSEND, "path": self.entry.path})
+                return
+            await send_chunks(send, self.entry.fd, size, self.chunk_size)
+        finally:
+            self.entry.release()
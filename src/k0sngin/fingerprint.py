@@ -0,0 +1,98 @@
+"""
+Fingerprinted asset URLs (optional): ``K0SNGIN_FINGERPRINT=1``.
+
+The ``/css`` and ``/icon`` formatters rewrite URLs of files in the served
+tree to carry a hash of the file's contents, ``style.css?v=<hash>``. A
+request whose ``v`` matches the file's current hash names that exact
+content forever, so it is served with ``IMMUTABLE_CACHE_CONTROL``; any
+other request for the file (no ``v``, or a stale one) gets the normal
+policy. A request's ``v`` is only compared with hashes the formatters have
+already computed (``known_hash``): a client can't make the server hash a
+file by asking for it. An edit changes the hash, so pages link to the new URL; the
+directory ETag covers the assets' stats (``directory_etag``), so cached
+pages don't keep linking to the old one.
+
+Hashes are cached in ``ASSET_HASHES``, keyed by the file's stat signature
+(memoized under the watcher). A file modified within the racy window
+(``cache.RACY_WINDOW_NS``) gets no hash yet, and its URL is left as written.
+"""
+
+import os
+import pathlib
+from urllib.parse import urlsplit
+
+from .cache import LRUCache, is_settled, stat_signature
+from .digests import file_digest
+from .links import is_allowed, resolve
+from .path import TOP_LEVEL_DIR
+
+FINGERPRINT = os.environ.get("K0SNGIN_FINGERPRINT", "").lower() in {"1", "true", "yes", "on"}
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+FINGERPRINT_PARAM = "v"
+HASH_LENGTH = 16
+
+ASSET_HASHES = LRUCache(4096, name="asset_hashes")
+
+
+def asset_path(url: str, directory: pathlib.Path) -> pathlib.Path | None:
+    """The served file a page URL points at — absolute from the site root,
+    or relative to the page's directory — or None for anything else (other
+    sites, URLs with a query, paths leaving the tree)."""
+    parts = urlsplit(url)
+    if parts.scheme or parts.netloc or parts.query or parts.fragment or not parts.path:
+        return None
+    if parts.path.startswith("/"):
+        path = TOP_LEVEL_DIR / parts.path.lstrip("/")
+    else:
+        path = directory / parts.path
+    path = pathlib.Path(os.path.normpath(path))
+    try:
+        path.relative_to(TOP_LEVEL_DIR)
+    except ValueError:
+        return None
+    if not is_allowed(resolve(path)):
+        return None
+    return path
+
+
+def asset_hash(path: pathlib.Path) -> str | None:
+    """Content hash of a file for its URL, or None if it is missing, not a
+    regular file, or too recently modified."""
+    signature = stat_signature(path)
+    if signature is None or not is_settled(signature):
+        return None
+    key = (str(path), signature)
+    digest = ASSET_HASHES.get(key)
+    if digest is None:
+        ino, mtime_ns, size = signature
+        digest = file_digest(str(path), (ino, size, mtime_ns))
+        if digest is None:
+            return None
+        digest = digest[:HASH_LENGTH]
+        ASSET_HASHES.put(key, digest)
+    return digest
+
+
+def known_hash(path: pathlib.Path) -> str | None:
+    """``asset_hash`` if a formatter has already computed it for the file as
+    it is now, else None (nothing is read)."""
+    signature = stat_signature(path)
+    if signature is None:
+        return None
+    return ASSET_HASHES.get((str(path), signature))
+
+
+def fingerprint_url(url: str, directory: pathlib.Path) -> str:
+    """``url`` with ``?v=<hash>`` if it names a hashable served file."""
+    path = asset_path(url, directory)
+    digest = asset_hash(path) if path is not None else None
+    if digest is None:
+        return url
+    return f"{url}?{FINGERPRINT_PARAM}={digest}"
+
+
+def asset_signatures(urls, directory: pathlib.Path) -> list:
+    """Stat signatures of the served files among ``urls`` — what the
+    fingerprinted forms of those URLs depend on."""
+    paths = (asset_path(url, directory) for url in urls)
+    return [stat_signature(path) for path in paths if path is not None]
@@ -11,6 +11,7 @@ import re
 
 from fastapi import Request
 
+from . import fingerprint
 from .path import TOP_LEVEL_DIR
 
 
@@ -64,7 +65,11 @@ class BreadcrumbsFormatter(Formatter):
 
 
 class CSSFormatter(Formatter):
-    """Space-separated list of CSS paths to include in the directory index."""
+    """Space-separated list of CSS paths to include in the directory index.
+
+    With ``K0SNGIN_FINGERPRINT``, paths of served files get a content hash
+    (``style.css?v=...``) and are cached as immutable (see fingerprint.py).
+    """
 
     @classmethod
     def key(cls) -> str:
@@ -76,11 +81,14 @@ class CSSFormatter(Formatter):
         value = value.strip()
         if not value:
             return None
-        return {"css": value.split()}
+        css = value.split()
+        if fingerprint.FINGERPRINT:
+            css = [fingerprint.fingerprint_url(url, directory) for url in css]
+        return {"css": css}
 
 
 class IconFormatter(Formatter):
-    """URL for favicon for the directory index."""
+    """URL for favicon for the directory index (fingerprinted like ``/css``)."""
 
     @classmethod
     def key(cls) -> str:
@@ -89,7 +97,10 @@ class IconFormatter(Formatter):
 
     def format(self, value: str, directory: pathlib.Path, request: Request, variables: dict) -> str:
         """Format the directory index."""
-        return {"icon": value.strip()}
+        icon = value.strip()
+        if fingerprint.FINGERPRINT and icon:
+            icon = fingerprint.fingerprint_url(icon, directory)
+        return {"icon": icon}
 
 
 class LinksFormatter(Formatter):
@@ -146,8 +157,10 @@ class IncludeFormatter(Formatter):
         """Key for the formatter."""
         return "include"
 
-    def format(self, value: str, directory: pathlib.Path, request: Request, variables: dict) -> dict:
-        """Format the directory index."""
+    @staticmethod
+    def find(value: str, directory: pathlib.Path) -> pathlib.Path | None:
+        """The fragment file ``value`` names for ``directory`` (walk-up
+        resolution, see above), or None if there isn't a usable one."""
         value = value.strip()
         relative = pathlib.PurePosixPath(value)
         if not value or relative.is_absolute() or '..' in relative.parts:
@@ -163,12 +176,28 @@ class IncludeFormatter(Formatter):
             if candidate.is_file():
                 try:
                     candidate.resolve().relative_to(TOP_LEVEL_DIR)
-                    return {"include_html": candidate.read_text(encoding="utf-8")}
-                except (ValueError, OSError, UnicodeDecodeError):
-                    break  # escapes the tree (symlink) or unreadable
+                    return candidate
+                except (ValueError, OSError):
+                    break  # escapes the tree (symlink)
             if current == TOP_LEVEL_DIR:
                 break
             current = current.parent
+        return None
+
+    def format(self, value: str, directory: pathlib.Path, request: Request, variables: dict) -> dict:
+        """Format the directory index."""
+        value = value.strip()
+        relative = pathlib.PurePosixPath(value)
+        if not value or relative.is_absolute() or '..' in relative.parts:
+            return None
+
+        fragment = self.find(value, directory)
+        if fragment is not None:
+            try:
+                return {"include_html": fragment.read_text(encoding="utf-8"),
+                        "include_path": fragment}  # for the page's cache tags
+            except (OSError, UnicodeDecodeError):
+                pass  # unreadable
 
         message = f"Include not found: {value}"
         print(message)  # TODO: log this; this is a warning
@@ -330,6 +359,78 @@ class TitleFormatter(Formatter):
 
         return result
 
+
+class CacheFormatter(Formatter):
+    """HTTP cache policy for a subtree's pages and files.
+
+    Comma-separated ``directive=seconds`` pairs (the ``/images`` syntax)::
+
+        /cache = max-age=300, s-maxage=86400, stale-while-revalidate=60
+
+    replace the built-in policy for the directory's index page and every
+    file in it with ``Cache-Control: public, max-age=300, s-maxage=86400,
+    stale-while-revalidate=60``. The directives are ``max-age`` (default 0),
+    ``s-maxage``, ``stale-while-revalidate`` and ``stale-if-error``.
+    Cascades; ``/cache = default`` restores the built-in policy below it,
+    and a value with no valid directive changes nothing (the parent's policy
+    still applies).
+
+    The policy is a response header, not a template variable: it is resolved
+    once per index.ini change in the formatter tree (see
+    ``directory.CachePolicies``), and ``format`` adds nothing.
+    """
+
+    directives = ("max-age", "s-maxage", "stale-while-revalidate", "stale-if-error")
+    default_values = {"", "default", "off", "none"}
+    _warned = set()  # (source, message) pairs already printed
+
+    @classmethod
+    def key(cls) -> str:
+        """Key for the formatter."""
+        return "cache"
+
+    @classmethod
+    def cache_control(cls, value: str | None, inherited: str | None = None,
+                      source=None) -> str | None:
+        """The Cache-Control header a ``/cache`` value asks for, or None for
+        the built-in policy; ``inherited`` (the parent's) if it has no valid
+        directive. Unknown directives and bad values are ignored, with a
+        warning printed once per ``source`` (e.g. the index.ini and its
+        mtime)."""
+        if value is None or value.strip().lower() in cls.default_values:
+            return None
+        flags, kwargs = ImagesFormatter.parse_args(value)
+        seconds = {}
+        for name in flags:
+            cls._warn(source, f"/cache: ignoring {name!r} (expected directive=seconds)")
+        for name, val in kwargs.items():
+            if name not in cls.directives:
+                cls._warn(source, f"/cache: unknown directive {name!r}")
+            elif not val.isdigit():
+                cls._warn(source, f"/cache: {name} must be a number of seconds, not {val!r}")
+            else:
+                seconds[name] = int(val)
+        if not seconds:
+            return inherited
+        seconds.setdefault("max-age", 0)
+        return ", ".join(["public"] + [f"{name}={seconds[name]}"
+                                       for name in cls.directives if name in seconds])
+
+    @classmethod
+    def _warn(cls, source, message: str) -> None:
+        if source is not None:
+            if (source, message) in cls._warned:
+                return
+            if len(cls._warned) >= 4096:
+                cls._warned.clear()
+            cls._warned.add((source, message))
+        print(message)  # TODO: log this
+
+    def format(self, value: str, directory: pathlib.Path, request: Request, variables: dict) -> dict:
+        """Format the directory index (nothing to do: see ``cache_control``)."""
+        return None
+
+
 # Canonical application order: `links` must extract alternate-form link
 # segments before `title` splits descriptions on ':'; `images` filters the
 # listing after titles/descriptions are settled.
@@ -341,6 +442,7 @@ all_formatters = [
     IconFormatter,
     BreadcrumbsFormatter,
     IncludeFormatter,
+    CacheFormatter,
 ]
 
 formatters = {formatter.key(): formatter for formatter in all_formatters}
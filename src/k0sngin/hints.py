@@ -0,0 +1,68 @@
+"""
+Preload hints for directory pages: ``Link: <url>; rel=preload`` headers and
+103 Early Hints.
+
+A page's stylesheets (``/css``), favicon (``/icon``) and gallery lead image
+(the first image of ``/images``) are known before the page is rendered, so
+they are announced in a ``Link`` header — Cloudflare turns these into 103
+Early Hints for cold loads — and, when the ASGI server offers the
+``http.response.early_hint`` extension, in a 103 sent by k0sNgin itself
+before the render starts. ``K0SNGIN_PRELOAD=0`` turns both off.
+
+The 103 goes straight to the server: ``EarlyHintsMiddleware`` (outermost)
+leaves the server's ``send`` in the scope. An endpoint has no ``send`` of
+its own, and the layers in between expect a response to begin with
+``http.response.start``.
+"""
+
+import os
+from urllib.parse import quote
+
+PRELOAD = os.environ.get("K0SNGIN_PRELOAD", "1").lower() not in {"0", "false", "no", "off"}
+
+EARLY_HINT = "http.response.early_hint"
+SEND_KEY = "k0sngin.early_hint_send"
+
+# Characters left alone when quoting a URL into a header.
+URL_SAFE = "/:?=&%#;@!$'()*+,~"
+
+
+def preload_links(template_variables: dict) -> list:
+    """``Link`` values for a prepared page's subresources, in page order."""
+    if not PRELOAD:
+        return []
+    links = [f"<{quote(url, safe=URL_SAFE)}>; rel=preload; as=style"
+             for url in template_variables.get("css") or []]
+    icon = template_variables.get("icon")
+    if icon:
+        links.append(f"<{quote(icon, safe=URL_SAFE)}>; rel=preload; as=image")
+    if template_variables.get("images"):
+        for data in template_variables.get("files", {}).values():
+            if data.get("src"):
+                links.append(f"<{quote(data['src'], safe=URL_SAFE)}>; rel=preload; as=image")
+                break
+    return links
+
+
+def preload_header(template_variables: dict) -> str | None:
+    """The ``Link`` header for a prepared page, or None."""
+    return ", ".join(preload_links(template_variables)) or None
+
+
+async def send_early_hints(request, links: list) -> None:
+    """Send a 103 with ``links`` if the server takes Early Hints."""
+    send = request.scope.get(SEND_KEY)
+    if send is not None and links:
+        await send({"type": EARLY_HINT, "links": [link.encode() for link in links]})
+
+
+class EarlyHintsMiddleware:
+    """Make the server's ``send`` reachable for ``send_early_hints``."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if PRELOAD and scope["type"] == "http" and EARLY_HINT in (scope.get("extensions") or {}):
+            scope[SEND_KEY] = send
+        await self.app(scope, receive, send)
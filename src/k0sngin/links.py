@@ -14,12 +14,21 @@ k0sNgin only consumes the *values*: a request may resolve outside
 targets. ``Path.resolve()`` follows every link in a chain, so a nested
 symlink inside an allowed target that points elsewhere resolves outside
 every allowed root and is refused — no separate escape audit is needed.
+
+Both halves of that check are on the request path, so both are cheap:
+``is_allowed`` looks the resolved path's prefixes up in a table of roots
+(constant in the number of roots), and ``resolve`` serves directory prefixes
+from a cache that a running watcher (``watcher.py``) keeps current — without
+a watcher it is exactly ``Path.resolve()``.
 """
 
 import json
 import os
 import pathlib
+import stat
+import threading
 
+from . import cache
 from .path import TOP_LEVEL_DIR
 
 
@@ -58,13 +67,130 @@ def load_link_targets(links_file) -> list:
 ALLOWED_LINK_TARGETS = load_link_targets(os.environ.get("K0SNGIN_LINKS"))
 
 
+def root_table(roots) -> dict:
+    """Allowed roots as ``{depth: {parts, ...}}``, for ``is_allowed``."""
+    table = {}
+    for root in roots:
+        table.setdefault(len(root.parts), set()).add(root.parts)
+    return table
+
+
+ALLOWED_ROOTS = root_table([TOP_LEVEL_DIR, *ALLOWED_LINK_TARGETS])
+
+
 def is_allowed(resolved_path: pathlib.Path) -> bool:
     """True if a fully-resolved path is inside the content tree or inside an
-    allowed link target."""
-    for root in (TOP_LEVEL_DIR, *ALLOWED_LINK_TARGETS):
+    allowed link target.
+
+    Same test as ``resolved_path.relative_to(root)`` for each root (a
+    component-wise prefix match), but one set lookup per distinct root depth
+    rather than one comparison per root.
+    """
+    parts = resolved_path.parts
+    return any(parts[:depth] in roots for depth, roots in ALLOWED_ROOTS.items())
+
+
+class PathResolver:
+    """``Path.resolve()`` for paths under ``root``, with the real paths of
+    directory prefixes cached while a watcher is running.
+
+    A prefix is cached only if the watcher would report every change that
+    could alter its resolution: each component is a watched directory, or a
+    symlink inside one whose target is a watched directory reached in a
+    single hop (no ``..``, no further links). Each entry remembers the real
+    paths it was derived from, and an invalidation of any of them drops it.
+    The final path component is always checked with ``lstat``.
+    """
+
+    def __init__(self, root: pathlib.Path, maxsize: int = 65536):
+        self.root = os.fspath(root)
+        self.maxsize = maxsize
+        self._cache = {}       # lexical directory -> (real path, dependencies)
+        self._dependents = {}  # real path -> lexical directories derived from it
+        self._lock = threading.Lock()
+        cache.on_invalidate(self.invalidate)
+
+    def resolve(self, path: pathlib.Path) -> pathlib.Path:
+        """The real path of ``path`` — identical to ``path.resolve()``."""
+        if not cache.covered(self.root):
+            return path.resolve()
+        parent, name = os.path.split(os.fspath(path))
+        real_parent = self._resolve_directory(parent)
+        if real_parent is None or not name:
+            return path.resolve()
+        candidate = os.path.join(real_parent, name)
+        try:
+            if stat.S_ISLNK(os.lstat(candidate).st_mode):
+                return pathlib.Path(os.path.realpath(candidate))
+        except OSError:
+            pass  # missing: resolves lexically below its real parent
+        return pathlib.Path(candidate)
+
+    def _resolve_directory(self, lexical: str) -> str | None:
+        """Real path of a directory prefix, or None if it isn't cacheable
+        (the caller then falls back to a full resolve)."""
+        entry = self._cache.get(lexical)
+        if entry is not None:
+            return entry[0]
+        if lexical == self.root:
+            return self.root
+        parent, name = os.path.split(lexical)
+        if not name or not (parent == self.root or parent.startswith(self.root + os.sep)):
+            return None
+        generation = cache.generation()
+        real_parent = self._resolve_directory(parent)
+        if real_parent is None:
+            return None
+        candidate = os.path.join(real_parent, name)
         try:
-            resolved_path.relative_to(root)
-            return True
-        except ValueError:
-            continue
-    return False
+            mode = os.lstat(candidate).st_mode
+            if stat.S_ISLNK(mode):
+                target = os.readlink(candidate)
+                real = os.path.realpath(candidate)
+                if ('..' in pathlib.PurePath(target).parts
+                        or os.path.normpath(os.path.join(real_parent, target)) != real):
+                    return None  # more than one hop: not every link is watched
+            elif stat.S_ISDIR(mode):
+                real = candidate
+            else:
+                return None
+        except OSError:
+            return None
+        if not (cache.covered(real_parent) and cache.covered(real)):
+            return None
+        with self._lock:
+            parent_entry = self._cache.get(parent, (None, ()))
+            if (generation != cache.generation()
+                    or (parent != self.root and parent_entry[0] is None)):
+                return real  # an invalidation raced this lookup: don't keep it
+            dependencies = parent_entry[1] + (candidate, real)
+            if len(self._cache) >= self.maxsize:
+                self._cache.clear()
+                self._dependents.clear()
+            self._cache[lexical] = (real, dependencies)
+            for dependency in dependencies:
+                self._dependents.setdefault(dependency, set()).add(lexical)
+        return real
+
+    def invalidate(self, path, subtree: bool) -> None:
+        """``cache.on_invalidate`` callback: drop entries derived from ``path``."""
+        with self._lock:
+            if path is None:
+                self._cache.clear()
+                self._dependents.clear()
+                return
+            stale = set(self._dependents.pop(path, ()))
+            if subtree:
+                prefix = path.rstrip(os.sep) + os.sep
+                for dependency in [d for d in self._dependents if d.startswith(prefix)]:
+                    stale |= self._dependents.pop(dependency)
+            for lexical in stale:
+                self._cache.pop(lexical, None)
+
+
+RESOLVER = PathResolver(TOP_LEVEL_DIR)
+
+
+def resolve(path: pathlib.Path) -> pathlib.Path:
+    """``path.resolve()`` through the process-wide ``RESOLVER``."""
+    return RESOLVER.resolve(path)
@@ -1,17 +1,32 @@
+import contextlib
+import functools
 import hashlib
 import mimetypes
 import os
 import pathlib
+import stat
 import time
-from collections import defaultdict
 from email.utils import formatdate, parsedate_to_datetime
 from fastapi import FastAPI, HTTPException, Request, status
 from fastapi.responses import FileResponse, RedirectResponse
 from fastapi.templating import Jinja2Templates
-from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.datastructures import Headers
 from starlette.responses import Response
-from .directory import serve_directory
-from .links import is_allowed
+from . import cache, fingerprint, purge, watcher
+from .cache import LRUCache, all_stats, is_settled, stat_signature
+from .blocking import render_admission, run_blocking
+from .compress import CompressionMiddleware
+from .digests import CONTENT_ETAG, DIGESTS
+from .directory import CACHE_POLICIES, cached_page_headers, directory_etag, render_directory
+from .filecache import (OPEN_FILES, PATHSEND, ZEROCOPYSEND, OpenFileResponse,
+                        send_chunks, send_zero_copy, server_supports)
+from .hints import EarlyHintsMiddleware
+from .links import is_allowed, resolve
+from .offload import OFFLOAD_HEADER, offload_location
+from .precompressed import (PRECOMPRESSED, applies as precompressed_applies, is_compressible,
+                            known_absent as siblings_known_absent, select as select_precompressed)
+from .purge import cache_tag_headers
+from .ratelimit import RateLimitMiddleware
 from .path import TOP_LEVEL_DIR
 from .version import COMMIT
 
@@ -21,31 +36,102 @@ HERE = pathlib.Path(__file__).parent
 # browsers and the Cloudflare edge; everything else (HTML, text) must
 # revalidate every time (`no-cache`), which the 304 handling below makes
 # cheap. Trade-off: an in-place media edit can stay stale up to this long
-# unless the edge is purged.
+# unless the edge is purged (K0SNGIN_CACHE_TAGS + K0SNGIN_PURGE_URL do that
+# on every change; see purge.py).
 MEDIA_MAX_AGE = int(os.environ.get("K0SNGIN_MEDIA_MAX_AGE", str(24 * 60 * 60)))
 MEDIA_CACHE_TYPES = ("image/", "audio/", "video/", "font/",
                      "text/css", "application/javascript", "text/javascript")
 
 
 def cache_control_for(media_type) -> str:
-    """Cache-Control policy for a response content type."""
+    """Built-in Cache-Control policy for a response content type (a ``/cache``
+    directive overrides it; see ``file_cache_control``)."""
     if media_type and media_type.startswith(MEDIA_CACHE_TYPES):
         return f"public, max-age={MEDIA_MAX_AGE}"
     return "no-cache"
 
 
+def file_cache_control(path: pathlib.Path, media_type) -> str:
+    """Cache-Control for a file: its directory's ``/cache`` policy, if any."""
+    return CACHE_POLICIES.lookup(path.parent) or cache_control_for(media_type)
+
+
 def file_etag(stat_result) -> str:
     """ETag for a file — Starlette's FileResponse formula, reproduced so the
     etags we validate against are the same ones FileResponse has been
     handing out."""
-    etag_base = f"{stat_result.st_mtime}-{stat_result.st_size}"
-    return f'"{hashlib.md5(etag_base.encode(), usedforsecurity=False).hexdigest()}"'
+    return _validators(stat_result.st_mtime, stat_result.st_size)[0]
+
+
+@functools.lru_cache(maxsize=4096)
+def _validators(mtime: float, size: int) -> tuple[str, str]:
+    """(ETag, Last-Modified) for a file's mtime and size — memoized, since a
+    hot file asks for the same pair on every request."""
+    etag_base = f"{mtime}-{size}"
+    etag = f'"{hashlib.md5(etag_base.encode(), usedforsecurity=False).hexdigest()}"'
+    return etag, formatdate(mtime, usegmt=True)
+
+
+# Load the system MIME tables now rather than on the first request.
+mimetypes.init()
 
 
-def client_cache_is_fresh(request: Request, etag: str, mtime: float) -> bool:
+@functools.lru_cache(maxsize=1024)
+def guess_media_type(name: str) -> str | None:
+    """``mimetypes.guess_type`` by file name, memoized."""
+    return mimetypes.guess_type(name)[0]
+
+
+class StatFileResponse(FileResponse):
+    """FileResponse for a file the handler has already stat'ed: Content-Length,
+    Last-Modified and ETag come from that one ``stat_result`` (and the
+    memoized validators), and the body is sent without stat'ing again.
+
+    Whole-file bodies go zero-copy when the server allows (see
+    ``filecache.server_supports``), else are read in the bounded blocking
+    pool (``run_blocking``); HEAD, pathsend and ranges are FileResponse's
+    own (public) ``__call__``."""
+
+    async def __call__(self, scope, receive, send) -> None:
+        if PATHSEND in (scope.get("extensions") or {}) and not server_supports(scope, PATHSEND):
+            scope = {**scope, "extensions": {}}  # K0SNGIN_ZERO_COPY=0: hide it from FileResponse
+        if (scope["method"].upper() == "HEAD" or "range" in Headers(scope=scope)
+                or server_supports(scope, PATHSEND)):
+            await super().__call__(scope, receive, send)
+            return
+        await send({"type": "http.response.start", "status": self.status_code,
+                    "headers": self.raw_headers})
+        file = await run_blocking(open, self.path, "rb")
+        try:
+            if server_supports(scope, ZEROCOPYSEND):
+                await send_zero_copy(send, file, self.stat_result.st_size)
+            else:
+                await send_chunks(send, file.fileno(), self.stat_result.st_size, self.chunk_size)
+        finally:
+            file.close()
+        if self.background is not None:
+            await self.background()
+
+    def set_stat_headers(self, stat_result) -> None:
+        etag, last_modified = _validators(stat_result.st_mtime, stat_result.st_size)
+        self.headers.setdefault("content-length", str(stat_result.st_size))
+        self.headers.setdefault("last-modified", last_modified)
+        self.headers.setdefault("etag", etag)
+
+
+def not_modified_headers(headers: dict) -> dict:
+    """The headers a 304 repeats from the 200 response it stands for."""
+    return {name: value for name, value in headers.items()
+            if name.lower() in ("etag", "cache-control", "last-modified", "vary",
+                                "link", "cache-tag", "surrogate-key")}
+
+
+def client_cache_is_fresh(request: Request, etag: str, mtime: float | None) -> bool:
     """True if the client's conditional headers show it already has the file.
 
     ``If-None-Match`` wins over ``If-Modified-Since`` (RFC 9110 §13.1.3).
+    Pass ``mtime=None`` for responses without a Last-Modified date, which
+    only ``If-None-Match`` can validate.
     """
     if_none_match = request.headers.get("if-none-match")
     if if_none_match:
@@ -53,7 +139,7 @@ def client_cache_is_fresh(request: Request, etag: str, mtime: float) -> bool:
                   for token in if_none_match.split(",")}
         return "*" in tokens or etag in tokens
     if_modified_since = request.headers.get("if-modified-since")
-    if if_modified_since:
+    if if_modified_since and mtime is not None:
         try:
             since = parsedate_to_datetime(if_modified_since)
         except (TypeError, ValueError):
@@ -61,83 +147,278 @@ def client_cache_is_fresh(request: Request, etag: str, mtime: float) -> bool:
         return int(mtime) <= since.timestamp()
     return False
 
+
+# Small files (stylesheets, icons, include fragments, thumbnails) are kept in
+# memory, body and response headers together, so serving one is a dictionary
+# lookup plus the validating stat (none under the watcher). Files up to
+# K0SNGIN_SMALL_FILE_MAX_SIZE bytes qualify, within a total budget of
+# K0SNGIN_SMALL_FILE_CACHE_BYTES (0 disables the cache).
+SMALL_FILE_MAX_SIZE = int(os.environ.get("K0SNGIN_SMALL_FILE_MAX_SIZE", str(64 * 1024)))
+SMALL_FILE_CACHE = LRUCache(
+    maxsize=None,
+    maxbytes=int(os.environ.get("K0SNGIN_SMALL_FILE_CACHE_BYTES", str(16 * 1024 * 1024))),
+    name="small_files",
+)
+
+
+class SmallFile:
+    """A small file's body and its complete 200 response headers."""
+
+    __slots__ = ("signature", "body", "raw_headers", "etag", "mtime", "cache_control",
+                 "not_modified_headers")
+
+    def __init__(self, signature, body: bytes, headers: dict, media_type: str | None):
+        self.signature = signature
+        self.body = body
+        response = Response(body, headers=headers, media_type=media_type)
+        self.raw_headers = response.raw_headers
+        self.etag = headers["ETag"]
+        self.mtime = signature[1] / 1e9
+        self.cache_control = headers["Cache-Control"]
+        self.not_modified_headers = not_modified_headers(headers)
+
+
+class SmallFileResponse(Response):
+    """Send a ``SmallFile`` from memory with its precomputed headers."""
+
+    def __init__(self, entry: SmallFile):
+        self.status_code = 200
+        self.background = None
+        self.body = entry.body
+        self.raw_headers = list(entry.raw_headers)  # middleware may add to them
+
+    async def __call__(self, scope, receive, send) -> None:
+        await send({
+            "type": "http.response.start",
+            "status": self.status_code,
+            "headers": self.raw_headers,
+        })
+        body = b"" if scope["method"].upper() == "HEAD" else self.body
+        await send({"type": "http.response.body", "body": body})
+
+
+def cached_small_file(path: pathlib.Path, requested_path: pathlib.Path,
+                      media_type: str | None) -> SmallFile | None:
+    """The cached entry for ``path`` if it still matches the file on disk
+    and the cache policy for ``requested_path``."""
+    entry = SMALL_FILE_CACHE.get(str(path))
+    if (entry is not None and entry.signature == stat_signature(path)
+            and entry.cache_control == file_cache_control(requested_path, media_type)):
+        return entry
+    return None
+
+
+def load_small_file(path: pathlib.Path, stat_result, headers: dict,
+                    media_type: str | None) -> SmallFile | None:
+    """Read a small regular file into ``SMALL_FILE_CACHE``; None if it can't
+    be cached (too large, too recently modified, or changed while read)."""
+    signature = (stat_result.st_ino, stat_result.st_mtime_ns, stat_result.st_size)
+    if (SMALL_FILE_CACHE.maxbytes == 0 or stat_result.st_size > SMALL_FILE_MAX_SIZE
+            or not stat.S_ISREG(stat_result.st_mode) or not is_settled(signature)):
+        return None
+    generation = cache.generation()
+    try:
+        with open(path, "rb") as f:
+            body = f.read(stat_result.st_size + 1)
+            opened_stat = os.fstat(f.fileno())
+    except OSError:
+        return None
+    if (len(body) != stat_result.st_size or generation != cache.generation()
+            or (opened_stat.st_ino, opened_stat.st_mtime_ns, opened_stat.st_size) != signature):
+        return None
+    entry = SmallFile(signature, body, headers, media_type)
+    SMALL_FILE_CACHE.put(str(path), entry, len(body))
+    return entry
+
+
+def _invalidate_small_files(path, subtree: bool) -> None:
+    if path is None:
+        SMALL_FILE_CACHE.clear()
+        return
+    SMALL_FILE_CACHE.pop(path)
+    if subtree:
+        prefix = path.rstrip(os.sep) + os.sep
+        SMALL_FILE_CACHE.pop_if(lambda key: key.startswith(prefix))
+
+
+cache.on_invalidate(_invalidate_small_files)
+
+
+# Paths recently found missing (scanner probes: /wp-admin, /.env, ...) are
+# answered with a 404 before any normalization, resolve() or stat of their
+# own. An entry records the nearest ancestor that does exist, with its
+# signature: creating the path, or any missing directory on the way, changes
+# that ancestor's mtime and so drops the entry. A hit costs that one stat
+# (none under the watcher). Keyed by the request path; up to
+# K0SNGIN_NEGATIVE_CACHE_SIZE entries (0 disables the cache).
+NEGATIVE_CACHE_SIZE = int(os.environ.get("K0SNGIN_NEGATIVE_CACHE_SIZE", "4096"))
+MISSING_PATHS = LRUCache(maxsize=NEGATIVE_CACHE_SIZE, maxbytes=NEGATIVE_CACHE_SIZE * 512,
+                         name="missing")
+
+
+def known_missing(file_path: str) -> bool:
+    """True if ``file_path`` was missing and nothing has changed since."""
+    entry = MISSING_PATHS.get(file_path)
+    if entry is None:
+        return False
+    ancestor, signature = entry
+    if stat_signature(ancestor) == signature:
+        return True
+    MISSING_PATHS.pop(file_path)
+    return False
+
+
+def remember_missing(file_path: str, requested_path: pathlib.Path, generation: int) -> None:
+    """Record that ``requested_path`` did not exist as of ``generation``."""
+    if NEGATIVE_CACHE_SIZE == 0:
+        return
+    for ancestor in requested_path.parents:
+        signature = stat_signature(ancestor)
+        if signature is not None or ancestor == TOP_LEVEL_DIR:
+            break
+    if signature is None or not is_settled(signature) or generation != cache.generation():
+        return
+    ancestor = str(ancestor)
+    MISSING_PATHS.put(file_path, (ancestor, signature), len(file_path) + len(ancestor))
+
+
 print(f"K0sNgin serving files from: {TOP_LEVEL_DIR}")
 print(f"K0sNgin commit: {COMMIT}")
 
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Process startup/shutdown."""
+    watcher.start()  # K0SNGIN_INOTIFY
+    purge.start(watching=watcher.WATCHER is not None)  # K0SNGIN_PURGE_URL
+    OPEN_FILES.start()  # K0SNGIN_OPEN_FILE_CACHE_INACTIVE
+    if CONTENT_ETAG:
+        started = time.perf_counter()
+        count = DIGESTS.load()  # K0SNGIN_DIGEST_INDEX
+        print(f"K0sNgin digest index: {count} entries loaded in"
+              f" {(time.perf_counter() - started) * 1000:.1f} ms")  # TODO: log this
+    yield
+    purge.stop()
+    OPEN_FILES.stop()
+    watcher.stop()
+    if CONTENT_ETAG:
+        DIGESTS.wait(cancel=True)
+        DIGESTS.save()
+    # Cache counters, for sizing the caches (see cache.all_stats)
+    for name, stats in all_stats().items():
+        print(f"K0sNgin cache {name}: {stats}")  # TODO: log this
+    print(f"K0sNgin render admission: {render_admission().stats()}")  # TODO: log this
+
 # Disable API docs for security
 app = FastAPI(
     docs_url=None,
     redoc_url=None,
     openapi_url=None,
+    lifespan=lifespan,
 )
 
-# Rate limiting middleware
-class RateLimitMiddleware(BaseHTTPMiddleware):
-    def __init__(self, app, requests_per_minute: int = 60):
-        super().__init__(app)
-        self.requests_per_minute = requests_per_minute
-        self.request_counts = defaultdict(list)
-
-    async def dispatch(self, request: Request, call_next):
-        # Get client IP (consider X-Forwarded-For from Cloudflare)
-        client_ip = request.client.host if request.client else "unknown"
-        if "x-forwarded-for" in request.headers:
-            # Cloudflare sets this header
-            client_ip = request.headers["x-forwarded-for"].split(",")[0].strip()
-
-        # Clean old entries (older than 1 minute)
-        current_time = time.time()
-        self.request_counts[client_ip] = [
-            timestamp for timestamp in self.request_counts[client_ip]
-            if current_time - timestamp < 60
-        ]
-
-        # Check rate limit
-        if len(self.request_counts[client_ip]) >= self.requests_per_minute:
-            return Response(
-                content="Rate limit exceeded. Please try again later.",
-                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-                headers={"Retry-After": "60"}
-            )
-
-        # Record this request
-        self.request_counts[client_ip].append(current_time)
-
-        return await call_next(request)
-
-# Security headers middleware
-class SecurityHeadersMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        response = await call_next(request)
-        # Add security headers
-        response.headers["X-Content-Type-Options"] = "nosniff"
-        response.headers["X-Frame-Options"] = "DENY"
-        response.headers["X-XSS-Protection"] = "1; mode=block"
-        response.headers["Referrer-Policy"] = "strict-origin-when-cross-origin"
-        # Identify the build being served (read once at import; see version.py)
-        response.headers["X-K0sNgin-Commit"] = COMMIT
-        # Content Security Policy - adjust based on your needs
-        response.headers["Content-Security-Policy"] = (
-            "default-src 'self'; "
-            "script-src 'self'; "
-            "style-src 'self' 'unsafe-inline'; "
-            "img-src 'self' data: https:; "
-            "font-src 'self' data:; "
-            "connect-src 'self'; "
-            "frame-ancestors 'none';"
-        )
-        return response
+# Security headers, encoded once: appended to every response.
+CONTENT_SECURITY_POLICY = (  # adjust based on your needs
+    "default-src 'self'; "
+    "script-src 'self'; "
+    "style-src 'self' 'unsafe-inline'; "
+    "img-src 'self' data: https:; "
+    "font-src 'self' data:; "
+    "connect-src 'self'; "
+    "frame-ancestors 'none';"
+)
+SECURITY_HEADERS = [
+    (b"x-content-type-options", b"nosniff"),
+    (b"x-frame-options", b"DENY"),
+    (b"x-xss-protection", b"1; mode=block"),
+    (b"referrer-policy", b"strict-origin-when-cross-origin"),
+    # Identify the build being served (read once at import; see version.py)
+    (b"x-k0sngin-commit", COMMIT.encode("latin-1")),
+    (b"content-security-policy", CONTENT_SECURITY_POLICY.encode("latin-1")),
+]
+
+
+class SecurityHeadersMiddleware:
+    """Set ``SECURITY_HEADERS`` on every response (plain ASGI), replacing any
+    the response already has under those names."""
+
+    def __init__(self, app, headers: list = SECURITY_HEADERS):
+        self.app = app
+        self.headers = headers
+        self.names = frozenset(name for name, _ in headers)
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_headers(message) -> None:
+            if message["type"] == "http.response.start":
+                names = self.names
+                message = {**message, "headers": [
+                    *(header for header in message.get("headers", ())
+                      if header[0].lower() not in names),
+                    *self.headers]}
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
+
+# Compress text responses (innermost, so the layers above pass the
+# compressed stream along; see compress.py)
+app.add_middleware(CompressionMiddleware)
 
 # Always enable rate limiting (60 requests per minute per IP by default;
 # K0SNGIN_RATE_LIMIT overrides, e.g. for the test suite)
 app.add_middleware(RateLimitMiddleware,
                    requests_per_minute=int(os.environ.get("K0SNGIN_RATE_LIMIT", "60")))
 app.add_middleware(SecurityHeadersMiddleware)
+# Outermost: 103 Early Hints go straight to the server (see hints.py)
+app.add_middleware(EarlyHintsMiddleware)
 
 # Initialize Jinja2 templates
 templates = Jinja2Templates(directory=HERE / "templates")
 
 
+class DirectoryPage:
+    """``lookup_file``'s answer for a directory index that must be rendered."""
+
+    __slots__ = ("path", "etag")
+
+    def __init__(self, path: pathlib.Path, etag: str | None):
+        self.path = path
+        self.etag = etag
+
+
+def answered_from_memory(file_path: str, request: Request) -> bool:
+    """True if ``lookup_file`` will answer from memory — a known-missing path
+    or a cached small file whose ``/cache`` policy is memoized — with
+    validation the watcher has memoized, so it can run on the event loop (all
+    it touches on disk is the lstat ``resolve`` makes of a watched file).
+
+    Mirrors the conditions under which ``lookup_file`` takes the small-file
+    path: no offload, no range, no fingerprinted URL, and no precompressed
+    sibling that might stand in for the file."""
+    if not cache.covered(TOP_LEVEL_DIR):
+        return False
+    missing = MISSING_PATHS.peek(file_path)
+    if missing is not None:
+        return cache.covered(missing[0])
+    if OFFLOAD_HEADER is not None or "range" in request.headers:
+        return False
+    if fingerprint.FINGERPRINT and fingerprint.FINGERPRINT_PARAM in request.query_params:
+        return False
+    path = os.path.normpath(os.path.join(TOP_LEVEL_DIR, file_path))
+    requested_path = pathlib.Path(path)
+    if (precompressed_applies(guess_media_type(requested_path.name),
+                              request.headers.get("accept-encoding"))
+            and not siblings_known_absent(requested_path)):
+        return False
+    entry = SMALL_FILE_CACHE.peek(path)
+    return (entry is not None and cache.covered(path)
+            and cache.STAT_CACHE.peek(path) == entry.signature
+            and CACHE_POLICIES.memoized(requested_path.parent))
+
+
 @app.api_route("/{file_path:path}", methods=["GET", "HEAD"])
 async def serve_file(file_path: str, request: Request):
     """
@@ -157,6 +438,26 @@ async def serve_file(file_path: str, request: Request):
         HTTPException: 404 if file not found or outside allowed directory
         HTTPException: 403 if permission denied
     """
+    # Filesystem work and renders go to the thread pool (see blocking.py).
+    if answered_from_memory(file_path, request):
+        response = lookup_file(file_path, request)
+    else:
+        response = await run_blocking(lookup_file, file_path, request)
+    if isinstance(response, DirectoryPage):
+        etag = response.etag
+        response = await render_directory(response.path, request, templates, etag)
+        if etag is not None and client_cache_is_fresh(request, etag, None):
+            # Rendered for the headers the 304 repeats: its render wasn't cached.
+            response = Response(status_code=status.HTTP_304_NOT_MODIFIED,
+                                headers=not_modified_headers(response.headers))
+    return response
+
+
+def lookup_file(file_path: str, request: Request) -> Response | DirectoryPage:
+    """The blocking part of ``serve_file``: everything but the render."""
+    if known_missing(file_path):
+        raise HTTPException(status_code=404, detail="File not found")
+
     # The requested path, normalized lexically ("." / ".." collapsed) but with
     # symlinks intact — this is the path we serve, so directory features
     # (index.ini cascade, local templates) see the content tree, not a
@@ -173,42 +474,137 @@ async def serve_file(file_path: str, request: Request):
 
     # ...and its real path (every symlink followed) must land inside the tree
     # or inside an allowed link target (K0SNGIN_LINKS).
-    if not is_allowed(requested_path.resolve()):
+    resolved_path = resolve(requested_path)
+    if not is_allowed(resolved_path):
         raise HTTPException(status_code=404, detail="File not found")
 
-    # Check if the file exists
-    if not requested_path.exists():
-        raise HTTPException(status_code=404, detail="File not found")
+    # A precompressed sibling (name.br, name.gz, ...) stands in for the file
+    # when the client accepts its encoding; it is what gets stat'ed and sent.
+    media_type = guess_media_type(requested_path.name)
+    served_path, encoding = requested_path, None
+    if OFFLOAD_HEADER is None and "range" not in request.headers:
+        sibling = select_precompressed(requested_path, media_type,
+                                       request.headers.get("accept-encoding"))
+        if sibling is not None:
+            served_path, encoding = sibling
+
+    # A fingerprinted URL (K0SNGIN_FINGERPRINT) whose hash matches the file
+    # is cached for good. Only a hash a page has linked to counts: the file
+    # is never hashed on a client's say-so.
+    immutable = False
+    if fingerprint.FINGERPRINT and fingerprint.FINGERPRINT_PARAM in request.query_params:
+        digest = fingerprint.known_hash(requested_path)
+        immutable = digest is not None and request.query_params[fingerprint.FINGERPRINT_PARAM] == digest
+
+    # Small files are answered from memory (ranges go the long way round) —
+    # unless the front proxy sends every body (K0SNGIN_OFFLOAD). Their cached
+    # headers carry the normal cache policy, so immutable requests skip them.
+    use_small_files = OFFLOAD_HEADER is None and "range" not in request.headers and not immutable
+    small = cached_small_file(served_path, requested_path, media_type) if use_small_files else None
+    if small is not None:
+        if client_cache_is_fresh(request, small.etag, small.mtime):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED,
+                            headers=small.not_modified_headers)
+        return SmallFileResponse(small)
+
+    # A hot file may already be open (K0SNGIN_OPEN_FILE_CACHE): its fstat
+    # stands in for the path stat.
+    use_open_files = OPEN_FILES.enabled and OFFLOAD_HEADER is None
+    opened = OPEN_FILES.acquire(served_path) if use_open_files else None
+
+    # One stat answers everything below: existence, directory or file, and
+    # every header of the file response (ETag, Last-Modified, length, 304).
+    if opened is not None:
+        stat_result = opened.stat_result
+    else:
+        generation = cache.generation()
+        try:
+            stat_result = os.stat(served_path)
+        except (FileNotFoundError, NotADirectoryError):
+            if served_path is requested_path:
+                remember_missing(file_path, requested_path, generation)
+            if CONTENT_ETAG:
+                DIGESTS.forget(served_path)
+            raise HTTPException(status_code=404, detail="File not found")
+        except OSError:
+            raise HTTPException(status_code=404, detail="File not found")
 
     # Check if it's a directory - redirect to trailing slash version
-    if requested_path.is_dir():
+    if stat.S_ISDIR(stat_result.st_mode):
         # If the URL doesn't end with a slash, redirect to the version with a slash
         # But don't redirect if we're already at the root with a slash
         if file_path.strip('/') and not file_path.endswith('/'):
             return RedirectResponse(url=f"/{file_path}/", status_code=301)
-        return serve_directory(requested_path, request, templates)
+        # Revalidation costs a few stats, not a render, while the page's
+        # render (and so its Link and cache tag headers) is cached.
+        etag = directory_etag(requested_path, request)
+        if etag and client_cache_is_fresh(request, etag, None):
+            headers = cached_page_headers(requested_path, etag)
+            if headers is not None:
+                return Response(status_code=status.HTTP_304_NOT_MODIFIED,
+                                headers=not_modified_headers(headers))
+        return DirectoryPage(requested_path, etag)
+
+    # Only regular files are served: opening a FIFO or a device would block
+    # a worker thread (StatFileResponse trusts the stat and doesn't re-check).
+    if not stat.S_ISREG(stat_result.st_mode):
+        if opened is not None:
+            opened.release()
+        raise HTTPException(status_code=404, detail="File not found")
+
+    # Validators come from the file actually sent; an encoded representation
+    # gets its own ETag.
+    etag, last_modified = _validators(stat_result.st_mtime, stat_result.st_size)
+    stat_etag = etag
+    if CONTENT_ETAG:  # the content digest, once known (see digests.py)
+        etag = DIGESTS.etag(served_path, stat_result, SMALL_FILE_MAX_SIZE) or etag
+    if encoding is not None:
+        etag = f'{etag[:-1]}-{encoding}"'
+        stat_etag = f'{stat_etag[:-1]}-{encoding}"'
+    headers = {
+        "Content-Disposition": f"inline; filename=\"{requested_path.name}\"",
+        "Cache-Control": (fingerprint.IMMUTABLE_CACHE_CONTROL if immutable
+                          else file_cache_control(requested_path, media_type)),
+        "ETag": etag,
+        "Last-Modified": last_modified,
+        **cache_tag_headers(requested_path),
+    }
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+    if PRECOMPRESSED and is_compressible(media_type):
+        headers["Vary"] = "Accept-Encoding"
 
     # Conditional requests: answer 304 when the client's cache is current.
-    stat_result = requested_path.stat()
-    etag = file_etag(stat_result)
-    media_type = mimetypes.guess_type(requested_path.name)[0]
-    cache_control = cache_control_for(media_type)
-    if client_cache_is_fresh(request, etag, stat_result.st_mtime):
-        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={
-            "etag": etag,
-            "cache-control": cache_control,
-            "last-modified": formatdate(stat_result.st_mtime, usegmt=True),
-        })
+    # A stat ETag sent before the digest was ready still names these bytes
+    # while the stat is unchanged; the 304 moves the client to the digest.
+    if (client_cache_is_fresh(request, etag, stat_result.st_mtime)
+            or etag != stat_etag and client_cache_is_fresh(request, stat_etag, None)):
+        if opened is not None:
+            opened.release()
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED,
+                        headers=not_modified_headers(headers))
 
     # Serve the file with inline disposition
-    file_response = FileResponse(
-        path=str(requested_path),
-        filename=requested_path.name,
+    # The front proxy may send the body (K0SNGIN_OFFLOAD); ranges included.
+    location = offload_location(resolved_path) if OFFLOAD_HEADER else None
+    if location is not None:
+        # The proxy sets the validators for the body it sends.
+        del headers["ETag"], headers["Last-Modified"]
+        headers[OFFLOAD_HEADER] = location
+        return Response(headers=headers, media_type=media_type)
+    if opened is None and use_small_files:
+        small = load_small_file(served_path, stat_result, headers, media_type)
+        if small is not None:
+            return SmallFileResponse(small)
+    if opened is None and use_open_files:
+        opened = OPEN_FILES.open(served_path, stat_result)
+    if opened is not None:
+        if "range" not in request.headers:
+            return OpenFileResponse(opened, headers=headers, media_type=media_type)
+        opened.release()  # ranges: FileResponse implements them
+    return StatFileResponse(
+        path=str(served_path),
         media_type=media_type,
+        stat_result=stat_result,
+        headers=headers,
     )
-
-    # Override the Content-Disposition header to display inline
-    file_response.headers["Content-Disposition"] = f"inline; filename=\"{requested_path.name}\""
-    file_response.headers["Cache-Control"] = cache_control
-
-    return file_response
@@ -0,0 +1,94 @@
+"""
+File-body offload: let the front proxy send the bytes (optional).
+
+With ``K0SNGIN_OFFLOAD`` set to ``X-Accel-Redirect`` (nginx) or
+``X-Sendfile`` (Apache mod_xsendfile, lighttpd), ``serve_file`` still does
+everything up to the body — the path checks, ``links.is_allowed``, the 304
+decision and the Cache-Control / Content-Disposition policy — and then
+answers with an empty response whose offload header tells the proxy which
+file to stream. Ranges and conditional requests on the body are then the
+proxy's job, with its own validators.
+
+``K0SNGIN_OFFLOAD_MAP`` names a JSON file of filesystem prefix -> proxy
+location pairs; a file's real path (every symlink followed) is translated by
+its longest matching prefix. For nginx the locations are ``internal``
+locations, e.g. ``{"/srv/site": "/_k0sngin/site"}`` with::
+
+    location /_k0sngin/site/ { internal; alias /srv/site/; }
+
+X-Sendfile takes filesystem paths, so it needs no map (identity by default).
+Files under no mapped prefix are served by k0sNgin itself.
+"""
+
+import json
+import os
+import pathlib
+from urllib.parse import quote
+
+OFFLOAD_HEADERS = {
+    "x-accel-redirect": "X-Accel-Redirect",
+    "x-sendfile": "X-Sendfile",
+}
+
+
+def load_offload(header, map_file) -> tuple[str | None, list]:
+    """(offload header name, ``[(prefix, location), ...]`` longest prefix
+    first) from the settings; (None, []) if offload is off.
+
+    Like ``K0SNGIN_LINKS``, a bad setting disables the feature with a
+    warning rather than taking the site down.
+    """
+    if not header:
+        return None, []
+    name = OFFLOAD_HEADERS.get(header.strip().lower())
+    if name is None:
+        print(f"K0SNGIN_OFFLOAD: unknown header {header!r}"
+              f" (use one of {', '.join(OFFLOAD_HEADERS.values())});"
+              " serving file bodies directly")  # TODO: log this
+        return None, []
+    if not map_file:
+        if name == "X-Sendfile":
+            return name, [("/", "/")]
+        print("K0SNGIN_OFFLOAD: X-Accel-Redirect needs K0SNGIN_OFFLOAD_MAP;"
+              " serving file bodies directly")  # TODO: log this
+        return None, []
+    try:
+        with open(map_file) as f:
+            mapping = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"K0SNGIN_OFFLOAD_MAP: cannot read {map_file}: {e};"
+              " serving file bodies directly")  # TODO: log this
+        return None, []
+    if not isinstance(mapping, dict) or not all(
+            isinstance(value, str) for value in mapping.values()):
+        print(f"K0SNGIN_OFFLOAD_MAP: {map_file} must be a JSON object of"
+              " string key-value pairs; serving file bodies directly")  # TODO: log this
+        return None, []
+    prefixes = []
+    for prefix, location in mapping.items():
+        prefix = pathlib.Path(os.path.expanduser(prefix))
+        if not prefix.is_absolute():
+            print(f"K0SNGIN_OFFLOAD_MAP: prefix {str(prefix)!r} is not absolute;"
+                  " serving file bodies directly")  # TODO: log this
+            return None, []
+        prefixes.append((str(prefix.resolve()).rstrip("/") + "/", location.rstrip("/") + "/"))
+    prefixes.sort(key=lambda pair: len(pair[0]), reverse=True)
+    return name, prefixes
+
+
+OFFLOAD_HEADER, OFFLOAD_MAP = load_offload(os.environ.get("K0SNGIN_OFFLOAD"),
+                                           os.environ.get("K0SNGIN_OFFLOAD_MAP"))
+
+
+def offload_location(resolved_path: pathlib.Path) -> str | None:
+    """The offload header value for a file's real path, or None if it is
+    under no mapped prefix (or offload is off)."""
+    if OFFLOAD_HEADER is None:
+        return None
+    path = str(resolved_path)
+    for prefix, location in OFFLOAD_MAP:
+        if path.startswith(prefix):
+            target = location + path[len(prefix):]
+            # nginx takes a URI (and unescapes it); X-Sendfile a plain path.
+            return quote(target) if OFFLOAD_HEADER == "X-Accel-Redirect" else target
+    return None
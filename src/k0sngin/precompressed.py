@@ -0,0 +1,140 @@
+"""
+Precompressed siblings: ``name.br`` / ``name.zst`` / ``name.gz`` served in
+place of ``name`` to clients that accept the encoding (cf. nginx
+``gzip_static``).
+
+Only compressible content types are considered (``COMPRESSIBLE_TYPES``), so
+images and media cost no extra lookups. A sibling is used only if it is at
+least as new as the file itself — a stale one is ignored, never served — and
+if its own real path passes ``links.is_allowed``. The sibling's stat supplies
+the validators, and its ETag is tagged with the encoding, so each
+representation revalidates on its own.
+
+A file found without any sibling is remembered (``NO_SIBLINGS``, at most
+``K0SNGIN_PRECOMPRESSED_CACHE_SIZE`` files) under its directory's stat
+signature, as missing paths are: creating a sibling changes the directory,
+so a repeat request costs one stat of the directory instead of three of the
+siblings — none while the watcher covers it.
+
+Siblings are generated offline by the ``precompress`` CLI
+(``scripts/precompress.py``). ``K0SNGIN_PRECOMPRESSED=0`` turns the lookup
+off.
+"""
+
+import functools
+import os
+import pathlib
+
+from . import cache
+from .cache import LRUCache, is_settled, stat_signature
+from .links import is_allowed, resolve
+
+PRECOMPRESSED = os.environ.get("K0SNGIN_PRECOMPRESSED", "1").lower() not in {"0", "false", "no", "off"}
+PRECOMPRESSED_CACHE_SIZE = int(os.environ.get("K0SNGIN_PRECOMPRESSED_CACHE_SIZE", "65536"))
+
+# (Content-Encoding, file suffix), in order of preference on equal q-values.
+ENCODINGS = (("br", ".br"), ("zstd", ".zst"), ("gzip", ".gz"))
+SUFFIXES = tuple(suffix for _, suffix in ENCODINGS)
+
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json",
+                      "application/xml", "application/xhtml+xml",
+                      "application/wasm", "image/svg+xml")
+
+
+def is_compressible(media_type: str | None) -> bool:
+    """True for content types worth (pre)compressing."""
+    return bool(media_type) and media_type.startswith(COMPRESSIBLE_TYPES)
+
+
+@functools.lru_cache(maxsize=256)
+def accepted_encodings(accept_encoding: str) -> tuple[str, ...]:
+    """Our encodings an ``Accept-Encoding`` value allows, best first: by
+    q-value, then in ``ENCODINGS`` order. ``q=0`` refuses an encoding; ``*``
+    stands for any encoding not listed."""
+    qualities = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qualities[coding] = q
+    wildcard = qualities.get("*", 0.0)
+    ranked = [(-qualities.get(encoding, wildcard), index, encoding)
+              for index, (encoding, _) in enumerate(ENCODINGS)]
+    return tuple(encoding for q, _, encoding in sorted(ranked) if q < 0)
+
+
+# File path -> (directory, its signature) for files without any sibling.
+NO_SIBLINGS = LRUCache(PRECOMPRESSED_CACHE_SIZE, name="no_siblings")
+
+
+def applies(media_type: str | None, accept_encoding: str | None) -> bool:
+    """True if ``select`` would look for a sibling at all."""
+    return (PRECOMPRESSED and bool(accept_encoding) and is_compressible(media_type)
+            and bool(accepted_encodings(accept_encoding)))
+
+
+def known_absent(path: pathlib.Path) -> bool:
+    """True if ``path`` is remembered to have no sibling, validated from
+    memory alone (the watcher's memoized stat of its directory)."""
+    entry = NO_SIBLINGS.peek(str(path))
+    return (entry is not None and cache.covered(entry[0])
+            and cache.STAT_CACHE.peek(entry[0]) == entry[1])
+
+
+def _absent(path: pathlib.Path) -> bool:
+    entry = NO_SIBLINGS.get(str(path))
+    if entry is None:
+        return False
+    if stat_signature(entry[0]) == entry[1]:
+        return True
+    NO_SIBLINGS.pop(str(path))
+    return False
+
+
+def _remember_absent(path: pathlib.Path, generation: int) -> None:
+    directory = str(path.parent)
+    signature = stat_signature(directory)
+    if signature is None or not is_settled(signature) or generation != cache.generation():
+        return
+    if any(stat_signature(path.with_name(path.name + suffix)) is not None for suffix in SUFFIXES):
+        return
+    NO_SIBLINGS.put(str(path), (directory, signature))
+
+
+def select(path: pathlib.Path, media_type: str | None,
+           accept_encoding: str | None) -> tuple[pathlib.Path, str] | None:
+    """``(sibling path, Content-Encoding)`` to serve for ``path``, or None
+    to serve the file itself."""
+    if not applies(media_type, accept_encoding) or _absent(path):
+        return None
+    generation = cache.generation()
+    original = None
+    suffixes = dict(ENCODINGS)
+    found = False
+    for encoding in accepted_encodings(accept_encoding):
+        sibling = path.with_name(path.name + suffixes[encoding])
+        signature = stat_signature(sibling)
+        if signature is None:
+            continue
+        found = True
+        if original is None:
+            original = stat_signature(path)
+            if original is None:
+                return None
+        if signature[1] < original[1]:
+            continue  # stale: the file was edited after compressing
+        if not is_allowed(resolve(sibling)):
+            continue
+        return sibling, encoding
+    if not found:
+        _remember_absent(path, generation)
+    return None
@@ -0,0 +1,402 @@
+"""
+Cache tags and targeted edge purging (optional).
+
+With ``K0SNGIN_CACHE_TAGS=1`` every file and directory page response names
+what it was served from, as ``Cache-Tag`` (Cloudflare, comma-separated) and
+``Surrogate-Key`` (Fastly and others, space-separated) headers:
+
+- a file carries ``f:/dir/name``;
+- a directory page carries ``d:/dir/``, a subtree tag ``t:/``, ``t:/dir/``,
+  ... for itself and each directory above it, and the ``f:`` tag of its
+  ``/include`` fragment.
+
+Tags are URL paths of the served tree (percent-encoded, so they never
+contain separators). A path too long for a tag is replaced by a hash of it.
+
+With ``K0SNGIN_PURGE_URL`` set as well, changes under ``TOP_LEVEL_DIR`` are
+turned back into those tags and posted to that URL as
+``{"tags": [...]}`` (the Cloudflare purge-by-tag body), with
+``Authorization: Bearer $K0SNGIN_PURGE_TOKEN`` if that is set. Changes come
+from the watcher when it runs (``K0SNGIN_INOTIFY``). Otherwise a background
+scan compares mtimes every ``K0SNGIN_PURGE_SCAN_INTERVAL`` seconds (default
+60); each scan walks and stats the whole tree and keeps a snapshot of it in
+memory. If the watcher loses events (its queue overflowed), every page is
+purged once (``t:/``) and the scan takes over. Tags are collected for ``K0SNGIN_PURGE_DELAY`` seconds (default 2) and
+sent ``K0SNGIN_PURGE_BATCH`` at a time (default 30); a failed batch is
+retried later.
+
+An edit then purges the edited file and its directory's page, and so every
+page that includes it. An edit to an ``index.ini`` cascades to every page
+below it (``t:``). Content reached through ``K0SNGIN_LINKS`` symlinks is not
+tracked: its changes happen outside ``TOP_LEVEL_DIR``.
+
+Every worker process serves the tags, but only one tracks changes and
+purges: the one holding an ``flock`` on ``K0SNGIN_PURGE_LOCK`` (by default a
+file in the temporary directory named after ``TOP_LEVEL_DIR``). The others
+try to take over every ``K0SNGIN_PURGE_SCAN_INTERVAL`` seconds; changes made
+while no process held the lock are not purged.
+"""
+
+import hashlib
+import http.client
+import json
+import os
+import pathlib
+import tempfile
+import threading
+import urllib.request
+from urllib.parse import quote
+
+try:
+    import fcntl
+except ImportError:  # not POSIX: every process purges
+    fcntl = None
+
+from . import cache
+from .path import TOP_LEVEL_DIR
+from .precompressed import SUFFIXES
+
+CACHE_TAGS = os.environ.get("K0SNGIN_CACHE_TAGS", "").lower() in {"1", "true", "yes", "on"}
+PURGE_URL = os.environ.get("K0SNGIN_PURGE_URL")
+PURGE_TOKEN = os.environ.get("K0SNGIN_PURGE_TOKEN")
+PURGE_BATCH = int(os.environ.get("K0SNGIN_PURGE_BATCH", "30"))
+PURGE_DELAY = float(os.environ.get("K0SNGIN_PURGE_DELAY", "2"))
+PURGE_SCAN_INTERVAL = float(os.environ.get("K0SNGIN_PURGE_SCAN_INTERVAL", "60"))
+PURGE_LOCK = os.environ.get("K0SNGIN_PURGE_LOCK") or os.path.join(
+    tempfile.gettempdir(),
+    f"k0sngin-purge-{hashlib.sha256(str(TOP_LEVEL_DIR).encode()).hexdigest()[:16]}.lock")
+PURGE_TIMEOUT = 10
+MAX_RETRY_DELAY = 300
+
+# Cloudflare's limit on the length of one tag.
+MAX_TAG_LENGTH = 1024
+
+
+def _tag(kind: str, url: str) -> str:
+    tag = f"{kind}:{quote(url, safe='/')}"
+    if len(tag) > MAX_TAG_LENGTH:
+        tag = f"{kind}#{hashlib.sha256(url.encode()).hexdigest()}"
+    return tag
+
+
+def url_path(path: pathlib.Path, root: pathlib.Path = TOP_LEVEL_DIR) -> str | None:
+    """The URL path of a path in the served tree, or None if outside it."""
+    try:
+        relative = pathlib.PurePath(path).relative_to(root)
+    except ValueError:
+        return None
+    return "/" + relative.as_posix() if relative.parts else "/"
+
+
+def file_tags(url: str) -> list:
+    """Tags of a file response."""
+    return [_tag("f", url)]
+
+
+def directory_tags(url: str) -> list:
+    """Tags of a directory page: the page, and the subtree of it and of every
+    directory above it."""
+    url = url.rstrip("/") + "/"
+    tags = [_tag("d", url), _tag("t", "/")]
+    ancestor = "/"
+    for part in filter(None, url.split("/")):
+        ancestor += part + "/"
+        tags.append(_tag("t", ancestor))
+    return tags
+
+
+def subtree_tags(url: str) -> list:
+    """The tag of every page at or below the directory ``url``."""
+    return [_tag("t", url.rstrip("/") + "/")]
+
+
+def cache_tag_headers(path: pathlib.Path, is_directory: bool = False, inputs=()) -> dict:
+    """``Cache-Tag`` and ``Surrogate-Key`` for the response for ``path`` (a
+    lexical path in the served tree), also tagged with the files ``inputs``
+    it includes; empty unless ``K0SNGIN_CACHE_TAGS``."""
+    if not CACHE_TAGS:
+        return {}
+    url = url_path(path)
+    if url is None:
+        return {}
+    tags = directory_tags(url) if is_directory else file_tags(url)
+    for input_path in inputs:
+        input_url = url_path(input_path)
+        if input_url is not None:
+            tags += file_tags(input_url)
+    return {"Cache-Tag": ",".join(tags), "Surrogate-Key": " ".join(tags)}
+
+
+class PurgeQueue:
+    """Changed tags waiting to be posted to a purge endpoint, in batches."""
+
+    def __init__(self, url: str, token: str | None = None, batch: int = 30,
+                 delay: float = 2, timeout: float = PURGE_TIMEOUT):
+        self.url = url
+        self.token = token
+        self.batch = batch
+        self.delay = delay
+        self.timeout = timeout
+        self.requests = 0
+        self.purged = 0
+        self.failures = 0
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._timer = None
+        self._retries = 0
+
+    def add(self, tags) -> None:
+        """Queue ``tags``; they are sent within ``delay`` seconds."""
+        with self._lock:
+            self._pending.update(tags)
+            if self._timer is None and self._pending:
+                self._schedule(self.delay)
+
+    def _schedule(self, delay: float) -> None:
+        self._timer = threading.Timer(delay, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def flush(self) -> bool:
+        """Send everything queued now; False if a batch failed (it stays
+        queued and is retried with backoff)."""
+        with self._flush_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                tags = sorted(self._pending)
+                self._pending.clear()
+            for start in range(0, len(tags), self.batch):
+                batch = tags[start:start + self.batch]
+                try:
+                    self._post(batch)
+                except (OSError, ValueError, http.client.HTTPException) as e:
+                    print(f"K0SNGIN_PURGE_URL: purge failed: {e}")  # TODO: log this
+                    self.failures += 1
+                    with self._lock:
+                        self._pending.update(tags[start:])
+                        self._retries += 1
+                        if self._timer is None:
+                            self._schedule(min(self.delay * 2 ** self._retries, MAX_RETRY_DELAY))
+                    return False
+                self.purged += len(batch)
+            self._retries = 0
+            return True
+
+    def _post(self, tags: list) -> None:
+        headers = {"Content-Type": "application/json"}
+        if self.token:
+            headers["Authorization"] = f"Bearer {self.token}"
+        request = urllib.request.Request(self.url, data=json.dumps({"tags": tags}).encode(),
+                                         headers=headers, method="POST")
+        self.requests += 1
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+    def stop(self) -> None:
+        """Send what is left (at shutdown)."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if self._pending:
+            self.flush()
+        with self._lock:
+            if self._timer is not None:  # don't retry after shutdown
+                self._timer.cancel()
+                self._timer = None
+
+    def stats(self) -> dict:
+        """Counters and occupancy."""
+        return {
+            "pending": len(self._pending),
+            "requests": self.requests,
+            "purged": self.purged,
+            "failures": self.failures,
+        }
+
+
+class ChangeTracker:
+    """Turn changes under ``root`` into purge tags for ``queue``: fed by
+    ``cache.invalidate`` under the watcher, or by ``scan``. With a
+    ``lock_path``, only while this process holds the lock on it."""
+
+    def __init__(self, queue: PurgeQueue, root: pathlib.Path = TOP_LEVEL_DIR,
+                 interval: float = PURGE_SCAN_INTERVAL, lock_path: str | None = None):
+        self.queue = queue
+        self.root = root
+        self.interval = interval
+        self.lock_path = lock_path
+        self.leader = lock_path is None or fcntl is None
+        self.watching = False
+        self._lock_file = None
+        self._snapshot = None  # path -> (st_ino, st_mtime_ns, st_size, is_dir)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def tags(self, path, is_directory: bool) -> list:
+        """Tags of the responses a change to ``path`` makes stale."""
+        url = url_path(path, self.root)
+        if url is None:
+            return []
+        if is_directory:  # its entries changed
+            return [_tag("d", url.rstrip("/") + "/")]
+        directory, name = url.rsplit("/", 1)
+        tags = file_tags(url) + [_tag("d", directory + "/")]  # the listing shows it
+        if name == "index.ini":  # cascades to the whole subtree
+            tags += subtree_tags(directory)
+        if url.endswith(SUFFIXES):  # a precompressed sibling stands in for its file
+            tags += file_tags(url.rsplit(".", 1)[0])
+        return tags
+
+    def lead(self) -> bool:
+        """Take the purge lock, unless another process holds it; True if
+        this tracker is (now) the one purging."""
+        if self.leader:
+            return True
+        try:
+            lock_file = open(self.lock_path, "a")
+        except OSError as e:
+            print(f"K0SNGIN_PURGE_LOCK: cannot open {self.lock_path}: {e};"
+                  " purging from this process")  # TODO: log this
+            self.leader = True
+            return True
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        self.leader = True
+        return True
+
+    def changed(self, path, subtree: bool) -> None:
+        """``cache.on_invalidate`` callback."""
+        if path is None:
+            self.lost()
+            return
+        if not self.leader:
+            return
+        tags = self.tags(path, subtree or os.path.isdir(path))
+        if tags:
+            self.queue.add(tags)
+
+    def lost(self) -> None:
+        """The watcher lost changes and stopped vouching (``cache.invalidate_all``):
+        purge every page once and scan from now on."""
+        if not self.watching:
+            return
+        self.watching = False
+        if self.leader:
+            print("K0SNGIN_PURGE_URL: the watcher lost file changes; purging every"
+                  f" page and scanning every {self.interval:g}s from now on;"
+                  " file responses may stay stale until they expire")  # TODO: log this
+            self.queue.add(subtree_tags("/"))
+        if self._thread is None:  # a follower's thread scans once it leads
+            self._start(baseline=True)
+
+    def scan(self) -> int:
+        """Compare the tree's stats with the last scan and queue the tags of
+        what changed; returns the number of changed paths. The first scan
+        only takes the snapshot."""
+        snapshot = {}
+        for directory, dirnames, filenames in os.walk(self.root):
+            for name in dirnames + filenames:
+                path = os.path.join(directory, name)
+                try:
+                    st = os.stat(path, follow_symlinks=False)
+                except OSError:
+                    continue
+                snapshot[path] = (st.st_ino, st.st_mtime_ns, st.st_size, name in dirnames)
+        previous, self._snapshot = self._snapshot, snapshot
+        if previous is None:
+            return 0
+        changed = 0
+        for path in previous.keys() | snapshot.keys():
+            before, after = previous.get(path), snapshot.get(path)
+            if before != after:
+                changed += 1
+                is_directory = (after or before)[3]
+                self.queue.add(self.tags(path, is_directory))
+        return changed
+
+    def start(self, watching: bool = False) -> None:
+        """Track changes: from the watcher if ``watching``, else by scanning
+        every ``interval`` seconds in a background thread, which also tries
+        to take the lock while another process holds it."""
+        self.watching = watching
+        if self.lead() and not watching:
+            self.scan()
+        if watching and self.leader:
+            return
+        self._start()
+
+    def _start(self, baseline: bool = False) -> None:
+        self._thread = threading.Thread(target=self._run, args=(baseline,),
+                                        name="k0sngin-purge-scan", daemon=True)
+        self._thread.start()
+
+    def _run(self, baseline: bool = False) -> None:
+        if baseline:
+            try:
+                self.scan()
+            except OSError as e:
+                print(f"K0SNGIN_PURGE_URL: scan failed: {e}")  # TODO: log this
+        while not self._stop.wait(self.interval):
+            try:
+                if not self.leader:
+                    if self.lead() and not self.watching:
+                        self.scan()  # the baseline
+                elif not self.watching:
+                    self.scan()
+            except OSError as e:
+                print(f"K0SNGIN_PURGE_URL: scan failed: {e}")  # TODO: log this
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._lock_file is not None:
+            self._lock_file.close()  # releases the lock
+            self._lock_file = None
+            self.leader = False
+
+
+QUEUE = None
+TRACKER = None
+
+
+def _on_invalidate(path, subtree: bool) -> None:
+    tracker = TRACKER
+    if tracker is not None and tracker.watching:
+        tracker.changed(path, subtree)
+
+
+cache.on_invalidate(_on_invalidate)
+
+
+def start(watching: bool) -> None:
+    """Start purging if ``K0SNGIN_PURGE_URL`` is set: from the watcher's
+    changes if ``watching``, else from periodic scans; in one process at a
+    time (``K0SNGIN_PURGE_LOCK``)."""
+    global QUEUE, TRACKER
+    if not PURGE_URL or TRACKER is not None:
+        return
+    QUEUE = PurgeQueue(PURGE_URL, PURGE_TOKEN, PURGE_BATCH, PURGE_DELAY)
+    cache.CACHES["purge"] = QUEUE
+    tracker = ChangeTracker(QUEUE, TOP_LEVEL_DIR, PURGE_SCAN_INTERVAL, PURGE_LOCK)
+    tracker.start(watching)
+    TRACKER = tracker
+
+
+def stop() -> None:
+    """Stop tracking and send the queued purges."""
+    global TRACKER
+    if TRACKER is not None:
+        TRACKER.stop()
+        TRACKER = None
+    if QUEUE is not None:
+        QUEUE.stop()
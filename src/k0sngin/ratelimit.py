@@ -0,0 +1,308 @@
+"""
+Per-client rate limiting in constant memory.
+
+Each client gets a sliding window counter: the number of requests in the
+current fixed window and in the one before it. The previous window's count
+is weighted by how much of it still overlaps the sliding window. That is
+three numbers per client and O(1) work per request, however high the
+limit.
+
+At most ``K0SNGIN_RATE_LIMIT_KEYS`` clients (default 65536) are tracked.
+The least recently seen client is dropped first. Idle clients, whose
+counts have expired anyway, are dropped as new ones arrive.
+
+With ``K0SNGIN_RATE_LIMIT_AGGREGATE=1``, clients are counted per IPv4 /24
+and IPv6 /64 network rather than per address. Addresses rotated within one
+allocation then share a budget.
+
+Each worker process counts on its own, so ``--workers 4`` would allow four
+times the limit. ``K0SNGIN_RATE_LIMIT_SHARED`` names a file (best on a
+tmpfs, e.g. ``/dev/shm/k0sngin-ratelimit``) that every worker maps: the
+counts then live in a fixed-size table there, ``SLOT.size`` (32) bytes per
+tracked client, under per-bucket ``fcntl`` locks. No other service is
+involved. Within a bucket of 8 slots, the least recently seen client is
+dropped first. The file name gets the table's layout appended (e.g.
+``/dev/shm/k0sngin-ratelimit.65536x60``), so workers running with other
+settings keep to a table of their own.
+"""
+
+import functools
+import hashlib
+import ipaddress
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:  # not POSIX: no shared limiter
+    fcntl = None
+
+from fastapi import status
+from starlette.responses import Response
+
+RATE_LIMIT_KEYS = int(os.environ.get("K0SNGIN_RATE_LIMIT_KEYS", "65536"))
+RATE_LIMIT_AGGREGATE = os.environ.get("K0SNGIN_RATE_LIMIT_AGGREGATE", "").lower() in {"1", "true", "yes", "on"}
+RATE_LIMIT_SHARED = os.environ.get("K0SNGIN_RATE_LIMIT_SHARED", "")
+IPV4_PREFIX = 24
+IPV6_PREFIX = 64
+WINDOW = 60.0
+
+# The shared table's layout (see SharedWindowLimiter)
+SHARED_MAGIC = b"k0srl\x00\x00\x01"
+HEADER = struct.Struct("<8sIId")         # magic, buckets, slots per bucket, window
+SLOT = struct.Struct("<QddII")           # key hash, start, last seen, previous, current
+BUCKET_SLOTS = 8
+
+
+@functools.lru_cache(maxsize=4096)
+def network_key(host: str) -> str:
+    """The /24 (IPv4) or /64 (IPv6) network of an address; anything that
+    isn't an address is its own key."""
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return host
+    prefix = IPV4_PREFIX if address.version == 4 else IPV6_PREFIX
+    return str(ipaddress.ip_network(f"{address}/{prefix}", strict=False))
+
+
+class Window:
+    """One client's counts: the current window's start, and the requests
+    in it and in the previous window."""
+
+    __slots__ = ("start", "previous", "current")
+
+    def __init__(self, start: float):
+        self.start = start
+        self.previous = 0
+        self.current = 0
+
+
+class SlidingWindowLimiter:
+    """At most ``limit`` requests per ``window`` seconds per key, for up to
+    ``max_keys`` keys."""
+
+    def __init__(self, limit: int, window: float = WINDOW, max_keys: int = 65536):
+        self.limit = limit
+        self.window = window
+        self.max_keys = max_keys
+        self.limited = 0
+        self.evictions = 0
+        self._windows = OrderedDict()  # key -> Window, least recently seen first
+
+    def _advance(self, entry: Window, now: float) -> None:
+        elapsed = now - entry.start
+        if not 0 <= elapsed < 2 * self.window:  # idle (or the clock went back)
+            entry.start = now - elapsed % self.window
+            entry.previous = entry.current = 0
+        elif elapsed >= self.window:
+            entry.start += self.window
+            entry.previous, entry.current = entry.current, 0
+
+    def _weight(self, entry: Window, now: float) -> float:
+        """The share of the previous window still inside the sliding one."""
+        return 1 - (now - entry.start) / self.window
+
+    def hit(self, key: str, now: float | None = None) -> float | None:
+        """Count a request for ``key``: None if it is allowed, else the number
+        of seconds until one would be."""
+        if now is None:
+            now = time.monotonic()
+        entry = self._windows.get(key)
+        if entry is None:
+            entry = self._windows[key] = Window(now)
+            self._evict(now)
+        else:
+            self._windows.move_to_end(key)
+            self._advance(entry, now)
+        return self._count(entry, now)
+
+    def _count(self, entry: Window, now: float) -> float | None:
+        """Count a request against ``entry`` (see ``hit``)."""
+        if entry.previous * self._weight(entry, now) + entry.current + 1 <= self.limit:
+            entry.current += 1
+            return None
+        self.limited += 1
+        return self._retry_after(entry, now)
+
+    def _retry_after(self, entry: Window, now: float) -> float:
+        """Seconds until ``entry`` allows one more request."""
+        if self.limit <= 0:
+            return self.window
+        end = entry.start + self.window
+        if entry.current + 1 <= self.limit:
+            # This window has room once the previous one has faded enough.
+            fraction = 1 - (self.limit - entry.current - 1) / entry.previous
+            return max(entry.start + fraction * self.window - now, 0)
+        # Next window: this one becomes the previous one, fading from full.
+        fraction = 1 - (self.limit - 1) / entry.current
+        return end + fraction * self.window - now
+
+    def _evict(self, now: float) -> None:
+        """Drop the least recently seen key if over the cap or idle."""
+        while self._windows:
+            key, oldest = next(iter(self._windows.items()))
+            if len(self._windows) > self.max_keys:
+                self.evictions += 1
+            elif now - oldest.start < 2 * self.window:
+                return
+            del self._windows[key]
+
+    def __len__(self) -> int:
+        return len(self._windows)
+
+    def stats(self) -> dict:
+        """Counters and occupancy."""
+        return {"keys": len(self), "limited": self.limited,
+                "evictions": self.evictions}
+
+
+class SharedWindowLimiter(SlidingWindowLimiter):
+    """``SlidingWindowLimiter`` with its counts in a file mapped by every
+    worker process on the host.
+
+    The file is a fixed hash table: ``max_keys`` slots (rounded up to whole
+    buckets of ``BUCKET_SLOTS``), ``SLOT.size`` bytes each. A key lives in
+    one bucket, found by a hash that is the same in every process; each
+    bucket has its own ``fcntl`` byte-range lock. A new key takes an empty
+    or idle slot in its bucket, else the least recently seen one.
+
+    The layout is part of the file name (``path`` plus e.g. ``.65536x60``),
+    so workers started with other settings, say during a rolling restart,
+    use a table of their own. A file once laid out is never resized: that
+    would fault the processes that still map it. A file of that name in
+    some other layout is refused with ``OSError``.
+    """
+
+    def __init__(self, path: str, limit: int, window: float = WINDOW, max_keys: int = 65536):
+        super().__init__(limit, window, max_keys)
+        self.buckets = max(1, -(-max_keys // BUCKET_SLOTS))
+        self.bucket_size = BUCKET_SLOTS * SLOT.size
+        self.path = f"{path}.{self.buckets * BUCKET_SLOTS}x{window:g}"
+        size = HEADER.size + self.buckets * self.bucket_size
+        header = HEADER.pack(SHARED_MAGIC, self.buckets, BUCKET_SLOTS, window)
+        self._lock = threading.Lock()  # fcntl locks don't exclude threads
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_size == 0:
+                    # New: lay it out, zeroed.
+                    os.ftruncate(fd, size)
+                    os.pwrite(fd, header, 0)
+                elif os.fstat(fd).st_size != size or os.pread(fd, HEADER.size, 0) != header:
+                    raise OSError(f"{self.path} is not a rate-limit table for these settings")
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN)
+            self._map = mmap.mmap(fd, size)
+        except BaseException:
+            os.close(fd)
+            raise
+        self._fd = fd
+
+    def hit(self, key: str, now: float | None = None) -> float | None:
+        """Count a request for ``key``: None if it is allowed, else the number
+        of seconds until one would be."""
+        if now is None:
+            now = time.time()  # the same in every process
+        digest = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little")
+        digest = digest or 1  # 0 marks an empty slot
+        offset = HEADER.size + digest % self.buckets * self.bucket_size
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self.bucket_size, offset)
+            try:
+                return self._hit_bucket(offset, digest, now)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self.bucket_size, offset)
+
+    def _hit_bucket(self, offset: int, digest: int, now: float) -> float | None:
+        victim = victim_seen = None
+        for slot in range(offset, offset + self.bucket_size, SLOT.size):
+            slot_digest, start, seen, previous, current = SLOT.unpack_from(self._map, slot)
+            if slot_digest == digest:
+                entry = Window(start)
+                entry.previous, entry.current = previous, current
+                self._advance(entry, now)
+                break
+            if slot_digest == 0 or not 0 <= now - start < 2 * self.window:
+                victim, victim_seen = slot, None  # free: no eviction
+            elif victim is None or victim_seen is not None and seen < victim_seen:
+                victim, victim_seen = slot, seen
+        else:
+            if victim_seen is not None:
+                self.evictions += 1
+            slot, entry = victim, Window(now)
+        retry_after = self._count(entry, now)
+        SLOT.pack_into(self._map, slot, digest, entry.start, now, entry.previous, entry.current)
+        return retry_after
+
+    def __len__(self) -> int:
+        return sum(1 for slot in range(HEADER.size, len(self._map), SLOT.size)
+                   if SLOT.unpack_from(self._map, slot)[0])
+
+    def close(self) -> None:
+        self._map.close()
+        os.close(self._fd)
+
+
+def make_limiter(limit: int, window: float = WINDOW, max_keys: int = 65536,
+                 shared: str = "") -> SlidingWindowLimiter:
+    """A limiter shared through the file ``shared``, if given and possible,
+    else one for this process alone."""
+    if shared:
+        if fcntl is None:
+            print("K0SNGIN_RATE_LIMIT_SHARED needs fcntl (POSIX);"
+                  " limiting per process")  # TODO: log this
+        else:
+            try:
+                return SharedWindowLimiter(shared, limit, window, max_keys)
+            except OSError as e:
+                print(f"K0SNGIN_RATE_LIMIT_SHARED: cannot map {shared}: {e};"
+                      " limiting per process")  # TODO: log this
+    return SlidingWindowLimiter(limit, window, max_keys)
+
+
+def client_host(scope) -> str:
+    """The client's address (as Cloudflare forwards it, when it does)."""
+    for name, value in scope["headers"]:
+        if name == b"x-forwarded-for":
+            # Cloudflare sets this header
+            return value.decode("latin-1").split(",")[0].strip()
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+
+class RateLimitMiddleware:
+    """Answer 429 to clients over ``requests_per_minute`` (plain ASGI)."""
+
+    def __init__(self, app, requests_per_minute: int = 60, max_keys: int | None = None,
+                 aggregate: bool | None = None, shared: str | None = None):
+        self.app = app
+        self.requests_per_minute = requests_per_minute
+        self.aggregate = RATE_LIMIT_AGGREGATE if aggregate is None else aggregate
+        self.limiter = make_limiter(
+            requests_per_minute, WINDOW, RATE_LIMIT_KEYS if max_keys is None else max_keys,
+            RATE_LIMIT_SHARED if shared is None else shared)
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        key = client_host(scope)
+        if self.aggregate:
+            key = network_key(key)
+        retry_after = self.limiter.hit(key)
+        if retry_after is not None:
+            response = Response(
+                content="Rate limit exceeded. Please try again later.",
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+            )
+            await response(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
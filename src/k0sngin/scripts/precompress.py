@@ -0,0 +1,139 @@
+"""
+Generate precompressed siblings (name.gz, name.br, name.zst) for the
+compressible files under a directory, refreshing any older than their file
+"""
+
+import argparse
+import gzip
+import mimetypes
+import os
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from k0sngin.precompressed import ENCODINGS, SUFFIXES, is_compressible
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from compression import zstd  # Python 3.14+
+except ImportError:
+    try:
+        import zstandard as zstd
+    except ImportError:
+        zstd = None
+
+
+def _zstd_compress(data: bytes) -> bytes:
+    if hasattr(zstd, "ZstdCompressor"):  # zstandard
+        return zstd.ZstdCompressor(level=19).compress(data)
+    return zstd.compress(data, level=19)
+
+
+# Content-Encoding -> compressor, for the encoders that are installed.
+COMPRESSORS = {"gzip": lambda data: gzip.compress(data, compresslevel=9, mtime=0)}
+if brotli is not None:
+    COMPRESSORS["br"] = lambda data: brotli.compress(data, quality=11)
+if zstd is not None:
+    COMPRESSORS["zstd"] = _zstd_compress
+
+
+def candidates(top: str, min_size: int):
+    """Paths of the compressible files under ``top`` (symlinks not
+    followed; existing siblings skipped)."""
+    for dirpath, _, filenames in os.walk(top):
+        for name in filenames:
+            if name.endswith(SUFFIXES):
+                continue
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path) or not is_compressible(mimetypes.guess_type(name)[0]):
+                continue
+            if os.path.getsize(path) >= min_size:
+                yield path
+
+
+def stale_encodings(path: str, encodings) -> list:
+    """The encodings whose sibling of ``path`` is missing or older than it."""
+    mtime = os.stat(path).st_mtime_ns
+    stale = []
+    for encoding, suffix in ENCODINGS:
+        if encoding not in encodings:
+            continue
+        try:
+            if os.stat(path + suffix).st_mtime_ns >= mtime:
+                continue
+        except FileNotFoundError:
+            pass
+        stale.append(encoding)
+    return stale
+
+
+def compress_file(path: str, encodings) -> list:
+    """Write the given siblings of ``path``; returns the ones written. A
+    sibling that would not be smaller than the file is not written (and a
+    stale one is removed, as the server would ignore it anyway)."""
+    with open(path, "rb") as f:
+        data = f.read()
+    written = []
+    suffixes = dict(ENCODINGS)
+    for encoding in encodings:
+        sibling = path + suffixes[encoding]
+        compressed = COMPRESSORS[encoding](data)
+        if len(compressed) >= len(data):
+            try:
+                os.remove(sibling)
+            except FileNotFoundError:
+                pass
+            continue
+        # Write beside the file and rename, so the server never sees half a
+        # sibling.
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".precompress-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(compressed)
+            os.chmod(tmp, os.stat(path).st_mode & 0o777)
+            os.replace(tmp, sibling)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        written.append(encoding)
+    return written
+
+
+def main(args=sys.argv[1:]):
+    """CLI entry point"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('directory', nargs='?', help='The directory to walk (default: K0SNGIN_TOP_LEVEL, or the current directory)')
+    parser.add_argument('--encodings', default=','.join(COMPRESSORS), help=f'Comma-separated encodings to generate (available: {", ".join(COMPRESSORS)})')
+    parser.add_argument('--min-size', type=int, default=1024, help='Skip files smaller than this many bytes (default: 1024)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='Parallel compression processes (default: CPU count)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Print every sibling written')
+    options = parser.parse_args(args)
+
+    encodings = [encoding.strip() for encoding in options.encodings.split(',') if encoding.strip()]
+    unavailable = [encoding for encoding in encodings if encoding not in COMPRESSORS]
+    if unavailable:
+        parser.error(f"encoding(s) not available: {', '.join(unavailable)}"
+                     " (br needs the brotli package, zstd Python 3.14 or zstandard)")
+    top = options.directory or os.environ.get("K0SNGIN_TOP_LEVEL", os.getcwd())
+
+    paths, stale = [], []
+    for path in candidates(top, options.min_size):
+        if todo := stale_encodings(path, encodings):
+            paths.append(path)
+            stale.append(todo)
+    written = 0
+    with ProcessPoolExecutor(max_workers=options.jobs) as pool:
+        for path, done in zip(paths, pool.map(compress_file, paths, stale)):
+            written += len(done)
+            if options.verbose:
+                for encoding in done:
+                    print(f"{path}: {encoding}")
+    print(f"{len(paths)} file(s) refreshed, {written} sibling(s) written")
+
+
+if __name__ == '__main__':
+    sys.exit(main() or 0)
@@ -0,0 +1,257 @@
+"""
+Filesystem watcher: inotify-driven cache invalidation (Linux, optional).
+
+With ``K0SNGIN_INOTIFY=1`` a background thread watches ``TOP_LEVEL_DIR`` and
+the ``K0SNGIN_LINKS`` targets (``links.ALLOWED_LINK_TARGETS``) through the
+kernel's inotify interface (via ctypes; no extra service or package) and
+pushes every change into ``cache.invalidate``. While it runs,
+``cache.stat_signature`` is memoized for covered paths, so the caches built on
+it stop stat'ing the filesystem on every request.
+
+A path is *covered* only if changes to it are guaranteed to produce an
+event: its directory is watched and it is not itself a symlink (events fire
+on the link, not on what it points to). Paths through symlinked directories
+are never under a watched directory (the walk does not follow links), so they
+keep the per-request stat. If the kernel's event queue overflows or a watch
+can't be added (``fs.inotify.max_user_watches``), events may have been lost:
+the caches are flushed and the watcher stops vouching for anything —
+every lookup falls back to stat validation.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import threading
+
+from . import cache
+from .links import ALLOWED_LINK_TARGETS
+from .path import TOP_LEVEL_DIR
+
+# <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+              | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+              | IN_ONLYDIR | IN_DONT_FOLLOW)
+# Events that change the containing directory's entries (and so its mtime).
+ENTRY_EVENTS = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+ENABLED = os.environ.get("K0SNGIN_INOTIFY", "").lower() in {"1", "true", "yes", "on"}
+
+
+def _libc():
+    """libc with the inotify calls, or None where there is no inotify."""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+class Watcher:
+    """Watch directory trees and feed their changes to ``cache.invalidate``."""
+
+    def __init__(self, roots):
+        self.roots = [os.fspath(root) for root in roots]
+        self.healthy = False
+        self._libc = _libc()
+        self._fd = None
+        self._stop_r = self._stop_w = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._paths = {}       # wd -> directory path
+        self._watched = set()  # watched directory paths
+        self._symlinks = set()  # symlinks seen inside the watched directories
+
+    def start(self) -> bool:
+        """Add the watches and start the reader thread; False if inotify is
+        unavailable (the caches then keep validating with stat)."""
+        if self._libc is None:
+            print("K0SNGIN_INOTIFY: inotify is not available;"
+                  " using stat validation")  # TODO: log this
+            return False
+        fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            print(f"K0SNGIN_INOTIFY: inotify_init1 failed: "
+                  f"{os.strerror(ctypes.get_errno())}")  # TODO: log this
+            return False
+        self._fd = fd
+        self.healthy = True
+        for root in self.roots:
+            self._add_tree(root)
+        if not self.healthy:
+            self.stop()
+            return False
+        self._stop_r, self._stop_w = os.pipe()
+        self._thread = threading.Thread(target=self._run, name="k0sngin-watcher", daemon=True)
+        self._thread.start()
+        cache.set_coverage(self.covers)
+        return True
+
+    def stop(self) -> None:
+        """Stop watching; caches go back to stat validation."""
+        if self.healthy:
+            cache.set_coverage(None)
+        self.healthy = False
+        if self._stop_w is not None:
+            os.write(self._stop_w, b"x")
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        for fd in (self._fd, self._stop_r, self._stop_w):
+            if fd is not None:
+                os.close(fd)
+        self._fd = self._stop_r = self._stop_w = None
+
+    def covers(self, path: str) -> bool:
+        """True if a change to ``path`` is guaranteed to be reported: it is a
+        watched directory, or a non-symlink entry of one."""
+        if not self.healthy:
+            return False
+        if path in self._watched:
+            return True
+        return os.path.dirname(path) in self._watched and path not in self._symlinks
+
+    # --- watches -------------------------------------------------------------
+
+    def _add_tree(self, top: str) -> None:
+        """Watch ``top`` and every directory below it (not following links)."""
+        for dirpath, dirnames, filenames in os.walk(top):
+            if not self._add_watch(dirpath):
+                return
+            for name in dirnames + filenames:
+                path = os.path.join(dirpath, name)
+                if os.path.islink(path):
+                    self._symlinks.add(path)
+
+    def _add_watch(self, directory: str) -> bool:
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error in (errno.ENOENT, errno.ENOTDIR):
+                return True  # raced with a removal; nothing to watch
+            print(f"K0SNGIN_INOTIFY: cannot watch {directory}: {os.strerror(error)};"
+                  " falling back to stat validation")  # TODO: log this
+            self._overflow()
+            return False
+        with self._lock:
+            self._paths[wd] = directory
+            self._watched.add(directory)
+        return True
+
+    def _forget_tree(self, top: str) -> None:
+        """Drop the watches at and below ``top`` (it was removed or moved)."""
+        prefix = top.rstrip(os.sep) + os.sep
+        with self._lock:
+            for wd, path in list(self._paths.items()):
+                if path == top or path.startswith(prefix):
+                    del self._paths[wd]
+                    self._watched.discard(path)
+                    self._libc.inotify_rm_watch(self._fd, wd)
+            self._symlinks = {link for link in self._symlinks
+                              if not link.startswith(prefix)}
+
+    def _overflow(self) -> None:
+        """Events were (or may have been) lost: stop vouching for anything."""
+        self.healthy = False
+        cache.set_coverage(None)
+
+    # --- events --------------------------------------------------------------
+
+    def _run(self) -> None:
+        while True:
+            readable, _, _ = select.select([self._fd, self._stop_r], [], [])
+            if self._stop_r in readable:
+                return
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                continue
+            self._dispatch(data)
+
+    def _dispatch(self, data: bytes) -> None:
+        offset = 0
+        while offset < len(data):
+            wd, mask, _cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            self._handle(wd, mask, os.fsdecode(name))
+
+    def _handle(self, wd: int, mask: int, name: str) -> None:
+        if mask & IN_Q_OVERFLOW:
+            print("K0SNGIN_INOTIFY: event queue overflowed;"
+                  " falling back to stat validation")  # TODO: log this
+            self._overflow()
+            return
+        directory = self._paths.get(wd)
+        if directory is None:
+            return
+        if mask & IN_IGNORED:
+            with self._lock:
+                self._paths.pop(wd, None)
+                self._watched.discard(directory)
+            return
+        path = os.path.join(directory, name) if name else directory
+        is_dir = bool(mask & IN_ISDIR)
+
+        if name and mask & (IN_CREATE | IN_MOVED_TO):
+            if os.path.islink(path):
+                self._symlinks.add(path)
+            elif is_dir:
+                self._add_tree(path)
+        if name and mask & (IN_DELETE | IN_MOVED_FROM):
+            self._symlinks.discard(path)
+            if is_dir:
+                self._forget_tree(path)
+
+        cache.invalidate(path, subtree=is_dir or not name)
+        if name and mask & ENTRY_EVENTS:
+            cache.invalidate(directory)
+
+
+WATCHER = None
+
+
+def start() -> None:
+    """Start the process-wide watcher if ``K0SNGIN_INOTIFY`` is set."""
+    global WATCHER
+    if not ENABLED or WATCHER is not None:
+        return
+    WATCHER = Watcher([TOP_LEVEL_DIR, *ALLOWED_LINK_TARGETS])
+    if not WATCHER.start():
+        WATCHER = None
+
+
+def stop() -> None:
+    """Stop the process-wide watcher."""
+    global WATCHER
+    if WATCHER is not None:
+        WATCHER.stop()
+        WATCHER = None
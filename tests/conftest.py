@@ -92,3 +92,14 @@ def client() -> TestClient:
 def site_root() -> pathlib.Path:
     """Path to the served top-level directory (``K0SNGIN_TOP_LEVEL``)."""
     return _SITE
+
+
+@pytest.fixture(scope="session")
+def settle():
+    """Backdate paths past the racy window (``cache.RACY_WINDOW_NS``), so the
+    caches that only trust settled files memoize them:
+    ``settle(*paths, mtime=1_500_000_000)``."""
+    def settle(*paths, mtime=1_500_000_000):
+        for path in paths:
+            os.utime(path, (mtime, mtime))
+    return settle
@@ -0,0 +1,190 @@
+"""Tests for moving blocking work off the event loop (``blocking.py``).
+
+Spec: file lookups and directory prepares/renders run in worker threads, at
+most ``K0SNGIN_BLOCKING_THREADS`` at a time; ``0`` runs them inline.
+Answers from memory whose validation the watcher has memoized (known-missing
+paths, cached small files) stay on the event loop. Directory renders are
+admitted at most ``K0SNGIN_RENDER_CONCURRENCY`` at a time, with a bounded,
+time-limited wait queue; past it they get a 503 with ``Retry-After`` at once,
+while files and render-cache hits are still served.
+"""
+
+import os
+import threading
+import time
+
+import anyio
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+from k0sngin import blocking, cache, directory, main
+
+WORKER = "AnyIO worker thread"
+
+
+@pytest.fixture
+def threads(monkeypatch):
+    """Names of the threads ``lookup_file`` and ``prepare_directory`` ran in."""
+    seen = {}
+
+    def recording(name, func):
+        def wrapper(*args):
+            seen[name] = threading.current_thread().name
+            return func(*args)
+        return wrapper
+
+    monkeypatch.setattr(main, "lookup_file", recording("lookup", main.lookup_file))
+    monkeypatch.setattr(directory, "prepare_directory",
+                        recording("prepare", directory.prepare_directory))
+    return seen
+
+
+def test_lookup_and_render_in_worker_threads(client, site_root, threads):
+    d = site_root / "blocking"
+    d.mkdir(exist_ok=True)
+    assert client.get("/blocking/").status_code == 200
+    assert threads == {"lookup": WORKER, "prepare": WORKER}
+
+
+def test_zero_threads_runs_inline(client, threads, monkeypatch):
+    monkeypatch.setattr(blocking, "BLOCKING_THREADS", 0)
+    assert client.get("/hello.txt").status_code == 200
+    assert threads["lookup"] != WORKER
+
+
+@pytest.fixture
+def watched():
+    """Every path counts as watched, as under ``K0SNGIN_INOTIFY``."""
+    cache.set_coverage(lambda path: True)
+    yield
+    cache.set_coverage(None)
+
+
+def test_memory_answers_stay_on_the_loop(client, site_root, threads, monkeypatch, settle, watched):
+    path = site_root / "inline.css"
+    path.write_text("body {}\n")
+    settle(path)
+    plain = {"accept-encoding": "identity"}
+    client.get("/inline.css", headers=plain)  # cached as a small file
+    assert threads["lookup"] == WORKER
+    client.get("/inline.css", headers=plain)  # its stat memoized
+    request = Request({"type": "http", "headers": [(b"accept-encoding", b"identity")],
+                       "query_string": b""})
+    assert main.answered_from_memory("inline.css", request)
+    assert client.get("/inline.css", headers=plain).text == "body {}\n"
+    assert threads["lookup"] != WORKER
+    assert not main.answered_from_memory("not-cached.css", request)
+    monkeypatch.setattr(directory.CACHE_POLICIES, "memoized", lambda directory: False)
+    assert not main.answered_from_memory("inline.css", request)  # its policy needs a lookup
+
+
+def test_other_small_file_requests_leave_the_loop(client, site_root, threads, monkeypatch,
+                                                   settle, watched):
+    """Ranges and encodings that may pick a precompressed sibling touch the
+    disk: no stat of theirs runs on the event loop."""
+    d = site_root / "inline_other"
+    d.mkdir()
+    (d / "style.css").write_text("body {}\n")
+    settle(d / "style.css", d)
+    for _ in range(2):  # cached as a small file, its stat memoized
+        client.get("/inline_other/style.css", headers={"accept-encoding": "identity"})
+    stats = []
+    real_stat = os.stat
+    monkeypatch.setattr(os, "stat", lambda path, *args, **kwargs:  # (not lazy imports')
+                        os.fspath(path).startswith(str(site_root))
+                        and stats.append(threading.current_thread().name)
+                        or real_stat(path, *args, **kwargs))
+    for headers in ({"accept-encoding": "identity", "range": "bytes=0-3"},
+                    {"accept-encoding": "gzip"}):
+        threads.clear()
+        assert client.get("/inline_other/style.css", headers=headers).status_code in (200, 206)
+        assert threads["lookup"] == WORKER
+    assert stats and set(stats) == {WORKER}
+    # Known to have no sibling now: back on the loop.
+    stats.clear()
+    assert client.get("/inline_other/style.css", headers={"accept-encoding": "gzip"}).status_code == 200
+    assert threads["lookup"] != WORKER
+    assert stats == []
+
+
+def test_pool_is_bounded(monkeypatch):
+    monkeypatch.setattr(blocking, "BLOCKING_THREADS", 2)
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def work():
+        with lock:
+            running.append(1)
+            peak.append(len(running))
+        time.sleep(0.02)
+        with lock:
+            running.pop()
+
+    async def main_():
+        async with anyio.create_task_group() as tg:
+            for _ in range(6):
+                tg.start_soon(blocking.run_blocking, work)
+
+    anyio.run(main_)
+    assert max(peak) == 2
+
+
+def test_render_queue_overflow_is_shed():
+    admission = blocking.RenderAdmission(1, 1, 5)
+    outcomes = []
+
+    async def render(release):
+        try:
+            async with admission.admit():
+                outcomes.append("admitted")
+                await release.wait()
+        except HTTPException as e:
+            outcomes.append((e.status_code, e.headers["Retry-After"]))
+
+    async def main_():
+        release = anyio.Event()
+        async with anyio.create_task_group() as tg:
+            tg.start_soon(render, release)    # runs
+            await anyio.sleep(0.01)
+            tg.start_soon(render, release)    # waits
+            await anyio.sleep(0.01)
+            assert admission.stats()["waiting"] == 1
+            tg.start_soon(render, release)    # queue full
+            await anyio.sleep(0.01)
+            release.set()
+
+    anyio.run(main_)
+    assert outcomes == ["admitted", (503, "5"), "admitted"]
+    assert admission.stats() == {"running": 0, "waiting": 0, "admitted": 2, "shed": 1}
+
+
+def test_render_wait_is_bounded():
+    admission = blocking.RenderAdmission(1, 4, 0.05)
+
+    async def main_():
+        async with admission.admit():
+            with pytest.raises(HTTPException) as e:
+                async with admission.admit():
+                    pass
+        assert e.value.headers["Retry-After"] == "1"
+
+    anyio.run(main_)
+    assert admission.stats()["shed"] == 1
+
+
+def test_overload_spares_files_and_cached_pages(client, site_root, monkeypatch, settle):
+    d = site_root / "admission"
+    d.mkdir(exist_ok=True)
+    settle(d)
+    assert client.get("/admission/").status_code == 200  # rendered and cached
+    monkeypatch.setattr(blocking, "render_admission",
+                        lambda: blocking.RenderAdmission(0, 0, 1))  # saturated
+    busy = site_root / "busy"
+    busy.mkdir(exist_ok=True)
+    response = client.get("/busy/")
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "1"
+    assert client.get("/admission/").status_code == 200
+    assert client.get("/hello.txt").status_code == 200
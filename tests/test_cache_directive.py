@@ -0,0 +1,101 @@
+"""Tests for the ``/cache`` directive (per-subtree Cache-Control).
+
+Spec: ``/cache = max-age=N, s-maxage=N, stale-while-revalidate=N,
+stale-if-error=N`` sets ``Cache-Control: public, ...`` on the directory's
+index page (and its 304s) and on every file below it, replacing the built-in
+policy; it cascades, a child's ``/cache`` replaces the parent's, and
+``/cache = default`` restores the built-in policy, while a value without a
+valid directive leaves the parent's in place (warning once per edit). File
+requests use a memoized policy: they don't stat the index.ini chain on every
+request.
+"""
+
+import os
+
+import pytest
+
+from k0sngin.directory import CACHE_POLICIES, INDEX_CACHE_CONTROL
+from k0sngin.formatter import CacheFormatter
+from k0sngin.main import MEDIA_MAX_AGE
+
+POLICY = "public, max-age=60, s-maxage=86400, stale-while-revalidate=30, stale-if-error=604800"
+
+
+@pytest.fixture
+def site(site_root, monkeypatch, settle):
+    monkeypatch.setattr(CACHE_POLICIES, "valid", 0)  # revalidate every time
+    d = site_root / "cached"
+    (d / "sub").mkdir(parents=True, exist_ok=True)
+    (d / "opt-out").mkdir(exist_ok=True)
+    (d / "notes.txt").write_text("notes\n")
+    (d / "sub" / "photo.png").write_bytes(b"png")
+    (d / "opt-out" / "photo.png").write_bytes(b"png")
+    (d / "index.ini").write_text(
+        "/cache = stale-if-error=604800, max-age=60, s-maxage=86400,"
+        " stale-while-revalidate=30\n")
+    (d / "sub" / "index.ini").write_text("/title = Sub\n")
+    (d / "opt-out" / "index.ini").write_text("/cache = default\n")
+    settle(d / "notes.txt", d / "sub" / "photo.png", d / "opt-out" / "photo.png",
+           d / "index.ini", d / "sub" / "index.ini", d / "opt-out" / "index.ini",
+           d / "sub", d / "opt-out", d)
+    return d
+
+
+def test_cache_control_from_value():
+    assert CacheFormatter.cache_control("max-age=0") == "public, max-age=0"
+    assert CacheFormatter.cache_control("s-maxage=600") == "public, max-age=0, s-maxage=600"
+    assert CacheFormatter.cache_control("default") is None
+    assert CacheFormatter.cache_control("") is None
+    assert CacheFormatter.cache_control("max-age=soon, bogus=1, immutable") is None
+    assert CacheFormatter.cache_control("bogus=1", "public, max-age=5") == "public, max-age=5"
+
+
+def test_invalid_value_inherits_and_warns_once(client, site, settle, capsys):
+    (site / "sub" / "index.ini").write_text("/cache = bogus=1\n")
+    settle(site / "sub" / "index.ini", mtime=1_500_000_200)
+    for _ in range(3):
+        assert client.get("/cached/sub/").headers["cache-control"] == POLICY
+        CACHE_POLICIES.tree.invalidate(site / "sub")  # rebuilt every time
+    assert capsys.readouterr().out.count("unknown directive 'bogus'") == 1
+
+
+def test_index_page_and_304(client, site):
+    r = client.get("/cached/")
+    assert r.headers["cache-control"] == POLICY
+    r = client.get("/cached/", headers={"if-none-match": r.headers["etag"]})
+    assert r.status_code == 304
+    assert r.headers["cache-control"] == POLICY
+
+
+def test_files_and_subtree_inherit(client, site):
+    assert client.get("/cached/notes.txt").headers["cache-control"] == POLICY
+    assert client.get("/cached/sub/photo.png").headers["cache-control"] == POLICY
+    assert client.get("/cached/sub/").headers["cache-control"] == POLICY
+
+
+def test_default_restores_builtin_policy(client, site):
+    assert client.get("/cached/opt-out/").headers["cache-control"] == INDEX_CACHE_CONTROL
+    assert (client.get("/cached/opt-out/photo.png").headers["cache-control"]
+            == f"public, max-age={MEDIA_MAX_AGE}")
+
+
+def test_edit_reaches_cached_small_file(client, site, settle):
+    assert client.get("/cached/notes.txt").headers["cache-control"] == POLICY
+    (site / "index.ini").write_text("/cache = max-age=5\n")
+    settle(site / "index.ini", mtime=1_500_000_100)
+    assert client.get("/cached/notes.txt").headers["cache-control"] == "public, max-age=5"
+
+
+def test_file_requests_use_memoized_policy(client, site, monkeypatch):
+    monkeypatch.setattr(CACHE_POLICIES, "valid", 3600)
+    client.get("/cached/sub/photo.png")
+    stats = []
+    real_stat = os.stat
+
+    def counting_stat(path, *args, **kwargs):
+        stats.append(os.fspath(path))
+        return real_stat(path, *args, **kwargs)
+
+    monkeypatch.setattr(os, "stat", counting_stat)
+    assert client.get("/cached/sub/photo.png").headers["cache-control"] == POLICY
+    assert not [path for path in stats if path.endswith("index.ini")]
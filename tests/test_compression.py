@@ -0,0 +1,169 @@
+"""Tests for dynamic response compression (``compress.CompressionMiddleware``).
+
+Spec: 200 responses to GET with a text type and at least the minimum size are
+gzip-compressed for clients that accept it, with ``Vary: Accept-Encoding``
+and a weak ETag that still revalidates; a 304 for it repeats the weak ETag.
+HEAD gets the same headers as GET. Compressed bodies of responses with an
+ETag are cached per (path, ETag, encoding). Small, binary and
+already-encoded responses pass through; streamed bodies stay streamed, and
+file bodies are read in chunks. Large chunks are compressed off the event
+loop.
+"""
+
+import gzip
+
+import anyio
+
+from k0sngin import compress
+from k0sngin.compress import COMPRESSED_CACHE, CompressionMiddleware
+from k0sngin.cache import LRUCache
+
+GZIP = {"accept-encoding": "gzip"}
+
+
+def test_directory_page_is_compressed_and_cached(client, site_root, settle):
+    d = site_root / "compress_dir"
+    d.mkdir()
+    for i in range(40):
+        (d / f"file-{i:03}.txt").write_text("x\n")
+    settle(d)  # so fingerprinted
+    plain = client.get("/compress_dir/", headers={"accept-encoding": "identity"})
+    assert "content-encoding" not in plain.headers
+    assert plain.headers["vary"] == "Accept-Encoding"
+
+    r = client.get("/compress_dir/", headers=GZIP)
+    assert r.headers["content-encoding"] == "gzip"
+    assert r.headers["vary"] == "Accept-Encoding"
+    assert r.text == plain.text
+    assert int(r.headers["content-length"]) < len(plain.content)
+    assert r.headers["etag"] == "W/" + plain.headers["etag"]
+    hits = COMPRESSED_CACHE.hits
+    again = client.get("/compress_dir/", headers=GZIP)
+    assert again.text == plain.text
+    assert COMPRESSED_CACHE.hits == hits + 1
+    r = client.get("/compress_dir/", headers={**GZIP, "if-none-match": r.headers["etag"]})
+    assert r.status_code == 304
+
+
+def test_text_file_is_compressed(client, site_root):
+    body = "a line of text\n" * 200
+    (site_root / "compress.txt").write_text(body)
+    r = client.get("/compress.txt", headers=GZIP)
+    assert r.headers["content-encoding"] == "gzip"
+    assert r.headers["etag"].startswith("W/")
+    assert r.text == body
+    etag = r.headers["etag"]
+    r = client.get("/compress.txt", headers={**GZIP, "if-none-match": etag})
+    assert r.status_code == 304
+    assert r.headers["etag"] == etag
+    assert r.headers["vary"] == "Accept-Encoding"
+    strong = etag.removeprefix("W/")
+    r = client.get("/compress.txt", headers={"if-none-match": strong})
+    assert r.headers["etag"] == strong  # the identity representation's
+
+
+def test_head_matches_get(client, site_root):
+    (site_root / "compress_head.txt").write_text("text\n" * 1000)
+    first = client.head("/compress_head.txt", headers=GZIP)
+    get = client.get("/compress_head.txt", headers=GZIP)
+    head = client.head("/compress_head.txt", headers=GZIP)  # compressed body cached
+    for name in ("content-encoding", "etag", "vary"):
+        assert first.headers[name] == get.headers[name] == head.headers[name]
+    assert "content-length" not in first.headers
+    assert head.headers["content-length"] == get.headers["content-length"]
+
+
+def test_small_and_binary_pass_through(client, site_root):
+    small = client.get("/hello.txt", headers=GZIP)
+    assert "content-encoding" not in small.headers
+    assert small.headers["vary"] == "Accept-Encoding"
+    assert not small.headers["etag"].startswith("W/")
+
+    (site_root / "compress.png").write_bytes(b"\0" * 4096)
+    r = client.get("/compress.png", headers=GZIP)
+    assert "content-encoding" not in r.headers
+    assert "vary" not in r.headers
+
+
+def run(app, headers=((b"accept-encoding", b"gzip"),), cache=None):
+    scope = {"type": "http", "method": "GET", "path": "/stream", "query_string": b"",
+             "headers": list(headers)}
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    cache = LRUCache(maxbytes=1 << 20) if cache is None else cache
+    anyio.run(CompressionMiddleware(app, minimum_size=10, cache=cache),
+              scope, receive, send)
+    return messages
+
+
+def test_streamed_body_stays_streamed():
+    chunks = [b"chunk %d " % i * 500 for i in range(4)]
+
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"text/plain")]})
+        for i, chunk in enumerate(chunks):
+            await send({"type": "http.response.body", "body": chunk,
+                        "more_body": i < len(chunks) - 1})
+
+    messages = run(app)
+    headers = dict(messages[0]["headers"])
+    assert headers[b"content-encoding"] == b"gzip"
+    assert b"content-length" not in headers
+    bodies = [m for m in messages[1:] if m["type"] == "http.response.body"]
+    assert len(bodies) > 1
+    assert bodies[-1]["more_body"] is False
+    assert gzip.decompress(b"".join(m["body"] for m in bodies)) == b"".join(chunks)
+
+
+def test_pathsend_body_is_compressed(tmp_path):
+    path = tmp_path / "big.txt"
+    path.write_bytes(b"pathsend " * 500)
+
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"text/plain"),
+                                (b"content-length", b"4500")]})
+        await send({"type": "http.response.pathsend", "path": str(path)})
+
+    messages = run(app)
+    headers = dict(messages[0]["headers"])
+    assert headers[b"content-encoding"] == b"gzip"
+    assert gzip.decompress(messages[1]["body"]) == path.read_bytes()
+    assert headers[b"content-length"] == str(len(messages[1]["body"])).encode()
+
+
+def test_large_pathsend_body_is_streamed(tmp_path, monkeypatch):
+    monkeypatch.setattr(compress, "FILE_CHUNK_SIZE", 1000)
+    path = tmp_path / "big.txt"
+    path.write_bytes(b"".join(b"line %05d\n" % i for i in range(1000)))
+    offloaded = []
+    real_run_blocking = compress.run_blocking
+
+    async def recording(func, *args):
+        offloaded.append(func.__name__)
+        return await real_run_blocking(func, *args)
+
+    monkeypatch.setattr(compress, "run_blocking", recording)
+    monkeypatch.setattr(compress, "INLINE_MAX", 500)
+
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"text/plain"),
+                                (b"content-length", b"11000")]})
+        await send({"type": "http.response.pathsend", "path": str(path)})
+
+    messages = run(app)
+    headers = dict(messages[0]["headers"])
+    assert b"content-length" not in headers
+    bodies = [m for m in messages[1:] if m["type"] == "http.response.body"]
+    assert len(bodies) > 1
+    assert gzip.decompress(b"".join(m["body"] for m in bodies)) == path.read_bytes()
+    assert offloaded.count("pread") == 11
+    assert offloaded.count("_compress") == 11
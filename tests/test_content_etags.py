@@ -0,0 +1,142 @@
+"""Tests for content-addressed ETags (``digests.py``).
+
+Spec: with ``K0SNGIN_CONTENT_ETAG`` on, a file's ETag is a digest of its
+contents, so touching the mtime keeps the ETag while any content change
+replaces it. Digests are computed once per stat (inline for small files, in
+the background otherwise — the stat ETag stands in meanwhile, and keeps
+validating the unchanged file) and persist in an index file that a fresh
+process loads. No request gets a large file hashed on the spot, whatever it
+sends; a touched file gets its old digest back once rehashed. The index is
+bounded, drops files that are gone, and a malformed one is discarded.
+"""
+
+import marshal
+
+import pytest
+
+from k0sngin import digests, main
+from k0sngin.digests import DigestIndex
+
+
+@pytest.fixture
+def content_etags(monkeypatch, tmp_path):
+    index = DigestIndex(str(tmp_path / "digests.idx"))
+    monkeypatch.setattr(main, "CONTENT_ETAG", True)
+    monkeypatch.setattr(main, "DIGESTS", index)
+    yield index
+    index.wait()
+
+
+def test_touch_keeps_the_etag_and_edits_change_it(client, site_root, content_etags, settle):
+    path = site_root / "digest.txt"
+    path.write_text("same bytes\n")
+    settle(path)
+    etag = client.get("/digest.txt").headers["etag"]
+    assert etag != main.file_etag(path.stat())
+
+    settle(path, mtime=1_500_000_500)  # a deploy rewrote the mtime
+    r = client.get("/digest.txt", headers={"if-none-match": etag})
+    assert r.status_code == 304
+
+    path.write_text("new bytes!\n")
+    settle(path, mtime=1_500_001_000)
+    assert client.get("/digest.txt").headers["etag"] != etag
+
+
+def test_large_files_are_hashed_in_the_background(client, site_root, content_etags, monkeypatch,
+                                                  settle):
+    monkeypatch.setattr(main, "SMALL_FILE_MAX_SIZE", 4)
+    path = site_root / "digest_large.bin"
+    path.write_bytes(b"large" * 1000)
+    settle(path)
+    first = client.get("/digest_large.bin").headers["etag"]
+    assert first == main.file_etag(path.stat())  # not hashed yet
+    content_etags.wait()
+    second = client.get("/digest_large.bin").headers["etag"]
+    assert second != first
+    assert content_etags.computed == 1
+
+
+def test_recent_files_are_not_hashed(site_root):
+    path = site_root / "digest_recent.txt"
+    path.write_text("fresh\n")
+    index = DigestIndex()
+    assert index.etag(path, path.stat(), inline_max=1 << 20) is None
+    assert index.computed == 0
+
+
+def test_index_persists(tmp_path, settle):
+    path = tmp_path / "file.txt"
+    path.write_text("persist me\n")
+    settle(path)
+    index = DigestIndex(str(tmp_path / "digests.idx"))
+    etag = index.etag(path, path.stat(), inline_max=1 << 20)
+    index.save()
+
+    reloaded = DigestIndex(str(tmp_path / "digests.idx"))
+    assert reloaded.load() == 1
+    assert reloaded.etag(path, path.stat()) == etag
+    assert reloaded.computed == 0
+
+    (tmp_path / "digests.idx").write_bytes(b"garbage")
+    assert DigestIndex(str(tmp_path / "digests.idx")).load() == 0
+    for entries in ([1, 2], {"a": "b"}, {"a": (1, 2, 3)}, {1: (1, 2, 3, "d")}):
+        (tmp_path / "digests.idx").write_bytes(
+            marshal.dumps((digests.INDEX_VERSION, digests.DIGEST_ALGORITHM, entries)))
+        assert DigestIndex(str(tmp_path / "digests.idx")).load() == 0
+
+
+def test_digest_matches_file_digest(tmp_path):
+    path = tmp_path / "file.txt"
+    path.write_bytes(b"abc")
+    st = path.stat()
+    assert digests.file_digest(str(path), (st.st_ino, st.st_size, st.st_mtime_ns)) == (
+        "ba7816bf8f01cfea414140de5dae2223b00361a396177a9cb410ff61f20015ad")
+    assert digests.file_digest(str(path), (st.st_ino, st.st_size + 1, st.st_mtime_ns)) is None
+
+
+def test_touched_large_file_keeps_its_digest(client, site_root, content_etags, monkeypatch, settle):
+    monkeypatch.setattr(main, "SMALL_FILE_MAX_SIZE", 4)
+    path = site_root / "digest_touched.bin"
+    path.write_bytes(b"large" * 1000)
+    settle(path)
+    client.get("/digest_touched.bin")
+    content_etags.wait()
+    etag = client.get("/digest_touched.bin").headers["etag"]
+    settle(path, mtime=1_500_000_500)  # a deploy rewrote the mtime
+    assert client.get("/digest_touched.bin").headers["etag"] == main.file_etag(path.stat())
+    content_etags.wait()
+    assert client.get("/digest_touched.bin").headers["etag"] == etag
+    assert content_etags.computed == 2
+
+
+def test_conditional_request_is_not_hashed_inline(client, site_root, content_etags, monkeypatch,
+                                                  settle):
+    monkeypatch.setattr(main, "SMALL_FILE_MAX_SIZE", 4)
+    path = site_root / "digest_conditional.bin"
+    path.write_bytes(b"large" * 1000)
+    settle(path)
+    stat_etag = main.file_etag(path.stat())
+    r = client.get("/digest_conditional.bin", headers={"if-none-match": '"made-up"'})
+    assert r.status_code == 200
+    assert r.headers["etag"] == stat_etag  # hashing is left to the background
+    content_etags.wait()
+    r = client.get("/digest_conditional.bin", headers={"if-none-match": stat_etag})
+    assert r.status_code == 304  # the stat ETag still names these bytes...
+    assert r.headers["etag"] != stat_etag  # ...and the client moves to the digest
+
+
+def test_index_is_bounded_and_pruned(tmp_path, settle):
+    index = DigestIndex(str(tmp_path / "digests.idx"), maxsize=2)
+    paths = []
+    for name in ("a", "b", "c"):
+        path = tmp_path / name
+        path.write_text(name)
+        settle(path)
+        index.etag(path, path.stat(), inline_max=1 << 20)
+        paths.append(path)
+    assert index.stats()["entries"] == 2
+    assert index.evictions == 1
+    paths[2].unlink()
+    index.save()
+    assert DigestIndex(str(tmp_path / "digests.idx")).load() == 1
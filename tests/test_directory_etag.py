@@ -0,0 +1,125 @@
+"""Tests for directory index validators (``directory.directory_etag``).
+
+Spec: a directory index carries an ETag fingerprinted from its inputs (the
+directory's stat, every cascading index.ini, the /include fragment, the
+template choice, the query parameters the templates read, and the build), and
+``If-None-Match`` with a current ETag yields a 304 without rendering while
+the page's render is cached (after it is evicted, the page is rendered
+again). The 304 repeats the page's Link and cache tag headers. Inputs
+modified within the racy window (``cache.RACY_WINDOW_NS``) get no ETag, since
+their mtime can't yet prove the next edit will be seen.
+"""
+
+import pytest
+
+from k0sngin import purge
+from k0sngin.directory import RENDER_CACHE
+
+
+@pytest.fixture
+def make_dir(site_root, settle):
+    """``make_dir(name, ini, **files)``: <site_root>/<name>/ with an
+    index.ini and files, all backdated."""
+    def make_dir(name: str, ini: str, **files):
+        d = site_root / name
+        d.mkdir()
+        (d / "index.ini").write_text(ini)
+        for fname, content in files.items():
+            (d / fname).write_text(content)
+        settle(*d.iterdir(), d)
+        return d
+    return make_dir
+
+
+def test_directory_index_has_etag_and_304s(client, make_dir):
+    make_dir("etag_basic", "/title = Etag\n", a_txt="a")
+    r = client.get("/etag_basic/")
+    etag = r.headers["etag"]
+    assert r.headers["cache-control"] == "no-cache"
+    again = client.get("/etag_basic/", headers={"if-none-match": etag})
+    assert again.status_code == 304
+    assert again.content == b""
+    assert again.headers["etag"] == etag
+
+
+def test_304_repeats_the_page_headers(client, make_dir, monkeypatch):
+    monkeypatch.setattr(purge, "CACHE_TAGS", True)
+    make_dir("etag_headers", "/css = site.css\n/include = nav.html\n",
+             **{"site.css": "body {}", "nav.html": "<nav></nav>"})
+    r = client.get("/etag_headers/")
+    assert r.headers["link"] and r.headers["cache-tag"]
+    expected = {name: r.headers[name] for name in
+                ("etag", "cache-control", "link", "cache-tag", "surrogate-key")}
+    for evicted in (False, True):
+        if evicted:
+            RENDER_CACHE.clear()
+        again = client.get("/etag_headers/", headers={"if-none-match": r.headers["etag"]})
+        assert again.status_code == 304
+        assert {name: again.headers.get(name) for name in expected} == expected
+
+
+def test_etag_is_stable(client, make_dir):
+    make_dir("etag_stable", "/title = Stable\n")
+    assert (client.get("/etag_stable/").headers["etag"]
+            == client.get("/etag_stable/").headers["etag"])
+
+
+def test_index_ini_edit_invalidates(client, make_dir):
+    d = make_dir("etag_ini", "/title = Old title\n")
+    etag = client.get("/etag_ini/").headers["etag"]
+    (d / "index.ini").write_text("/title = New title\n")
+    r = client.get("/etag_ini/", headers={"if-none-match": etag})
+    assert r.status_code == 200
+    assert "New title" in r.text
+
+
+def test_ancestor_index_ini_edit_invalidates(client, make_dir, settle):
+    d = make_dir("etag_parent", "/css = /a.css\n")
+    (d / "child").mkdir()
+    settle(d / "child")
+    etag = client.get("/etag_parent/child/").headers["etag"]
+    (d / "index.ini").write_text("/css = /b.css\n")
+    settle(d / "index.ini", mtime=1_600_000_000)
+    r = client.get("/etag_parent/child/", headers={"if-none-match": etag})
+    assert r.status_code == 200
+    assert "/b.css" in r.text
+    assert r.headers["etag"] != etag
+
+
+def test_new_file_invalidates(client, make_dir):
+    d = make_dir("etag_listing", "")
+    etag = client.get("/etag_listing/").headers["etag"]
+    (d / "new.txt").write_text("new")
+    r = client.get("/etag_listing/", headers={"if-none-match": etag})
+    assert r.status_code == 200
+    assert "new.txt" in r.text
+
+
+def test_include_fragment_edit_invalidates(client, make_dir, settle):
+    d = make_dir("etag_include", "/include = nav.html\n",
+                 **{"nav.html": "<nav>one</nav>"})
+    etag = client.get("/etag_include/").headers["etag"]
+    (d / "nav.html").write_text("<nav>two</nav>")
+    settle(d / "nav.html", mtime=1_600_000_000)
+    r = client.get("/etag_include/", headers={"if-none-match": etag})
+    assert r.status_code == 200
+    assert "<nav>two</nav>" in r.text
+
+
+def test_template_query_params_are_inputs(client, make_dir):
+    make_dir("etag_query", "/images =\n/template = sequence.html\n",
+             **{"a.jpg": "a", "b.jpg": "b"})
+    first = client.get("/etag_query/?index=0").headers["etag"]
+    second = client.get("/etag_query/?index=1").headers["etag"]
+    assert first != second
+    # Parameters no template reads don't fragment the cache.
+    assert client.get("/etag_query/?index=0&utm=x").headers["etag"] == first
+
+
+def test_racy_inputs_get_no_etag(client, site_root):
+    d = site_root / "etag_racy"
+    d.mkdir()
+    (d / "index.ini").write_text("/title = Fresh\n")
+    r = client.get("/etag_racy/")
+    assert r.status_code == 200
+    assert "etag" not in r.headers
@@ -0,0 +1,131 @@
+"""Tests for the one-stat file fast path in ``serve_file``.
+
+Spec: a plain file request makes exactly one ``stat`` call, whose result
+answers existence, directory detection, ETag, Last-Modified, Content-Length
+and the 304 decision — FileResponse does not stat again. Resolving symlinks
+adds one ``lstat`` per path component (``Path.resolve()``); while a watcher
+covers the tree the directory prefixes are memoized, leaving one ``lstat`` of
+the file itself. Text types (CSS, JS, ...) may have a precompressed sibling:
+once a file is known to have none, that costs one stat of its directory
+(none under the watcher). A path already known to be missing costs one stat
+of its directory instead. Anything but a regular file or a directory (a
+FIFO, a device) is a 404, without being opened.
+"""
+
+import hashlib
+import os
+import pathlib
+
+import pytest
+
+from k0sngin import cache, links
+
+
+@pytest.fixture
+def stat_calls(monkeypatch):
+    """Record every os.stat/os.fstat call (its path or descriptor) and
+    os.lstat call (``("lstat", path)``)."""
+    calls = []
+    real_stat, real_lstat, real_fstat = os.stat, os.lstat, os.fstat
+
+    def counting_stat(path, *args, **kwargs):
+        calls.append(os.fspath(path))
+        return real_stat(path, *args, **kwargs)
+
+    def counting_lstat(path, *args, **kwargs):
+        calls.append(("lstat", os.fspath(path)))
+        return real_lstat(path, *args, **kwargs)
+
+    def counting_fstat(fd):
+        calls.append(fd)
+        return real_fstat(fd)
+
+    monkeypatch.setattr(os, "stat", counting_stat)
+    monkeypatch.setattr(os, "lstat", counting_lstat)
+    monkeypatch.setattr(os, "fstat", counting_fstat)
+    return calls
+
+
+def resolve_lstats(path: pathlib.Path) -> list:
+    """The lstats ``Path.resolve()`` makes of a path without symlinks."""
+    return [("lstat", str(p)) for p in [*reversed(path.parents[:-1]), path]]
+
+
+def test_file_request_stats_once(client, site_root, stat_calls):
+    (site_root / "fast_path.png").write_bytes(b"png bytes")
+    client.get("/fast_path.png")  # warm up: lazy imports stat their sources
+    stat_calls.clear()
+    r = client.get("/fast_path.png")
+    assert r.status_code == 200
+    assert r.content == b"png bytes"
+    assert r.headers["content-length"] == "9"
+    assert r.headers["etag"] and r.headers["last-modified"]
+    path = site_root / "fast_path.png"
+    assert stat_calls == [*resolve_lstats(path), str(path)]
+
+
+def test_text_file_request_stats_its_directory(client, site_root, stat_calls, settle):
+    """Text may have a precompressed sibling: once none is found, a repeat
+    request costs one stat of the directory instead of the siblings."""
+    d = site_root / "fast_path_text"
+    d.mkdir()
+    (d / "style.css").write_text("body {}\n" * 10_000)  # too large for memory
+    settle(d / "style.css", d)
+    client.get("/fast_path_text/style.css", headers={"accept-encoding": "gzip"})
+    stat_calls.clear()
+    r = client.get("/fast_path_text/style.css", headers={"accept-encoding": "gzip"})
+    assert r.status_code == 200
+    path = d / "style.css"
+    assert stat_calls == [*resolve_lstats(path), str(d), str(path)]
+
+
+def test_watched_file_request_lstats_once(client, site_root, stat_calls, monkeypatch):
+    """With the directory prefixes memoized, resolving costs one lstat."""
+    monkeypatch.setattr(cache, "covered", lambda path: True)  # as under the watcher
+    path = site_root / "fast_path_watched.png"
+    path.write_bytes(b"png bytes")
+    try:
+        client.get("/fast_path_watched.png")  # memoizes the prefixes
+        stat_calls.clear()
+        assert client.get("/fast_path_watched.png").status_code == 200
+        assert stat_calls == [("lstat", str(path)), str(path)]
+    finally:
+        links.RESOLVER.invalidate(None, True)
+
+
+def test_not_modified_stats_once(client, site_root, stat_calls):
+    (site_root / "fast_path_304.png").write_bytes(b"png bytes")
+    etag = client.get("/fast_path_304.png").headers["etag"]
+    stat_calls.clear()
+    r = client.get("/fast_path_304.png", headers={"if-none-match": etag})
+    assert r.status_code == 304
+    path = site_root / "fast_path_304.png"
+    assert stat_calls == [*resolve_lstats(path), str(path)]
+
+
+def test_missing_file_stats_once(client, site_root, stat_calls, settle):
+    """A repeated miss is answered from the negative cache: one stat of the
+    directory it would be in, and none of the path itself."""
+    settle(site_root)  # cacheable
+    assert client.get("/fast_path_missing.png").status_code == 404
+    stat_calls.clear()
+    assert client.get("/fast_path_missing.png").status_code == 404
+    assert stat_calls == [str(site_root)]
+
+
+def test_etag_matches_starlette_formula(client, site_root):
+    """The memoized validators are the ones FileResponse has always sent."""
+    path = site_root / "fast_path_etag.png"
+    path.write_bytes(b"png")
+    st = path.stat()
+    expected = hashlib.md5(f"{st.st_mtime}-{st.st_size}".encode()).hexdigest()
+    assert client.get("/fast_path_etag.png").headers["etag"] == f'"{expected}"'
+
+
+def test_special_file_is_not_found(client, site_root):
+    fifo = site_root / "fast_path.fifo"
+    os.mkfifo(fifo)
+    try:
+        assert client.get("/fast_path.fifo").status_code == 404
+    finally:
+        fifo.unlink()
@@ -0,0 +1,90 @@
+"""Tests for fingerprinted asset URLs (``fingerprint.py``).
+
+Spec: with ``K0SNGIN_FINGERPRINT`` on, ``/css`` and ``/icon`` URLs of served
+files are rewritten to ``url?v=<content hash>``; a request carrying the
+current hash is served ``public, max-age=31536000, immutable``, any other
+the normal policy. Only hashes a page has linked to are honored; a request
+never makes the server hash a file. Editing the asset changes the URL on the (re-rendered)
+page. Other sites, missing files and paths outside the tree are untouched.
+"""
+
+import hashlib
+
+import pytest
+
+from k0sngin import fingerprint
+from k0sngin.fingerprint import IMMUTABLE_CACHE_CONTROL, fingerprint_url
+
+
+@pytest.fixture
+def fingerprinting(monkeypatch):
+    monkeypatch.setattr(fingerprint, "FINGERPRINT", True)
+
+
+def content_hash(path):
+    return hashlib.sha256(path.read_bytes()).hexdigest()[:fingerprint.HASH_LENGTH]
+
+
+@pytest.fixture
+def site(site_root, settle):
+    d = site_root / "fp"
+    d.mkdir(exist_ok=True)
+    (d / "style.css").write_text("body { color: teal; }\n")
+    (d / "icon.png").write_bytes(b"icon")
+    (d / "index.ini").write_text(
+        "/css = style.css https://cdn.example/x.css missing.css\n/icon = /fp/icon.png\n")
+    settle(d / "style.css", d / "icon.png", d / "index.ini", d)
+    return d
+
+
+def test_page_links_to_hashed_urls(client, site, fingerprinting):
+    html = client.get("/fp/").text
+    assert f'href="style.css?v={content_hash(site / "style.css")}"' in html
+    assert f'href="/fp/icon.png?v={content_hash(site / "icon.png")}"' in html
+    assert 'href="https://cdn.example/x.css"' in html
+    assert 'href="missing.css"' in html
+
+
+def test_matching_hash_is_immutable(client, site, fingerprinting):
+    digest = content_hash(site / "style.css")
+    client.get("/fp/")  # the page links to it
+    r = client.get(f"/fp/style.css?v={digest}")
+    assert r.headers["cache-control"] == IMMUTABLE_CACHE_CONTROL
+    assert r.text == "body { color: teal; }\n"
+    for url in ("/fp/style.css", "/fp/style.css?v=0123456789abcdef"):
+        assert client.get(url).headers["cache-control"] != IMMUTABLE_CACHE_CONTROL
+
+
+def test_unlinked_file_is_not_hashed(client, site, fingerprinting, monkeypatch, settle):
+    big = site / "big.bin"
+    big.write_bytes(b"x" * (4 * 1024 * 1024))
+    settle(big)
+    hashed = []
+    monkeypatch.setattr(fingerprint, "file_digest", lambda *args: hashed.append(args))
+    for v in ("x", content_hash(big)):
+        r = client.get(f"/fp/big.bin?v={v}")
+        assert r.status_code == 200
+        assert r.headers["cache-control"] != IMMUTABLE_CACHE_CONTROL
+    assert hashed == []
+
+
+def test_edit_changes_the_url(client, site, fingerprinting, settle):
+    old = content_hash(site / "style.css")
+    assert f"v={old}" in client.get("/fp/").text
+    (site / "style.css").write_text("body { color: navy; }\n")
+    settle(site / "style.css", mtime=1_500_000_100)
+    html = client.get("/fp/").text
+    assert f"v={content_hash(site / 'style.css')}" in html
+    assert f"v={old}" not in html
+    r = client.get(f"/fp/style.css?v={old}")
+    assert r.headers["cache-control"] != IMMUTABLE_CACHE_CONTROL
+
+
+def test_off_by_default(client, site):
+    assert 'href="style.css"' in client.get("/fp/").text
+
+
+def test_urls_outside_the_tree_are_untouched(site, fingerprinting):
+    assert fingerprint_url("../../secret.txt", site) == "../../secret.txt"
+    assert fingerprint_url("style.css?x=1", site) == "style.css?x=1"
+    assert fingerprint_url("//cdn.example/style.css", site) == "//cdn.example/style.css"
@@ -0,0 +1,104 @@
+"""Tests for the memoized cascading-formatter trie (``directory.FormatterTree``).
+
+Spec: each directory's merged cascading formatters are derived from its
+parent's memo; a child's index.ini overrides its ancestors' at any depth
+(docs/formatters.md). Editing an index.ini invalidates exactly the subtree
+below it — sibling subtrees keep their memos. Reading an index.ini holds up
+only the lookups that need it.
+"""
+
+import threading
+
+import pytest
+
+from k0sngin import directory
+from k0sngin.directory import FormatterTree
+
+
+@pytest.fixture
+def tree(tmp_path, settle):
+    """root{css=root.css} / a{css=a.css} / a/deep ; root / b"""
+    (tmp_path / "index.ini").write_text("/css = root.css\n/title = Root\n")
+    (tmp_path / "a" / "deep").mkdir(parents=True)
+    (tmp_path / "a" / "index.ini").write_text("/css = a.css\n/all =\n")
+    (tmp_path / "b").mkdir()
+    settle(tmp_path / "index.ini", tmp_path / "a" / "index.ini")  # memoizable
+    return FormatterTree(tmp_path)
+
+
+def test_child_overrides_ancestors_at_any_depth(tmp_path, tree):
+    assert tree.lookup(tmp_path / "a" / "deep") == {"css": "a.css", "title": "Root"}
+    assert tree.lookup(tmp_path / "b") == {"css": "root.css", "title": "Root"}
+
+
+def test_local_only_directives_do_not_cascade(tmp_path, tree):
+    assert "all" not in tree.lookup(tmp_path / "a")
+
+
+def test_outside_root_cascades_nothing(tmp_path):
+    tree = FormatterTree(tmp_path / "site")
+    assert tree.lookup(tmp_path) == {}
+
+
+def test_repeat_lookup_reuses_memo(tmp_path, tree):
+    first = tree.lookup(tmp_path / "a" / "deep")
+    assert tree.lookup(tmp_path / "a" / "deep") is first
+
+
+def test_racy_index_ini_is_not_memoized(tmp_path, tree):
+    """A just-written index.ini may change again within the same mtime tick,
+    so its memo is rebuilt until it settles."""
+    (tmp_path / "b" / "index.ini").write_text("/title = Fresh\n")
+    first = tree.lookup(tmp_path / "b")
+    assert first["title"] == "Fresh"
+    assert tree.lookup(tmp_path / "b") is not first
+
+
+def test_edit_invalidates_only_that_subtree(tmp_path, tree):
+    deep = tree.lookup(tmp_path / "a" / "deep")
+    sibling = tree.lookup(tmp_path / "b")
+    (tmp_path / "a" / "index.ini").write_text("/css = a-edited-stylesheet.css\n")
+    assert tree.lookup(tmp_path / "a" / "deep")["css"] == "a-edited-stylesheet.css"
+    assert tree.lookup(tmp_path / "a" / "deep") is not deep
+    assert tree.lookup(tmp_path / "b") is sibling
+
+
+def test_root_edit_reaches_every_descendant(tmp_path, tree):
+    tree.lookup(tmp_path / "a" / "deep")
+    (tmp_path / "index.ini").write_text("/title = A New Root Title\n")
+    assert tree.lookup(tmp_path / "a" / "deep") == {
+        "css": "a.css", "title": "A New Root Title"}
+
+
+def test_explicit_invalidate(tmp_path, tree):
+    deep = tree.lookup(tmp_path / "a" / "deep")
+    tree.invalidate(tmp_path / "a")
+    assert tree.lookup(tmp_path / "a" / "deep") == deep
+    assert tree.lookup(tmp_path / "a" / "deep") is not deep
+
+
+def test_slow_index_ini_blocks_only_its_lookups(tmp_path, tree, monkeypatch):
+    tree.lookup(tmp_path / "b")
+    (tmp_path / "a" / "index.ini").write_text("/css = slow.css\n")
+    reading, release = threading.Event(), threading.Event()
+    real_load = directory.load_index_conf
+
+    def slow_load(path, *args):
+        if path == tmp_path / "a" / "index.ini":
+            reading.set()
+            release.wait(5)
+        return real_load(path, *args)
+
+    monkeypatch.setattr(directory, "load_index_conf", slow_load)
+    slow = threading.Thread(target=tree.lookup, args=(tmp_path / "a" / "deep",))
+    slow.start()
+    try:
+        assert reading.wait(5)
+        other = threading.Thread(target=tree.lookup, args=(tmp_path / "b",))
+        other.start()
+        other.join(1)
+        assert not other.is_alive()  # not queued behind the slow read
+    finally:
+        release.set()
+        slow.join()
+    assert tree.lookup(tmp_path / "a" / "deep")["css"] == "slow.css"
@@ -0,0 +1,73 @@
+"""Tests for the stat-keyed index.ini parse cache (``directory.INDEX_CONF_CACHE``).
+
+Spec: parsed ``index.ini`` files are cached process-wide, keyed by
+(path, st_ino, st_mtime_ns, st_size). A repeat request re-uses the parse
+(one stat, no open/read/parse); any edit changes the key, so the next request
+sees the new contents. A file that fails to parse is cached the same way:
+its error is printed once and raised again without a re-read. Files modified
+within the racy window (``cache.RACY_WINDOW_NS``) are not cached yet.
+"""
+
+import os
+
+import pytest
+
+from k0sngin import directory
+from k0sngin.directory import INDEX_CONF_CACHE, load_index_conf
+
+
+def test_load_index_conf_caches_by_stat(tmp_path, monkeypatch):
+    """A second load of an unchanged file is a cache hit (no re-parse)."""
+    ini = tmp_path / "index.ini"
+    ini.write_text("/title = Cached\nfoo.txt = foo\n")
+    os.utime(ini, (1_000_000_000, 1_000_000_000))
+    parses = []
+    real_parse = directory.parse_index_conf
+    monkeypatch.setattr(directory, "parse_index_conf",
+                        lambda path: parses.append(path) or real_parse(path))
+
+    first = load_index_conf(ini)
+    hits = INDEX_CONF_CACHE.hits
+    second = load_index_conf(ini)
+    assert second is first
+    assert INDEX_CONF_CACHE.hits == hits + 1
+    assert len(parses) == 1
+    assert first["formatters"] == {"title": "Cached"}
+
+
+def test_parse_failure_is_cached(tmp_path, monkeypatch, capsys):
+    """A malformed file is parsed (and its error printed) once per edit."""
+    ini = tmp_path / "index.ini"
+    ini.write_text("/ = no key\n")
+    os.utime(ini, (1_000_000_000, 1_000_000_000))
+    parses = []
+    real_parse = directory.parse_index_conf
+    monkeypatch.setattr(directory, "parse_index_conf",
+                        lambda path: parses.append(path) or real_parse(path))
+
+    for _ in range(3):
+        with pytest.raises(ValueError, match="Empty key"):
+            load_index_conf(ini)
+    assert len(parses) == 1
+    assert capsys.readouterr().out.count("not parsed") == 1
+
+    ini.write_text("/title = Fixed\n")
+    os.utime(ini, (1_000_000_100, 1_000_000_100))
+    assert load_index_conf(ini)["formatters"] == {"title": "Fixed"}
+
+
+def test_load_index_conf_missing_is_none(tmp_path):
+    assert load_index_conf(tmp_path / "index.ini") is None
+
+
+def test_edited_index_ini_is_reparsed(client, site_root):
+    """An edit to index.ini shows up on the next request."""
+    d = site_root / "idx_cache_edit"
+    d.mkdir()
+    (d / "a.txt").write_text("a\n")
+    (d / "index.ini").write_text("/title = Before\n")
+    assert "Before" in client.get("/idx_cache_edit/").text
+    (d / "index.ini").write_text("/title = After the edit\n")
+    html = client.get("/idx_cache_edit/").text
+    assert "After the edit" in html
+    assert "Before" not in html
@@ -8,8 +8,14 @@ nested symlink leading outside every allowed root.
 
 import json
 import pathlib
+import sys
+import time
 
-from k0sngin.links import load_link_targets
+import pytest
+
+from k0sngin import links
+from k0sngin.links import PathResolver, load_link_targets
+from k0sngin.watcher import Watcher
 
 
 # --- serving through the allowlist -----------------------------------------
@@ -103,3 +109,81 @@ def test_load_link_targets_relative_value_disables(tmp_path):
     links.write_text(json.dumps(
         {"~jhammel/web/site/a": "~no-such-user-xyzzy/docs/a"}))
     assert load_link_targets(links) == []
+
+
+# --- is_allowed / PathResolver ----------------------------------------------
+
+def test_root_table_matches_whole_components(tmp_path):
+    """A root matches by path component, never by string prefix."""
+    table = links.root_table([tmp_path / "ext"])
+    original = links.ALLOWED_ROOTS
+    links.ALLOWED_ROOTS = table
+    try:
+        assert links.is_allowed(tmp_path / "ext")
+        assert links.is_allowed(tmp_path / "ext" / "a" / "b.txt")
+        assert not links.is_allowed(tmp_path / "external" / "b.txt")
+        assert not links.is_allowed(tmp_path)
+    finally:
+        links.ALLOWED_ROOTS = original
+
+
+def _watched_tree(tmp_path):
+    """site/{real/, link -> ../ext, twohop -> link/deep}; ext/deep/"""
+    site = tmp_path / "site"
+    (site / "real" / "sub").mkdir(parents=True)
+    (tmp_path / "ext" / "deep").mkdir(parents=True)
+    (site / "link").symlink_to(tmp_path / "ext")
+    (site / "twohop").symlink_to(site / "link" / "deep")
+    watcher = Watcher([site, tmp_path / "ext"])
+    return site, watcher
+
+
+linux_only = pytest.mark.skipif(not sys.platform.startswith("linux"),
+                                reason="inotify is Linux-only")
+
+
+@linux_only
+def test_resolver_matches_path_resolve(tmp_path):
+    site, watcher = _watched_tree(tmp_path)
+    resolver = PathResolver(site)
+    if not watcher.start():
+        pytest.skip("inotify unavailable")
+    try:
+        for relative in ["real/sub/f.txt", "real/sub", "link/deep/f.txt",
+                         "twohop/f.txt", "missing/f.txt", "link"]:
+            path = site / relative
+            for _ in range(2):  # cold, then cached
+                assert resolver.resolve(path) == path.resolve()
+        assert str(site / "real" / "sub") in resolver._cache
+        assert str(site / "link" / "deep") in resolver._cache
+        # Two hops (twohop -> link/deep -> ext/deep): not every link is watched.
+        assert str(site / "twohop") not in resolver._cache
+    finally:
+        watcher.stop()
+
+
+@linux_only
+def test_resolver_sees_symlink_swap(tmp_path):
+    """Replacing a cached directory with a symlink elsewhere is picked up."""
+    site, watcher = _watched_tree(tmp_path)
+    resolver = PathResolver(site)
+    if not watcher.start():
+        pytest.skip("inotify unavailable")
+    try:
+        path = site / "real" / "sub" / "f.txt"
+        assert resolver.resolve(path) == path
+        (site / "real" / "sub").rename(site / "moved")
+        (site / "real" / "sub").symlink_to(tmp_path / "ext" / "deep")
+        deadline = time.monotonic() + 5
+        while str(site / "real" / "sub") in resolver._cache and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert resolver.resolve(path) == tmp_path / "ext" / "deep" / "f.txt"
+    finally:
+        watcher.stop()
+
+
+def test_resolver_without_watcher_is_path_resolve(tmp_path):
+    site, _ = _watched_tree(tmp_path)
+    resolver = PathResolver(site)
+    assert resolver.resolve(site / "link" / "x") == (tmp_path / "ext" / "x").resolve()
+    assert resolver._cache == {}
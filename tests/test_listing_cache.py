@@ -0,0 +1,50 @@
+"""Tests for the scandir-based directory listing (``directory.list_directory``).
+
+Spec: one ``os.scandir`` pass yields name, type (from ``d_type``), size and
+mtime per entry. Listings are cached by the directory's own stat signature,
+so an unchanged directory is never re-enumerated, while adding or removing
+an entry (which bumps the directory's mtime) shows up immediately.
+"""
+
+from k0sngin import directory
+from k0sngin.directory import list_directory
+
+
+def test_listing_metadata(tmp_path):
+    (tmp_path / "a.txt").write_text("12345")
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "dangling").symlink_to(tmp_path / "nowhere")
+    entries = list_directory(tmp_path)
+    assert entries["a.txt"]["type"] == "file"
+    assert entries["a.txt"]["size"] == 5
+    assert entries["a.txt"]["mtime"] == (tmp_path / "a.txt").stat().st_mtime
+    assert entries["sub"]["type"] == "directory"
+    assert entries["dangling"] == {
+        "name": "dangling", "type": None, "size": None, "mtime": None}
+
+
+def test_unchanged_directory_is_not_rescanned(tmp_path, monkeypatch, settle):
+    (tmp_path / "a.txt").write_text("a")
+    settle(tmp_path)
+    first = list_directory(tmp_path)
+    monkeypatch.setattr(directory.os, "scandir", None)  # any rescan would fail
+    assert list_directory(tmp_path) is first
+
+
+def test_new_entry_invalidates_listing(tmp_path, settle):
+    (tmp_path / "a.txt").write_text("a")
+    settle(tmp_path)
+    assert set(list_directory(tmp_path)) == {"a.txt"}
+    (tmp_path / "b.txt").write_text("b")
+    assert set(list_directory(tmp_path)) == {"a.txt", "b.txt"}
+
+
+def test_formatters_do_not_mutate_cached_listing(client, site_root, settle):
+    """Gallery annotations (link/src) stay out of the shared listing."""
+    d = site_root / "listing_copy"
+    d.mkdir()
+    (d / "a.jpg").write_bytes(b"stub")
+    (d / "index.ini").write_text("/images =\n/template = strip.html\n")
+    settle(d)
+    assert client.get("/listing_copy/").status_code == 200
+    assert "src" not in list_directory(d)["a.jpg"]
@@ -0,0 +1,65 @@
+"""Tests for the negative-lookup cache (``MISSING_PATHS`` in main.py).
+
+Spec: a path that was just missing is answered with a 404 without resolving
+or stat'ing it, as long as its nearest existing ancestor is unchanged.
+Creating the path — or a missing directory on the way to it — changes that
+ancestor and serves the new file at once. Hits are counted.
+"""
+
+import time
+
+import pytest
+
+from k0sngin import main
+
+
+@pytest.fixture
+def probes(site_root, settle):
+    d = site_root / "probes"
+    d.mkdir(exist_ok=True)
+    settle(d)
+    return d
+
+
+@pytest.fixture
+def resolve_calls(monkeypatch):
+    calls = []
+    real_resolve = main.resolve
+
+    def counting_resolve(path):
+        calls.append(path)
+        return real_resolve(path)
+
+    monkeypatch.setattr(main, "resolve", counting_resolve)
+    return calls
+
+
+def test_repeated_miss_skips_resolve(client, probes, resolve_calls):
+    hits = main.MISSING_PATHS.stats()["hits"]
+    assert client.get("/probes/.env").status_code == 404
+    assert len(resolve_calls) == 1
+    assert client.get("/probes/.env").status_code == 404
+    assert len(resolve_calls) == 1
+    assert main.MISSING_PATHS.stats()["hits"] == hits + 1
+
+
+def test_created_file_is_served(client, probes):
+    assert client.get("/probes/late.txt").status_code == 404
+    (probes / "late.txt").write_text("here now\n")
+    r = client.get("/probes/late.txt")
+    assert r.status_code == 200
+    assert r.text == "here now\n"
+
+
+def test_missing_directory_uses_nearest_ancestor(client, probes):
+    assert client.get("/probes/wp-admin/setup.php").status_code == 404
+    assert main.MISSING_PATHS.get("probes/wp-admin/setup.php")[0] == str(probes)
+    (probes / "wp-admin").mkdir()
+    (probes / "wp-admin" / "setup.php").write_text("<?php\n")
+    assert client.get("/probes/wp-admin/setup.php").status_code == 200
+
+
+def test_unsettled_directory_not_cached(client, probes, settle):
+    settle(probes, mtime=time.time())  # just modified: racy
+    assert client.get("/probes/phpmyadmin").status_code == 404
+    assert "probes/phpmyadmin" not in main.MISSING_PATHS
@@ -0,0 +1,93 @@
+"""Tests for file-body offload to the front proxy (``offload.py``).
+
+Spec: with ``K0SNGIN_OFFLOAD`` set, a file request that passes the security
+checks and isn't answered with a 304 gets an empty response carrying the
+offload header (``X-Accel-Redirect`` location or ``X-Sendfile`` path, mapped
+from the file's real path by ``K0SNGIN_OFFLOAD_MAP``) plus the usual
+Cache-Control and Content-Disposition. Refused paths stay 404; unmapped
+files are served directly. Bad settings disable offload.
+"""
+
+import json
+
+import pytest
+
+from k0sngin import main, offload
+from k0sngin.offload import load_offload
+
+
+@pytest.fixture
+def accel(monkeypatch, site_root, tmp_path):
+    """Offload the served tree (only) to an nginx internal location."""
+    map_file = tmp_path / "offload.json"
+    map_file.write_text(json.dumps({str(site_root): "/_k0sngin/site"}))
+    header, mapping = load_offload("X-Accel-Redirect", map_file)
+    monkeypatch.setattr(offload, "OFFLOAD_HEADER", header)
+    monkeypatch.setattr(offload, "OFFLOAD_MAP", mapping)
+    monkeypatch.setattr(main, "OFFLOAD_HEADER", header)
+
+
+def test_file_is_offloaded(client, accel):
+    r = client.get("/hello.txt")
+    assert r.status_code == 200
+    assert r.content == b""
+    assert r.headers["x-accel-redirect"] == "/_k0sngin/site/hello.txt"
+    assert r.headers["content-disposition"] == 'inline; filename="hello.txt"'
+    assert r.headers["cache-control"] == "no-cache"
+    assert r.headers["content-type"].startswith("text/plain")
+
+
+def test_location_is_uri_escaped(client, site_root, accel):
+    (site_root / "offload me.txt").write_text("spaced\n")
+    r = client.get("/offload%20me.txt")
+    assert r.headers["x-accel-redirect"] == "/_k0sngin/site/offload%20me.txt"
+
+
+def test_not_modified_and_refusals_stay_in_python(client, accel):
+    etag = main.file_etag((main.TOP_LEVEL_DIR / "hello.txt").stat())
+    r = client.get("/hello.txt", headers={"if-none-match": etag})
+    assert r.status_code == 304
+    assert "x-accel-redirect" not in r.headers
+    assert client.get("/unlisted/nope.txt").status_code == 404
+    assert client.get("/missing.txt").status_code == 404
+
+
+def test_unmapped_file_is_served_directly(client, accel):
+    # linked/ resolves outside the mapped tree.
+    r = client.get("/linked/poem.txt")
+    assert r.text == "external poem\n"
+    assert "x-accel-redirect" not in r.headers
+
+
+def test_directories_are_rendered(client, accel):
+    r = client.get("/docs/")
+    assert r.status_code == 200
+    assert "x-accel-redirect" not in r.headers
+
+
+def test_load_offload_settings(tmp_path, site_root):
+    assert load_offload("", None) == (None, [])
+    assert load_offload("X-Nope", None) == (None, [])
+    assert load_offload("X-Accel-Redirect", None) == (None, [])
+    assert load_offload("x-sendfile", None) == ("X-Sendfile", [("/", "/")])
+    bad = tmp_path / "bad.json"
+    bad.write_text('["not", "an", "object"]')
+    assert load_offload("X-Accel-Redirect", bad) == (None, [])
+    relative = tmp_path / "relative.json"
+    relative.write_text('{"srv/site": "/x"}')
+    assert load_offload("X-Accel-Redirect", relative) == (None, [])
+    nested = tmp_path / "nested.json"
+    nested.write_text(json.dumps({str(site_root): "/outer", str(site_root / "docs"): "/inner/"}))
+    header, mapping = load_offload("X-Accel-Redirect", nested)
+    assert mapping[0] == (str(site_root / "docs") + "/", "/inner/")
+
+
+def test_sendfile_header_is_the_path(client, site_root, monkeypatch):
+    header, mapping = load_offload("X-Sendfile", None)
+    monkeypatch.setattr(offload, "OFFLOAD_HEADER", header)
+    monkeypatch.setattr(offload, "OFFLOAD_MAP", mapping)
+    monkeypatch.setattr(main, "OFFLOAD_HEADER", header)
+    (site_root / "offload sendfile.txt").write_text("x\n")
+    r = client.get("/offload%20sendfile.txt")
+    assert r.headers["x-sendfile"] == str(site_root / "offload sendfile.txt")
+    assert r.content == b""
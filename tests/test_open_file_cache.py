@@ -0,0 +1,123 @@
+"""Tests for the open-file cache (``filecache.OPEN_FILES``).
+
+Spec: with the cache enabled, a repeat request for a file is served from the
+already-open descriptor — no ``open()`` — with headers identical to the
+uncached response. Each hit is revalidated with ``fstat``: in-place edits,
+deletions and replacements are picked up on the next request. Descriptors are
+reference counted, so eviction never closes one a response is still reading.
+Descriptors unused for the inactive time are closed even if no other file
+is opened.
+"""
+
+import os
+import time
+
+import pytest
+
+from k0sngin import filecache
+from k0sngin.filecache import OpenFileCache
+
+
+@pytest.fixture
+def open_files(monkeypatch):
+    """Enable the process-wide cache for one test."""
+    monkeypatch.setattr(filecache.OPEN_FILES, "maxsize", 8)
+    yield filecache.OPEN_FILES
+    filecache.OPEN_FILES.invalidate(None, True)
+
+
+@pytest.fixture
+def opens(monkeypatch):
+    calls = []
+    real_open = os.open
+    monkeypatch.setattr(os, "open", lambda path, *args, **kwargs:
+                        calls.append(path) or real_open(path, *args, **kwargs))
+    return calls
+
+
+def test_hit_skips_open(client, site_root, open_files, opens):
+    (site_root / "ofc_hit.css").write_text("body {}")
+    uncached = client.get("/ofc_hit.css")
+    opens.clear()
+    hits = open_files.hits
+    r = client.get("/ofc_hit.css")
+    assert r.text == "body {}"
+    assert open_files.hits == hits + 1
+    assert opens == []
+    for header in ("etag", "last-modified", "content-length", "content-type",
+                   "content-disposition", "cache-control"):
+        assert r.headers[header] == uncached.headers[header]
+
+
+def test_in_place_edit_is_seen(client, site_root, open_files):
+    path = site_root / "ofc_edit.css"
+    path.write_text("a {}")
+    assert client.get("/ofc_edit.css").text == "a {}"
+    with open(path, "w") as f:
+        f.write("a { color: red }")
+    r = client.get("/ofc_edit.css")
+    assert r.text == "a { color: red }"
+    assert r.headers["content-length"] == str(len("a { color: red }"))
+
+
+def test_replacement_and_deletion_are_seen(client, site_root, open_files):
+    path = site_root / "ofc_replace.css"
+    path.write_text("old")
+    assert client.get("/ofc_replace.css").text == "old"
+    (site_root / "ofc_replace.tmp").write_text("new")
+    os.replace(site_root / "ofc_replace.tmp", path)
+    assert client.get("/ofc_replace.css").text == "new"
+    path.unlink()
+    assert client.get("/ofc_replace.css").status_code == 404
+
+
+def test_head_and_range_requests(client, site_root, open_files):
+    (site_root / "ofc_range.css").write_text("0123456789")
+    client.get("/ofc_range.css")
+    head = client.head("/ofc_range.css")
+    assert head.status_code == 200 and head.content == b""
+    r = client.get("/ofc_range.css", headers={"range": "bytes=2-4"})
+    assert r.status_code == 206
+    assert r.text == "234"
+
+
+def test_eviction_waits_for_readers(tmp_path):
+    """An evicted descriptor stays open until its last reader releases it."""
+    cache = OpenFileCache(maxsize=1)
+    a, b = tmp_path / "a", tmp_path / "b"
+    a.write_text("a")
+    b.write_text("b")
+    entry = cache.open(a, a.stat())
+    cache.open(b, b.stat()).release()  # evicts a
+    assert os.pread(entry.fd, 1, 0) == b"a"
+    entry.release()
+    with pytest.raises(OSError):
+        os.fstat(entry.fd)
+
+
+def test_inactive_entries_are_closed(tmp_path):
+    cache = OpenFileCache(maxsize=8, inactive=0)
+    a, b = tmp_path / "a", tmp_path / "b"
+    a.write_text("a")
+    b.write_text("b")
+    cache.open(a, a.stat()).release()
+    cache.open(b, b.stat()).release()
+    assert cache.acquire(a) is None
+
+
+def test_inactive_entries_expire_in_the_background(tmp_path):
+    cache = OpenFileCache(maxsize=8, inactive=0.05)
+    a = tmp_path / "a"
+    a.write_text("a")
+    entry = cache.open(a, a.stat())
+    entry.release()
+    cache.start()
+    try:
+        deadline = time.monotonic() + 5
+        while cache.stats()["entries"] and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        cache.stop()
+    assert cache.stats()["entries"] == 0
+    with pytest.raises(OSError):
+        os.fstat(entry.fd)
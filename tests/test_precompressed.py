@@ -0,0 +1,120 @@
+"""Tests for precompressed siblings (``precompressed.py``) and the
+``precompress`` CLI.
+
+Spec: a compressible file with a fresh ``name.br`` / ``name.gz`` sibling is
+served from the sibling to clients that accept the encoding, with
+Content-Encoding, ``Vary: Accept-Encoding`` and an ETag of its own; 304s
+work per representation. Stale siblings (older than the file) and refused
+encodings fall back to the file itself. A file without siblings is not
+looked for them again until its directory changes. The CLI writes missing
+or stale siblings and leaves fresh ones alone.
+"""
+
+import gzip
+import os
+
+from k0sngin.precompressed import accepted_encodings
+from k0sngin.scripts import precompress
+
+CSS = b"body { color: black; }\n" * 50
+
+
+def write(path, data, mtime):
+    path.write_bytes(data)
+    os.utime(path, (mtime, mtime))
+
+
+def test_accepted_encodings():
+    assert accepted_encodings("gzip, deflate, br") == ("br", "gzip")
+    assert accepted_encodings("gzip;q=1.0, br;q=0.5") == ("gzip", "br")
+    assert accepted_encodings("br;q=0, *") == ("zstd", "gzip")
+    assert accepted_encodings("identity") == ()
+
+
+def test_sibling_is_negotiated(client, site_root):
+    write(site_root / "pre.css", CSS, 1_500_000_000)
+    write(site_root / "pre.css.gz", gzip.compress(CSS), 1_500_000_100)
+    plain = client.get("/pre.css", headers={"accept-encoding": "identity"})
+    assert plain.content == CSS
+    assert "content-encoding" not in plain.headers
+    assert plain.headers["vary"] == "Accept-Encoding"
+
+    r = client.get("/pre.css", headers={"accept-encoding": "gzip, br"})
+    assert r.headers["content-encoding"] == "gzip"
+    assert r.headers["vary"] == "Accept-Encoding"
+    assert r.headers["content-type"].startswith("text/css")
+    assert r.headers["content-disposition"] == 'inline; filename="pre.css"'
+    assert r.content == CSS  # httpx decodes it
+    assert int(r.headers["content-length"]) == (site_root / "pre.css.gz").stat().st_size
+    assert r.headers["etag"].endswith('-gzip"')
+    assert r.headers["etag"] != plain.headers["etag"]
+
+    again = client.get("/pre.css", headers={"accept-encoding": "gzip",
+                                            "if-none-match": r.headers["etag"]})
+    assert again.status_code == 304
+    assert again.headers["vary"] == "Accept-Encoding"
+    other = client.get("/pre.css", headers={"accept-encoding": "identity",
+                                            "if-none-match": r.headers["etag"]})
+    assert other.status_code == 200
+
+
+def test_stale_sibling_is_ignored(client, site_root):
+    write(site_root / "stale.css", CSS, 1_500_000_100)
+    write(site_root / "stale.css.gz", gzip.compress(b"old"), 1_500_000_000)
+    r = client.get("/stale.css", headers={"accept-encoding": "gzip"})
+    assert not r.headers["etag"].endswith('-gzip"')
+    assert r.content == CSS
+
+
+def test_ranges_and_incompressible_types_skip_siblings(client, site_root):
+    write(site_root / "range.css", CSS, 1_500_000_000)
+    write(site_root / "range.css.gz", gzip.compress(CSS), 1_500_000_100)
+    r = client.get("/range.css", headers={"accept-encoding": "gzip", "range": "bytes=0-3"})
+    assert r.status_code == 206
+    assert r.content == CSS[:4]
+    write(site_root / "pre.png", b"png", 1_500_000_000)
+    write(site_root / "pre.png.gz", gzip.compress(b"png"), 1_500_000_100)
+    r = client.get("/pre.png", headers={"accept-encoding": "gzip"})
+    assert "content-encoding" not in r.headers
+    assert "vary" not in r.headers
+
+
+def test_missing_siblings_are_remembered(client, site_root, settle, monkeypatch):
+    d = site_root / "pre_none"
+    d.mkdir()
+    write(d / "plain.css", CSS, 1_500_000_000)
+    settle(d)
+    assert client.get("/pre_none/plain.css", headers={"accept-encoding": "gzip"}).content == CSS
+    stats = []
+    real_stat = os.stat
+    monkeypatch.setattr(os, "stat", lambda path, *args, **kwargs:
+                        stats.append(os.fspath(path)) or real_stat(path, *args, **kwargs))
+    assert client.get("/pre_none/plain.css", headers={"accept-encoding": "gzip"}).content == CSS
+    assert not [path for path in stats if path.endswith((".br", ".zst", ".gz"))]
+    write(d / "plain.css.gz", gzip.compress(CSS), 1_500_000_100)  # changes the directory
+    r = client.get("/pre_none/plain.css", headers={"accept-encoding": "gzip"})
+    assert r.headers["content-encoding"] == "gzip"
+
+
+def test_cli_refreshes_stale_siblings(tmp_path, capsys):
+    write(tmp_path / "a.css", CSS, 1_500_000_000)
+    write(tmp_path / "tiny.js", b"x", 1_500_000_000)
+    write(tmp_path / "b.png", CSS, 1_500_000_000)
+    (tmp_path / "sub").mkdir()
+    write(tmp_path / "sub" / "c.txt", CSS, 1_500_000_000)
+
+    precompress.main([str(tmp_path), "--encodings", "gzip", "-j", "1"])
+    assert gzip.decompress((tmp_path / "a.css.gz").read_bytes()) == CSS
+    assert (tmp_path / "sub" / "c.txt.gz").exists()
+    assert not (tmp_path / "tiny.js.gz").exists()
+    assert not (tmp_path / "b.png.gz").exists()
+    assert "2 file(s) refreshed" in capsys.readouterr().out
+
+    precompress.main([str(tmp_path), "--encodings", "gzip", "-j", "1"])
+    assert "0 file(s) refreshed" in capsys.readouterr().out
+
+    write(tmp_path / "a.css", CSS + b"/* edit */\n", 1_600_000_000)
+    os.utime(tmp_path / "a.css.gz", (1_500_000_000, 1_500_000_000))
+    precompress.main([str(tmp_path), "--encodings", "gzip", "-j", "1"])
+    assert "1 file(s) refreshed" in capsys.readouterr().out
+    assert gzip.decompress((tmp_path / "a.css.gz").read_bytes()).endswith(b"/* edit */\n")
@@ -0,0 +1,86 @@
+"""Tests for preload hints on directory pages (``hints.py``).
+
+Spec: a page's ``/css`` stylesheets, ``/icon`` and gallery lead image are
+announced in a ``Link: <url>; rel=preload`` header — also on pages served
+from the render cache — and, when the ASGI server offers the
+``http.response.early_hint`` extension, in a 103 sent before the response.
+"""
+
+import anyio
+import pytest
+
+from k0sngin.hints import EARLY_HINT
+from k0sngin.main import app
+
+
+@pytest.fixture
+def page(site_root, settle):
+    d = site_root / "preload"
+    d.mkdir(exist_ok=True)
+    (d / "index.ini").write_text("/css = /preload/site.css print.css\n/icon = fav icon.png\n")
+    (d / "site.css").write_text("body {}\n")
+    settle(d / "index.ini", d / "site.css", d)
+    return d
+
+
+EXPECTED = ("</preload/site.css>; rel=preload; as=style, "
+            "<print.css>; rel=preload; as=style, "
+            "<fav%20icon.png>; rel=preload; as=image")
+
+
+def test_link_header(client, page):
+    first = client.get("/preload/")
+    assert first.headers["link"] == EXPECTED
+    second = client.get("/preload/")  # from the render cache
+    assert second.headers["etag"] == first.headers["etag"]
+    assert second.headers["link"] == EXPECTED
+
+
+def test_gallery_lead_image(client, site_root):
+    d = site_root / "preload_gallery"
+    d.mkdir()
+    (d / "index.ini").write_text("/images = thumbnails\n")
+    (d / "notes.txt").write_text("not an image\n")
+    (d / "a.jpg").write_bytes(b"jpg")
+    (d / "thumbs").mkdir()
+    (d / "thumbs" / "thumb_a.jpg").write_bytes(b"thumb")
+    assert client.get("/preload_gallery/").headers["link"] == (
+        "<thumbs/thumb_a.jpg>; rel=preload; as=image")
+
+
+def test_plain_page_has_no_link(client):
+    assert "link" not in client.get("/docs/").headers
+
+
+def run(url, extensions):
+    path, _, query = url.partition("?")
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": "GET", "scheme": "http", "path": path, "raw_path": path.encode(),
+        "root_path": "", "query_string": query.encode(), "headers": [(b"host", b"testserver")],
+        "client": ("127.0.0.1", 1234), "server": ("testserver", 80),
+        "extensions": extensions,
+    }
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    anyio.run(app, scope, receive, send)
+    return messages
+
+
+def test_early_hints_before_the_response(page):
+    messages = run("/preload/?index=0", {EARLY_HINT: {}})
+    assert messages[0] == {"type": EARLY_HINT,
+                           "links": [link.encode() for link in EXPECTED.split(", ")]}
+    assert messages[1]["type"] == "http.response.start"
+    assert messages[1]["status"] == 200
+
+
+def test_no_early_hints_without_the_extension(page):
+    messages = run("/preload/?index=1", {})
+    assert messages[0]["type"] == "http.response.start"
@@ -0,0 +1,175 @@
+"""Tests for cache tags and the purge queue (``purge.py``).
+
+Spec: with ``K0SNGIN_CACHE_TAGS`` on, a file response carries
+``Cache-Tag: f:<url>`` (and the same tags space-separated in
+``Surrogate-Key``), a directory page ``d:<url>``, ``t:`` for it and each
+directory above, and ``f:`` of its ``/include`` fragment. Changes — reported
+by the watcher or found by an mtime scan — become the tags of the file and
+of its directory's page (of the whole subtree, for an ``index.ini``), and
+are POSTed to the purge endpoint as ``{"tags": [...]}`` in batches; a failed
+batch stays queued. Only the process holding the purge lock tracks changes.
+When the watcher loses events, every page is purged once and the tracker
+falls back to scanning.
+"""
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from k0sngin import purge
+from k0sngin.purge import ChangeTracker, PurgeQueue
+
+
+@pytest.fixture
+def endpoint():
+    """A local purge endpoint recording (headers, body) of every POST."""
+    received = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            received.append((dict(self.headers), json.loads(body)))
+            self.send_response(200)
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            self.wfile.write(b"{}")
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/purge", received
+    server.shutdown()
+    server.server_close()
+
+
+class RecordingQueue:
+    def __init__(self):
+        self.tags = set()
+
+    def add(self, tags):
+        self.tags.update(tags)
+
+
+def test_response_tags(client, site_root, monkeypatch, settle):
+    monkeypatch.setattr(purge, "CACHE_TAGS", True)
+    d = site_root / "tagged"
+    d.mkdir(exist_ok=True)
+    (d / "a b.png").write_bytes(b"png")
+    (d / "nav.html").write_text("<nav></nav>")
+    (d / "index.ini").write_text("/include = nav.html\n")
+    settle(d / "a b.png", d / "nav.html", d / "index.ini", d)
+    r = client.get("/tagged/a%20b.png")
+    assert r.headers["cache-tag"] == "f:/tagged/a%20b.png"
+    assert r.headers["surrogate-key"] == "f:/tagged/a%20b.png"
+    page_tags = "d:/tagged/,t:/,t:/tagged/,f:/tagged/nav.html"
+    assert client.get("/tagged/").headers["cache-tag"] == page_tags
+    assert client.get("/tagged/").headers["cache-tag"] == page_tags  # from the render cache
+
+
+def test_no_tags_by_default(client):
+    assert "cache-tag" not in client.get("/hello.txt").headers
+
+
+def test_queue_posts_batches(endpoint):
+    url, received = endpoint
+    queue = PurgeQueue(url, token="secret", batch=2, delay=60)
+    queue.add(["f:/a", "d:/"])
+    queue.add(["f:/b", "f:/a"])
+    assert queue.flush()
+    assert [body for _, body in received] == [{"tags": ["d:/", "f:/a"]}, {"tags": ["f:/b"]}]
+    assert received[0][0]["Authorization"] == "Bearer secret"
+    assert queue.stats()["purged"] == 3
+
+
+def test_queue_sends_after_delay(endpoint):
+    url, received = endpoint
+    queue = PurgeQueue(url, delay=0.01)
+    queue.add(["f:/late"])
+    for _ in range(200):
+        if received:
+            break
+        threading.Event().wait(0.01)
+    assert received[0][1] == {"tags": ["f:/late"]}
+
+
+def test_failed_batch_stays_queued():
+    queue = PurgeQueue("http://127.0.0.1:9/purge", delay=60, timeout=1)
+    queue.add(["f:/x"])
+    assert not queue.flush()
+    assert queue.stats()["pending"] == 1
+    queue.stop()
+
+
+def test_watcher_changes_to_tags(tmp_path):
+    queue = RecordingQueue()
+    tracker = ChangeTracker(queue, root=tmp_path)
+    (tmp_path / "docs").mkdir()
+    tracker.changed(str(tmp_path / "docs" / "style.css.gz"), False)
+    assert queue.tags == {"f:/docs/style.css.gz", "f:/docs/style.css", "d:/docs/"}
+    queue.tags.clear()
+    tracker.changed(str(tmp_path / "docs" / "index.ini"), False)
+    assert queue.tags == {"f:/docs/index.ini", "d:/docs/", "t:/docs/"}
+    queue.tags.clear()
+    tracker.changed(str(tmp_path / "docs"), False)  # its entries changed
+    tracker.changed("/elsewhere/file.txt", False)
+    assert queue.tags == {"d:/docs/"}
+
+
+def test_scan_finds_changes(tmp_path, settle):
+    queue = RecordingQueue()
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "photo.png").write_bytes(b"png")
+    (tmp_path / "old.txt").write_text("old")
+    tracker = ChangeTracker(queue, root=tmp_path)
+    assert tracker.scan() == 0  # the baseline
+    settle(tmp_path / "sub" / "photo.png", mtime=1_600_000_000)
+    (tmp_path / "old.txt").unlink()
+    assert tracker.scan() == 2
+    assert queue.tags == {"f:/sub/photo.png", "d:/sub/", "f:/old.txt", "d:/"}
+
+
+def test_one_process_tracks(tmp_path):
+    lock = str(tmp_path / "purge.lock")
+    first, second = RecordingQueue(), RecordingQueue()
+    leader = ChangeTracker(first, root=tmp_path, interval=3600, lock_path=lock)
+    follower = ChangeTracker(second, root=tmp_path, interval=3600, lock_path=lock)
+    leader.start(watching=True)
+    follower.start(watching=True)
+    try:
+        assert leader.leader and not follower.leader
+        for tracker in (leader, follower):
+            tracker.changed(str(tmp_path / "a.txt"), False)
+        assert first.tags == {"f:/a.txt", "d:/"}
+        assert second.tags == set()
+        leader.stop()
+        assert follower.lead()  # takes over
+    finally:
+        leader.stop()
+        follower.stop()
+
+
+def test_watcher_overflow_falls_back_to_scanning(tmp_path, settle):
+    queue = RecordingQueue()
+    (tmp_path / "a.txt").write_text("a")
+    tracker = ChangeTracker(queue, root=tmp_path, interval=3600)
+    tracker.start(watching=True)
+    try:
+        tracker.changed(None, True)  # cache.invalidate_all, after an overflow
+        assert not tracker.watching
+        assert queue.tags == {"t:/"}
+        deadline = time.monotonic() + 5
+        while tracker._snapshot is None and time.monotonic() < deadline:
+            time.sleep(0.01)  # the baseline scan, on the scan thread
+        assert tracker._snapshot is not None
+        queue.tags.clear()
+        settle(tmp_path / "a.txt", mtime=1_600_000_000)
+        assert tracker.scan() == 1
+        assert queue.tags == {"f:/a.txt", "d:/"}
+    finally:
+        tracker.stop()
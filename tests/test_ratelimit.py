@@ -0,0 +1,163 @@
+"""Tests for the sliding window rate limiter (``ratelimit.py``).
+
+Spec: at most ``limit`` requests per 60 s window per client, counting the
+previous window weighted by its remaining overlap; a refused request learns
+when the next one would be allowed (``Retry-After``). Memory is bounded:
+past ``max_keys`` clients the least recently seen is dropped, and idle
+clients are dropped as new ones arrive. Aggregation keys clients by IPv4
+/24 and IPv6 /64. With a shared file, every process mapping it counts
+against the same budget, in a table whose size depends only on ``max_keys``.
+Other settings use another table; a table is never resized or wiped.
+"""
+
+import multiprocessing
+import os
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from k0sngin.ratelimit import (RateLimitMiddleware, SharedWindowLimiter, SlidingWindowLimiter,
+                                make_limiter, network_key)
+
+
+def test_limit_within_a_window():
+    limiter = SlidingWindowLimiter(3)
+    assert [limiter.hit("a", now=t) for t in (0, 1, 2)] == [None, None, None]
+    assert limiter.hit("a", now=3) == pytest.approx(60 + 60 * (1 - 2 / 3) - 3)
+    assert limiter.hit("b", now=3) is None  # per key
+
+
+def test_previous_window_fades():
+    limiter = SlidingWindowLimiter(10)
+    for _ in range(10):
+        limiter.hit("a", now=0)
+    # 30 s into the next window, half of the previous 10 still count.
+    for _ in range(5):
+        assert limiter.hit("a", now=90) is None
+    retry = limiter.hit("a", now=90)
+    assert retry == pytest.approx(6)  # 10 * (1 - 36/60) + 5 + 1 <= 10
+    assert limiter.hit("a", now=90 + retry) is None
+
+
+def test_long_idle_resets():
+    limiter = SlidingWindowLimiter(1)
+    assert limiter.hit("a", now=0) is None
+    assert limiter.hit("a", now=1) is not None
+    assert limiter.hit("a", now=125) is None
+
+
+def test_key_cap_evicts_least_recently_seen():
+    limiter = SlidingWindowLimiter(1, max_keys=2)
+    limiter.hit("a", now=0)
+    limiter.hit("b", now=1)
+    limiter.hit("a", now=2)  # refused, but "a" is now the most recent
+    limiter.hit("c", now=3)
+    assert len(limiter) == 2
+    assert limiter.hit("a", now=4) is not None  # still tracked
+    assert limiter.hit("b", now=5) is None      # forgotten
+    assert limiter.stats()["evictions"] == 2
+
+
+def test_idle_keys_dropped():
+    limiter = SlidingWindowLimiter(5)
+    for i in range(100):
+        limiter.hit(f"10.0.0.{i}", now=0)
+    limiter.hit("fresh", now=200)
+    assert len(limiter) == 1
+
+
+def test_network_key():
+    assert network_key("192.0.2.77") == "192.0.2.0/24"
+    assert network_key("2001:db8:1:2:3:4:5:6") == "2001:db8:1:2::/64"
+    assert network_key("unknown") == "unknown"
+
+
+def test_aggregated_middleware():
+    app = FastAPI()
+
+    @app.get("/ping")
+    async def ping():
+        return {"ok": True}
+
+    app.add_middleware(RateLimitMiddleware, requests_per_minute=2, aggregate=True)
+    client = TestClient(app)
+    for host in ("198.51.100.1", "198.51.100.2"):
+        assert client.get("/ping", headers={"x-forwarded-for": host}).status_code == 200
+    blocked = client.get("/ping", headers={"x-forwarded-for": "198.51.100.3"})
+    assert blocked.status_code == 429
+    assert int(blocked.headers["retry-after"]) > 0
+    assert client.get("/ping", headers={"x-forwarded-for": "198.51.101.1"}).status_code == 200
+
+
+def test_shared_between_mappings(tmp_path):
+    path = str(tmp_path / "ratelimit")
+    one, two = SharedWindowLimiter(path, 3), SharedWindowLimiter(path, 3)
+    assert one.hit("a", now=1000) is None
+    assert two.hit("a", now=1001) is None
+    assert one.hit("a", now=1002) is None
+    assert two.hit("a", now=1003) == pytest.approx(60 + 60 * (1 - 2 / 3) - 3)
+    assert two.hit("b", now=1003) is None
+    assert len(one) == 2
+
+
+def _hits(path, count, results):
+    limiter = SharedWindowLimiter(path, 60)
+    results.put(sum(limiter.hit("client", now=1000) is None for _ in range(count)))
+
+
+def test_shared_across_processes(tmp_path):
+    path = str(tmp_path / "ratelimit")
+    SharedWindowLimiter(path, 60).close()
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    workers = [context.Process(target=_hits, args=(path, 30, results)) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    allowed = sum(results.get(timeout=30) for _ in workers)
+    for worker in workers:
+        worker.join()
+    assert allowed == 60
+
+
+def test_shared_table_is_bounded(tmp_path):
+    path = str(tmp_path / "ratelimit")
+    limiter = SharedWindowLimiter(path, 5, max_keys=8)  # one bucket
+    size = os.path.getsize(limiter.path)
+    for i in range(20):
+        limiter.hit(f"10.0.0.{i}", now=1000 + i)
+    assert len(limiter) == 8
+    assert limiter.stats()["evictions"] == 12
+    assert os.path.getsize(limiter.path) == size
+    assert limiter.hit("10.0.0.19", now=1030) is None  # recent: still tracked
+    assert limiter.stats()["evictions"] == 12
+    # Other settings get a table of their own; this one is left as it was.
+    other = SharedWindowLimiter(path, 5, window=30, max_keys=8)
+    assert other.path != limiter.path
+    assert len(other) == 0
+    assert os.path.getsize(limiter.path) == size
+    assert len(limiter) == len(SharedWindowLimiter(path, 5, max_keys=8)) == 8
+
+
+def test_shared_table_in_another_layout_is_refused(tmp_path, capsys):
+    path = str(tmp_path / "ratelimit")
+    table = SharedWindowLimiter(path, 5, max_keys=8).path
+    with open(table, "r+b") as f:
+        f.truncate(4)  # e.g. not ours
+    limiter = make_limiter(5, max_keys=8, shared=path)
+    assert not isinstance(limiter, SharedWindowLimiter)
+    assert "limiting per process" in capsys.readouterr().out
+    assert os.path.getsize(table) == 4
+
+
+def test_shared_middleware(tmp_path):
+    app = FastAPI()
+
+    @app.get("/ping")
+    async def ping():
+        return {"ok": True}
+
+    path = str(tmp_path / "ratelimit")
+    app.add_middleware(RateLimitMiddleware, requests_per_minute=1, shared=path)
+    assert TestClient(app).get("/ping").status_code == 200
+    assert SharedWindowLimiter(path, 1).hit("testclient") is not None
@@ -0,0 +1,60 @@
+"""Tests for the rendered-page cache (``directory.RENDER_CACHE``) and the
+byte budget of ``cache.LRUCache``.
+
+Spec: rendered directory pages are cached by their input fingerprint (the
+directory ETag, which includes the query parameters templates read), within
+a total byte budget; least recently used pages are evicted first, and the
+cache counts hits, misses and evictions.
+"""
+
+from k0sngin import directory
+from k0sngin.cache import LRUCache
+
+
+def test_byte_budget_evicts_least_recently_used():
+    cache = LRUCache(maxsize=None, maxbytes=10)
+    cache.put("a", b"aaaa", size=4)
+    cache.put("b", b"bbbb", size=4)
+    cache.get("a")
+    cache.put("c", b"cccc", size=4)
+    assert "b" not in cache
+    assert "a" in cache and "c" in cache
+    assert cache.stats()["bytes"] == 8
+    assert cache.evictions == 1
+
+
+def test_oversized_value_is_not_stored():
+    cache = LRUCache(maxsize=None, maxbytes=10)
+    cache.put("big", b"x" * 11, size=11)
+    assert "big" not in cache
+
+
+def test_replacing_a_key_keeps_the_byte_count():
+    cache = LRUCache(maxsize=None, maxbytes=100)
+    cache.put("a", b"x" * 10, size=10)
+    cache.put("a", b"x" * 20, size=20)
+    assert cache.nbytes == 20
+    cache.pop("a")
+    assert cache.nbytes == 0
+
+
+def test_repeat_request_served_from_cache(client, site_root, monkeypatch, settle):
+    d = site_root / "render_cache"
+    d.mkdir()
+    (d / "index.ini").write_text("/title = Rendered once\n")
+    settle(d / "index.ini", d)
+    first = client.get("/render_cache/")
+    renders = []
+    real_prepare = directory.prepare_directory
+    monkeypatch.setattr(directory, "prepare_directory",
+                        lambda *args: renders.append(args) or real_prepare(*args))
+    hits = directory.RENDER_CACHE.hits
+    second = client.get("/render_cache/")
+    assert second.text == first.text
+    assert second.headers["etag"] == first.headers["etag"]
+    assert second.headers["cache-control"] == "no-cache"
+    assert renders == []
+    assert directory.RENDER_CACHE.hits == hits + 1
+    # A query parameter the templates read is part of the key.
+    client.get("/render_cache/?index=1")
+    assert len(renders) == 1
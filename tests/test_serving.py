@@ -30,6 +30,21 @@ def test_security_headers_and_commit_present(client):
     assert r.headers.get("x-k0sngin-commit")
 
 
+def test_security_headers_replace_the_response_s_own():
+    """A response that sets a security header itself doesn't send it twice."""
+    from fastapi.testclient import TestClient
+    from starlette.responses import Response
+    from k0sngin.main import SecurityHeadersMiddleware
+
+    async def app(scope, receive, send):
+        await Response("x", headers={"X-Frame-Options": "SAMEORIGIN", "X-Other": "kept"})(
+            scope, receive, send)
+
+    r = TestClient(SecurityHeadersMiddleware(app)).get("/")
+    assert r.headers.get_list("x-frame-options") == ["DENY"]
+    assert r.headers["x-other"] == "kept"
+
+
 def test_missing_file_returns_404(client):
     """A nonexistent path returns 404 (not 403), avoiding info disclosure."""
     assert client.get("/does-not-exist.txt").status_code == 404
@@ -0,0 +1,105 @@
+"""Tests for the in-memory small-file cache (``main.SMALL_FILE_CACHE``).
+
+Spec: settled files up to ``SMALL_FILE_MAX_SIZE`` bytes are kept in memory
+with their response headers; a repeat request is served from memory (no
+``open()``) with the same headers as the uncached response. Entries are
+validated by stat signature, so edits, replacements and deletions show up on
+the next request. Range requests and large files bypass the cache.
+"""
+
+import os
+
+import pytest
+
+from k0sngin import main
+
+
+@pytest.fixture
+def opens(monkeypatch):
+    calls = []
+    real_open = open
+    monkeypatch.setattr("builtins.open", lambda path, *args, **kwargs:
+                        calls.append(os.fspath(path)) or real_open(path, *args, **kwargs))
+    return calls
+
+
+def test_hit_is_served_from_memory(client, site_root, opens, monkeypatch, settle):
+    path = site_root / "small_hit.css"
+    path.write_text("body {}")
+    settle(path)
+    with monkeypatch.context() as m:
+        m.setattr(main.SMALL_FILE_CACHE, "maxbytes", 0)
+        uncached = client.get("/small_hit.css")
+    assert str(path) not in main.SMALL_FILE_CACHE
+    client.get("/small_hit.css")
+    assert str(path) in main.SMALL_FILE_CACHE
+    opens.clear()
+    hits = main.SMALL_FILE_CACHE.hits
+    r = client.get("/small_hit.css")
+    assert r.text == "body {}"
+    assert main.SMALL_FILE_CACHE.hits == hits + 1
+    assert str(path) not in opens
+    for header in ("etag", "last-modified", "content-length", "content-type",
+                   "content-disposition", "cache-control"):
+        assert r.headers[header] == uncached.headers[header]
+
+
+def test_conditional_and_head_requests(client, site_root, settle):
+    path = site_root / "small_cond.txt"
+    path.write_text("hello\n")
+    settle(path)
+    etag = client.get("/small_cond.txt").headers["etag"]
+    r = client.get("/small_cond.txt", headers={"if-none-match": etag})
+    assert r.status_code == 304
+    assert r.headers["etag"] == etag
+    r = client.head("/small_cond.txt")
+    assert r.status_code == 200
+    assert r.content == b""
+    assert r.headers["content-length"] == "6"
+
+
+def test_edit_and_deletion_are_seen(client, site_root, settle):
+    path = site_root / "small_edit.txt"
+    path.write_text("before\n")
+    settle(path)
+    assert client.get("/small_edit.txt").text == "before\n"
+    path.write_text("after the edit\n")
+    settle(path, mtime=1_500_000_100)
+    assert client.get("/small_edit.txt").text == "after the edit\n"
+    path.unlink()
+    assert client.get("/small_edit.txt").status_code == 404
+
+
+def test_recent_large_and_range_requests_are_not_cached(client, site_root, monkeypatch, settle):
+    recent = site_root / "small_recent.txt"
+    recent.write_text("just written\n")
+    client.get("/small_recent.txt")
+    assert str(recent) not in main.SMALL_FILE_CACHE
+
+    monkeypatch.setattr(main, "SMALL_FILE_MAX_SIZE", 4)
+    large = site_root / "small_large.txt"
+    large.write_text("too large\n")
+    settle(large)
+    assert client.get("/small_large.txt").text == "too large\n"
+    assert str(large) not in main.SMALL_FILE_CACHE
+
+    monkeypatch.setattr(main, "SMALL_FILE_MAX_SIZE", 1024)
+    ranged = site_root / "small_range.txt"
+    ranged.write_text("0123456789")
+    settle(ranged)
+    client.get("/small_range.txt")
+    r = client.get("/small_range.txt", headers={"range": "bytes=2-4"})
+    assert r.status_code == 206
+    assert r.content == b"234"
+
+
+def test_byte_budget_evicts(client, site_root, monkeypatch, settle):
+    monkeypatch.setattr(main.SMALL_FILE_CACHE, "maxbytes", 10)
+    for name in ("small_a.txt", "small_b.txt"):
+        path = site_root / name
+        path.write_text("123456\n")
+        settle(path)
+        client.get(f"/{name}")
+    assert str(site_root / "small_b.txt") in main.SMALL_FILE_CACHE
+    assert str(site_root / "small_a.txt") not in main.SMALL_FILE_CACHE
+    assert main.SMALL_FILE_CACHE.nbytes <= 10
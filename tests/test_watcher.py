@@ -0,0 +1,88 @@
+"""Tests for inotify-driven cache invalidation (``watcher.Watcher``).
+
+Spec: while a watcher runs, ``cache.stat_signature`` is memoized for paths
+whose changes inotify is guaranteed to report (entries of watched
+directories that are not symlinks); every change invalidates the memo, so
+cached lookups stay current without per-request stats. On overflow the
+watcher stops vouching for anything and callers fall back to stat.
+"""
+
+import os
+import sys
+import time
+
+import pytest
+
+from k0sngin import cache
+from k0sngin.watcher import IN_Q_OVERFLOW, Watcher
+
+pytestmark = pytest.mark.skipif(not sys.platform.startswith("linux"),
+                                reason="inotify is Linux-only")
+
+
+@pytest.fixture
+def watched(tmp_path):
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "a.txt").write_text("a")
+    (tmp_path / "link.txt").symlink_to(tmp_path / "sub" / "a.txt")
+    w = Watcher([tmp_path])
+    if not w.start():
+        pytest.skip("inotify unavailable")
+    yield w
+    w.stop()
+
+
+def _wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_coverage(watched, tmp_path):
+    assert watched.covers(str(tmp_path))
+    assert watched.covers(str(tmp_path / "sub" / "a.txt"))
+    assert watched.covers(str(tmp_path / "sub" / "missing.txt"))
+    assert not watched.covers(str(tmp_path / "link.txt"))  # events fire on the link
+    assert not watched.covers(str(tmp_path.parent / "elsewhere"))
+
+
+def test_stat_signature_is_memoized_and_invalidated(watched, tmp_path):
+    path = tmp_path / "sub" / "a.txt"
+    before = cache.stat_signature(path)
+    assert str(path) in cache.STAT_CACHE
+    path.write_text("changed contents")
+    assert _wait_for(lambda: str(path) not in cache.STAT_CACHE)
+    assert cache.stat_signature(path) != before
+
+
+def test_new_directory_is_watched(watched, tmp_path):
+    new = tmp_path / "sub" / "new"
+    new.mkdir()
+    assert _wait_for(lambda: watched.covers(str(new / "x.txt")))
+    cache.stat_signature(new / "x.txt")
+    (new / "x.txt").write_text("x")
+    assert _wait_for(lambda: cache.stat_signature(new / "x.txt") is not None)
+
+
+def test_overflow_falls_back_to_stat(watched, tmp_path):
+    path = tmp_path / "sub" / "a.txt"
+    cache.stat_signature(path)
+    watched._handle(-1, IN_Q_OVERFLOW, "")
+    assert not watched.covers(str(path))
+    assert str(path) not in cache.STAT_CACHE
+    path.write_text("after overflow")
+    assert cache.stat_signature(path)[2] == len("after overflow")
+
+
+def test_invalidation_reaches_registered_caches(watched, tmp_path):
+    seen = []
+    cache.on_invalidate(lambda path, subtree: seen.append(path))
+    try:
+        (tmp_path / "sub" / "b.txt").write_text("b")
+        assert _wait_for(lambda: str(tmp_path / "sub" / "b.txt") in seen)
+        assert str(tmp_path / "sub") in seen  # its directory's entries changed
+    finally:
+        cache._invalidators.pop()
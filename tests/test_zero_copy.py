@@ -0,0 +1,140 @@
+"""Tests for zero-copy file delivery.
+
+Spec: when the ASGI server offers ``http.response.pathsend`` the file body is
+handed over by path; with ``http.response.zerocopysend`` (which the
+middleware stack forwards) as an open file for the server to ``sendfile``;
+otherwise it is read in chunks. The response headers are the same either
+way. ``K0SNGIN_ZERO_COPY=0`` forces the chunked path. A cached descriptor
+goes by path only while the watcher vouches the path still names its file.
+Chunked reads go through the bounded blocking pool.
+"""
+
+import os
+
+import anyio
+import pytest
+
+from k0sngin import filecache
+from k0sngin.filecache import PATHSEND, ZEROCOPYSEND, OpenFileCache, OpenFileResponse
+from k0sngin.main import StatFileResponse, app
+
+
+def run(asgi_app, path, extensions=None, method="GET"):
+    """Call an ASGI app for ``path``; returns the messages it sent. A
+    zerocopysend message gets the bytes the server would have sent."""
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": method, "scheme": "http", "path": path, "raw_path": path.encode(),
+        "root_path": "", "query_string": b"", "headers": [(b"host", b"testserver")],
+        "client": ("127.0.0.1", 1234), "server": ("testserver", 80),
+        "extensions": extensions or {},
+    }
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == ZEROCOPYSEND:
+            message = {**message, "data": os.pread(
+                message["file"].fileno(), message["count"], message["offset"])}
+        messages.append(message)
+
+    anyio.run(asgi_app, scope, receive, send)
+    return messages
+
+
+@pytest.fixture
+def video(site_root):
+    path = site_root / "zero_copy.mp4"
+    path.write_bytes(b"\0video" * 1000)
+    return path
+
+
+def headers_of(messages):
+    return dict(messages[0]["headers"])
+
+
+def test_pathsend_through_the_app(client, video):
+    messages = run(app, "/zero_copy.mp4", {PATHSEND: {}})
+    assert messages[0]["status"] == 200
+    assert messages[-1] == {"type": PATHSEND, "path": str(video)}
+    chunked = client.get("/zero_copy.mp4")
+    headers = headers_of(messages)
+    for header in ("etag", "last-modified", "content-length", "content-type",
+                   "content-disposition", "cache-control"):
+        assert headers[header.encode()].decode() == chunked.headers[header]
+
+
+def test_zero_copy_can_be_disabled(video, monkeypatch):
+    monkeypatch.setattr(filecache, "ZERO_COPY", False)
+    messages = run(app, "/zero_copy.mp4", {PATHSEND: {}})
+    assert all(message["type"] != PATHSEND for message in messages)
+    body = b"".join(message.get("body", b"") for message in messages[1:])
+    assert body == video.read_bytes()
+
+
+def test_zerocopysend_needs_forwarding(video, monkeypatch):
+    monkeypatch.setattr(filecache, "FORWARDED_EXTENSIONS", {PATHSEND})
+    response = StatFileResponse(str(video), stat_result=os.stat(video))
+    messages = run(response, "/zero_copy.mp4", {ZEROCOPYSEND: {}})
+    assert all(message["type"] == "http.response.body" for message in messages[1:])
+
+    monkeypatch.setattr(filecache, "FORWARDED_EXTENSIONS", {PATHSEND, ZEROCOPYSEND})
+    response = StatFileResponse(str(video), stat_result=os.stat(video))
+    messages = run(response, "/zero_copy.mp4", {ZEROCOPYSEND: {}, PATHSEND: {}})
+    assert messages[-1]["type"] == PATHSEND  # pathsend is preferred
+    response = StatFileResponse(str(video), stat_result=os.stat(video))
+    messages = run(response, "/zero_copy.mp4", {ZEROCOPYSEND: {}})
+    assert messages[-1]["type"] == ZEROCOPYSEND
+    assert messages[-1]["data"] == video.read_bytes()
+    assert messages[-1]["count"] == video.stat().st_size
+
+
+def test_zerocopysend_through_the_app(video):
+    messages = run(app, "/zero_copy.mp4", {ZEROCOPYSEND: {}})
+    assert messages[0]["status"] == 200
+    assert headers_of(messages)[b"x-content-type-options"] == b"nosniff"
+    assert messages[-1]["type"] == ZEROCOPYSEND
+    assert messages[-1]["data"] == video.read_bytes()
+
+
+def test_open_file_uses_cached_descriptor(video, monkeypatch):
+    open_files = OpenFileCache(4)
+    entry = open_files.open(video, os.stat(video))
+    messages = run(OpenFileResponse(entry), "/zero_copy.mp4", {ZEROCOPYSEND: {}})
+    assert messages[-1]["file"].fileno() == entry.fd
+    assert messages[-1]["data"] == video.read_bytes()
+
+    # By path only while the watcher vouches the path is still this file.
+    entry = open_files.acquire(video)
+    messages = run(OpenFileResponse(entry), "/zero_copy.mp4", {PATHSEND: {}})
+    assert all(message["type"] == "http.response.body" for message in messages[1:])
+    assert b"".join(message["body"] for message in messages[1:]) == video.read_bytes()
+    monkeypatch.setattr(filecache.cache, "covered", lambda path: True)
+    entry = open_files.acquire(video)
+    messages = run(OpenFileResponse(entry), "/zero_copy.mp4", {PATHSEND: {}})
+    assert messages[-1] == {"type": PATHSEND, "path": str(video)}
+    open_files.invalidate(None, True)
+
+
+def test_chunked_reads_use_the_blocking_pool(video, monkeypatch):
+    reads = []
+    real_run_blocking = filecache.run_blocking
+
+    async def recording(func, *args):
+        reads.append(func)
+        return await real_run_blocking(func, *args)
+
+    monkeypatch.setattr(filecache, "run_blocking", recording)
+    response = StatFileResponse(str(video), stat_result=os.stat(video))
+    messages = run(response, "/zero_copy.mp4")
+    assert b"".join(message["body"] for message in messages[1:]) == video.read_bytes()
+    assert reads and set(reads) == {os.pread}
+
+    reads.clear()
+    open_files = OpenFileCache(4)
+    messages = run(OpenFileResponse(open_files.open(video, os.stat(video))), "/zero_copy.mp4")
+    assert b"".join(message["body"] for message in messages[1:]) == video.read_bytes()
+    assert reads and set(reads) == {os.pread}
+    open_files.invalidate(None, True)